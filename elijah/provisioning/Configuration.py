@@ -19,6 +19,7 @@
 #
 
 import os
+import multiprocessing
 
 
 class ConfigurationError(Exception):
@@ -53,6 +54,19 @@ class Options(object):
     SEPERATE_DEDUP_REDUCING_SEMANTICS   = False     
     # for test purposes, we can optionally save modified memory snapshot
     MEMORY_SAVE_PATH                    = None
+    # compare memory with base memory while saving memory snapshot.
+    # Not applicable with FREE_SUPPORT
+    MEMORY_DIFF_STREAMING               = True
+    # number of processes for CPU intensive steps of overlay creation
+    PROCESS_NUMBER                      = multiprocessing.cpu_count()
+    # compression of overlay blobs (see codec.Codec)
+    OVERLAY_CODEC                       = "xz"
+    OVERLAY_CODEC_LEVEL                 = 9
+    # uncompressed size of each overlay blob. Small blobs let a chunk
+    # demanded by VM be fetched without transferring the whole overlay
+    OVERLAY_BLOB_SIZE_KB                = 1024
+    # uncompressed size of independently compressed frame in a blob
+    OVERLAY_FRAME_SIZE_KB               = 256
 
     def __str__(self):
         import pprint
@@ -69,8 +83,11 @@ class Const(object):
     BASE_DISK_META          = ".base-img-meta"
     BASE_MEM_META           = ".base-mem-meta"
     BASE_HASH_VALUE         = ".base-hash"
+    HASH_INDEX_EXT          = "-index"
     OVERLAY_URIs            = ".overlay-URIs"
     OVERLAY_META            = "overlay-meta"
+    # sha256 of chunks of each frame, sent only for chunk negotiation
+    OVERLAY_CHUNK_HASHES_EXT = ".chunk-hashes"
     OVERLAY_FILE_PREFIX     = "overlay-blob"
     OVERLAY_ZIP             = "overlay.zip"
     OVERLAY_LOG             = ".overlay-log"
@@ -85,6 +102,19 @@ class Const(object):
     META_OVERLAY_FILE_SIZE              = "overlay_size"
     META_OVERLAY_FILE_DISK_CHUNKS       = "disk_chunk"
     META_OVERLAY_FILE_MEMORY_CHUNKS     = "memory_chunk"
+    META_OVERLAY_FILE_CODEC             = "codec"
+    META_OVERLAY_FILE_CODEC_LEVEL       = "codec_level"
+    META_OVERLAY_FILE_FRAMES            = "frames"
+    # [[index of referenced chunk, number of self references], ...]
+    META_OVERLAY_FILE_SELF_REFS         = "self_refs"
+    # sha256 hex digest of the compressed blob
+    META_OVERLAY_FILE_SHA256            = "overlay_sha256"
+    # each frame is compressed independently in a blob
+    META_FRAME_OFFSET                   = "offset"
+    META_FRAME_SIZE                     = "size"
+    META_FRAME_DECOMP_SIZE              = "decomp_size"
+    META_FRAME_MEMORY_CHUNK_COUNT       = "memory_chunk_count"
+    META_FRAME_DISK_CHUNK_COUNT         = "disk_chunk_count"
 
     MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
     QEMU_BIN_PATH           = which("cloudlet_qemu-system-x86_64")
@@ -137,16 +167,41 @@ class Const(object):
         dir_path = os.path.dirname(base_disk_path)
         return os.path.join(dir_path, image_name+Const.BASE_HASH_VALUE)
 
+    @staticmethod
+    def get_hashindex_path(meta_path):
+        return meta_path + Const.HASH_INDEX_EXT
+
 
 class Synthesis_Const(object):
     # PIPLINING CONSTANT
     TRANSFER_SIZE           = 1024*16
     END_OF_FILE             = "!!Overlay Transfer End Marker"
     ERROR_OCCURED           = "!!Overlay Transfer Error Marker"
+    # (BLOB_BEGIN, blob name) is queued before data of each blob
+    BLOB_BEGIN              = "!!Overlay Blob Begin Marker"
+    # (DELTA_ITEMS, data) is serialized delta items, not compressed
+    DELTA_ITEMS             = "!!Overlay Delta Items Marker"
 
     # Synthesis Server
     LOCAL_IPADDRESS = 'localhost'
     SERVER_PORT_NUMBER = 8021
+    # number of synthesis sessions admitted at once
+    MAX_SESSION_NUMBER = multiprocessing.cpu_count()
+    # admitted session with no request for this many seconds is closed
+    # when other sessions wait for admission. 0 keeps idle sessions
+    SESSION_IDLE_TIMEOUT = 60*30
+    # number of processes recovering xdelta items of each session.
+    # None splits CPUs across the maximum number of sessions
+    RECOVERY_PROCESS_NUMBER = None
+    # received overlay blobs are kept for later sessions
+    OVERLAY_CACHE_DIR = os.path.abspath(os.path.join(Const.HOME_DIR, ".cloudlet", "overlay-cache"))
+    OVERLAY_CACHE_SIZE_MB = 1024*10   # 10 GB, 0 disables cache
+    # recovered launch images are kept for the same overlay
+    LAUNCH_CACHE_DIR = os.path.abspath(os.path.join(Const.HOME_DIR, ".cloudlet", "launch-cache"))
+    LAUNCH_CACHE_SIZE_MB = 0    # disabled by default
+    # chunks of recovered overlays, so that client can skip them
+    CHUNK_STORE_DIR = os.path.abspath(os.path.join(Const.HOME_DIR, ".cloudlet", "chunk-store"))
+    CHUNK_STORE_SIZE_MB = 1024*4    # 4 GB, 0 disables chunk store
 
 
 class Caching_Const(object):
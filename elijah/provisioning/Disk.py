@@ -22,9 +22,13 @@ import struct
 import os
 import sys
 import mmap
+import errno
+import bisect
+import itertools
+import multiprocessing
 from math import ceil
 from hashlib import sha256
-from operator import itemgetter
+from operator import attrgetter
 
 import tool
 import delta
@@ -41,51 +45,193 @@ class DiskError(Exception):
     pass
 
 
-def hashing(disk_path, meta_path, chunk_size=4096, window_size=512):
-    # TODO: need more efficient implementation, e.g. bisect
+# size of disk hashed at a time by a worker
+HASHING_TASK_SIZE = 1024*1024*4
+# maximum size of a sequential read of modified disk chunks
+DELTA_READ_SIZE = 1024*1024
+# number of reads queued to the xdelta pool at a time per process
+DELTA_READS_PER_PROCESS = 2
+
+
+# lseek whence values for sparse file (Linux), not defined at python 2 os module
+SEEK_DATA = getattr(os, "SEEK_DATA", 3)
+SEEK_HOLE = getattr(os, "SEEK_HOLE", 4)
+
+# disk mmap and data extents of hashing worker process
+_hashing_disk = None
+_hashing_extents = None
+
+
+def _get_data_extents(disk_path, disk_size):
+    # return list of (start, end) of data extents at sparse file.
+    # Whole file is one extent if file system does not support SEEK_DATA
+    extents = list()
+    fd = os.open(disk_path, os.O_RDONLY)
+    try:
+        offset = 0
+        while offset < disk_size:
+            try:
+                data_start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError, e:
+                if e.errno == errno.ENXIO:
+                    break   # no more data until the end of file
+                raise
+            data_end = os.lseek(fd, data_start, SEEK_HOLE)
+            extents.append((data_start, min(data_end, disk_size)))
+            offset = data_end
+    except OSError, e:
+        LOG.debug("Cannot find holes of %s : %s" % (disk_path, str(e)))
+        extents = [(0, disk_size)]
+    finally:
+        os.close(fd)
+    return extents
+
+
+def _init_hashing_worker(disk_path, data_extents):
+    global _hashing_disk
+    global _hashing_extents
+    disk_file = open(disk_path, "rb")
+    _hashing_disk = mmap.mmap(disk_file.fileno(), 0, prot=mmap.PROT_READ)
+    disk_file.close()
+    _hashing_extents = data_extents
+
+
+def _hash_windows(args):
+    # hash windows starting at [start_offset, end_offset) by window_size
+    # return: list of (hash, offset) for the first appearance of each hash
+    start_offset, end_offset, chunk_size, window_size = args
+    disk_mmap = _hashing_disk
+    extents = _hashing_extents
+    zero_hash = sha256(chr(0x00)*chunk_size).digest()
+    hash_dict = dict()
+    hash_list = list()
+    prev_data = None
+    hashed_data = None
+
+    # first extent that ends after start_offset
+    extent_index = bisect.bisect_right(extents, (start_offset, sys.maxint))
+    if extent_index > 0 and extents[extent_index-1][1] > start_offset:
+        extent_index -= 1
+
+    s_offset = start_offset
+    while s_offset < end_offset:
+        while extent_index < len(extents) and extents[extent_index][1] <= s_offset:
+            extent_index += 1
+        if extent_index == len(extents) or \
+                extents[extent_index][0] >= s_offset+chunk_size:
+            # window is in a hole. Every window until the next data extent
+            # is zero, so only the first one is needed
+            if zero_hash not in hash_dict:
+                hash_dict[zero_hash] = True
+                hash_list.append((zero_hash, s_offset))
+            prev_data = None
+            if extent_index == len(extents):
+                break
+            next_data = extents[extent_index][0] - chunk_size + 1
+            next_window = (next_data + window_size - 1)/window_size*window_size
+            s_offset = max(s_offset+window_size, next_window)
+            continue
+
+        data = disk_mmap[s_offset:s_offset+chunk_size]
+        # Comparing with previous window is much cheaper than sha256, and
+        # repeated windows (e.g. zeros) are common at disk image
+        if data != prev_data:
+            hashed_data = sha256(data).digest()
+            prev_data = data
+            if hashed_data not in hash_dict:
+                hash_dict[hashed_data] = True
+                hash_list.append((hashed_data, s_offset))
+        s_offset += window_size
+    return hash_list
+
+
+def _hash_entire_disk(disk_path, hashing_size, data_extents):
+    # sha256 of the disk. Holes are not read from the disk, but
+    # zeros are given to the hash
+    entire_hashing = sha256()
+    zero_data = chr(0x00)*HASHING_TASK_SIZE
+    disk_file = open(disk_path, "rb")
+    offset = 0
+    for (data_start, data_end) in data_extents + [(hashing_size, hashing_size)]:
+        data_start = min(data_start, hashing_size)
+        data_end = min(data_end, hashing_size)
+        while offset < data_start:
+            zero_size = min(HASHING_TASK_SIZE, data_start-offset)
+            entire_hashing.update(zero_data[:zero_size])
+            offset += zero_size
+        disk_file.seek(offset)
+        while offset < data_end:
+            data = disk_file.read(min(HASHING_TASK_SIZE, data_end-offset))
+            if not data:
+                raise DiskError("disk size is changed while hashing")
+            entire_hashing.update(data)
+            offset += len(data)
+    disk_file.close()
+    return entire_hashing
+
+
+def hashing(disk_path, meta_path, chunk_size=4096, window_size=512, num_proc=1):
     # generate hash of base disk
     # disk_path : raw disk path
     # chunk_size : hash chunk size
     # window_size : slicing window size
-
-    prog_bar = AnimatedProgressBar(end=100, width=80, stdout=sys.stdout)
-    total_iteration = os.path.getsize(disk_path)/window_size
-    iter_count = 0
-    prog_interval = 100
-
-    disk_file = open(disk_path, "rb")
-    out_file = open(meta_path, "w+b")
-    data = disk_file.read(chunk_size)
-    if (not data) or len(data) < chunk_size:
+    # num_proc : number of processes for hashing
+    # return : sha256 of the disk, which is used as base VM hash value
+    disk_size = os.path.getsize(disk_path)
+    if disk_size < chunk_size:
         raise DiskError("invalid raw disk size")
 
-    entire_hashing = sha256()
-    entire_hashing.update(data)
+    # windows start at every window_size and the last window ends before
+    # the end of the disk. Trailing data shorter than window_size is not
+    # included in the hash of the disk.
+    window_count = (disk_size-chunk_size)/window_size + 1
+    hashing_size = chunk_size + (window_count-1)*window_size
+    data_extents = _get_data_extents(disk_path, disk_size)
+    windows_per_task = HASHING_TASK_SIZE/window_size
+    task_list = list()
+    for start_window in xrange(0, window_count, windows_per_task):
+        end_window = min(start_window+windows_per_task, window_count)
+        task_list.append((start_window*window_size, end_window*window_size,
+            chunk_size, window_size))
 
-    s_offset = 0
-    data_len = len(data)
-    hash_dic = dict()
-    while True:
-        if (iter_count)%prog_interval == 0:
-            prog_bar.process(100.0*prog_interval/total_iteration)
+    prog_bar = AnimatedProgressBar(end=100, width=80, stdout=sys.stdout)
+    pool = None
+    if num_proc > 1:
+        pool = multiprocessing.Pool(processes=num_proc,
+                initializer=_init_hashing_worker,
+                initargs=(disk_path, data_extents))
+        results = pool.imap(_hash_windows, task_list)
+    else:
+        _init_hashing_worker(disk_path, data_extents)
+        results = itertools.imap(_hash_windows, task_list)
+
+    try:
+        # hash of the entire disk while workers are hashing windows
+        entire_hashing = _hash_entire_disk(disk_path, hashing_size, data_extents)
+
+        # merge in the order of offset to keep the first appearance of each hash
+        hash_dic = dict()
+        for index, hash_list in enumerate(results):
+            for (hashed_data, s_offset) in hash_list:
+                if hash_dic.get(hashed_data) == None:
+                    hash_dic[hashed_data]= (hashed_data, s_offset, chunk_size)
+            prog_bar.set_percent(100.0*(index+1)/len(task_list))
             prog_bar.show_progress()
-        iter_count += 1
-
-        hashed_data = sha256(data).digest()
-        if hash_dic.get(hashed_data) == None:
-            hash_dic[hashed_data]= (hashed_data, s_offset, data_len)
-
-        added_data = disk_file.read(window_size)
-        if (not added_data) or len(added_data) != window_size:
-            break
-        s_offset += window_size
-        data = data[window_size:] + added_data
-        entire_hashing.update(added_data)
+        if pool:
+            pool.close()
+    except:
+        if pool:
+            pool.terminate()
+        raise
+    finally:
+        if pool:
+            pool.join()
+    prog_bar.finish()
 
+    out_file = open(meta_path, "w+b")
     for hashed_data, s_offset, data_len in list(hash_dic.values()):
         out_file.write(struct.pack("!QI%ds" % len(hashed_data), 
             s_offset, data_len, hashed_data))
-    disk_file.close()
     out_file.close()
 
     return entire_hashing.hexdigest()
@@ -170,13 +316,90 @@ def parse_qemu_log(qemu_logfile, chunk_size):
     return dma_dict, discard_dict
 
 
+# base disk mmap of disk delta worker process
+_delta_base_disk = None
+
+
+def _init_delta_worker(basedisk_path):
+    global _delta_base_disk
+    base_fd = open(basedisk_path, "rb")
+    _delta_base_disk = mmap.mmap(base_fd.fileno(), 0, prot=mmap.PROT_READ)
+    base_fd.close()
+
+
+def _diff_chunks(chunk_data_list):
+    # xdelta modified chunks with base disk
+    # chunk_data_list : list of (offset, data)
+    delta_list = list()
+    for (offset, data) in chunk_data_list:
+        source_data = _delta_base_disk[offset:offset+len(data)]
+        try:
+            patch = tool.diff_data(source_data, data, 2*len(source_data))
+            if len(patch) < len(data):
+                delta_item = DeltaItem(DeltaItem.DELTA_DISK,
+                        offset, len(data),
+                        hash_value=sha256(data).digest(),
+                        ref_id=DeltaItem.REF_XDELTA,
+                        data_len=len(patch),
+                        data=patch)
+            else:
+                raise IOError("xdelta3 patch is bigger than origianl")
+        except IOError as e:
+            #LOG.info("xdelta failed, so save it as raw (%s)" % str(e))
+            delta_item = DeltaItem(DeltaItem.DELTA_DISK,
+                    offset, len(data),
+                    hash_value=sha256(data).digest(),
+                    ref_id=DeltaItem.REF_RAW,
+                    data_len=len(data),
+                    data=data)
+        delta_list.append(delta_item)
+    return delta_list
+
+
+def _read_chunks(modified_disk, chunk_list, chunk_size):
+    # read sorted chunks merging adjacent chunks into a sequential read
+    # yield : list of (offset, data) for each read
+    modified_fd = open(modified_disk, "rb")
+    max_read_chunks = DELTA_READ_SIZE/chunk_size
+    index = 0
+    while index < len(chunk_list):
+        start_chunk = chunk_list[index]
+        end_index = index + 1
+        while end_index < len(chunk_list) and \
+                chunk_list[end_index] == start_chunk + (end_index-index) and \
+                end_index-index < max_read_chunks:
+            end_index += 1
+
+        modified_fd.seek(start_chunk*chunk_size)
+        data = modified_fd.read((end_index-index)*chunk_size)
+        chunk_data_list = list()
+        for chunk in chunk_list[index:end_index]:
+            start = (chunk-start_chunk)*chunk_size
+            chunk_data_list.append((chunk*chunk_size, data[start:start+chunk_size]))
+        yield chunk_data_list
+        index = end_index
+    modified_fd.close()
+
+
+def _imap_bounded(pool, func, iterable, batch_size):
+    # Pool drains its task iterator as fast as it can, so feed it in
+    # batches to bound the data in flight
+    while True:
+        batch = list(itertools.islice(iterable, batch_size))
+        if len(batch) == 0:
+            break
+        for result in pool.imap(func, batch):
+            yield result
+
+
 def create_disk_deltalist(modified_disk, 
             modified_chunk_dict, chunk_size,
             basedisk_hashlist=None, basedisk_path=None,
             trim_dict=None, dma_dict=None,
             apply_discard=True,
             used_blocks_dict=None,
-            ret_statistics=None):
+            ret_statistics=None,
+            num_proc=1):
     # get disk delta
     # base_diskmeta : hash list of base disk
     # base_disk: path to base VM disk
@@ -185,9 +408,7 @@ def create_disk_deltalist(modified_disk,
     # overlay_path : path to destination of overlay disk
     # dma_dict : dma information, 
     #           dma_dict[disk_chunk] = {'time':time, 'memory_chunk':memory chunk number, 'read': True if read from disk'}
-    base_fd = open(basedisk_path, "rb")
-    base_mmap = mmap.mmap(base_fd.fileno(), 0, prot=mmap.PROT_READ)
-    modified_fd = open(modified_disk, "rb")
+    # num_proc : number of processes for xdelta
 
     # 0. get info from qemu log file
     # dictionary : (chunk_%, discarded_time)
@@ -201,8 +422,8 @@ def create_disk_deltalist(modified_disk,
 
     # 1. get modified page
     LOG.debug("1.get modified disk page")
-    delta_list = list()
-    for index, chunk in enumerate(modified_chunk_dict.keys()):
+    chunk_list = list()
+    for chunk in sorted(modified_chunk_dict.keys()):
         offset = chunk * chunk_size
         ctime = modified_chunk_dict[chunk]
 
@@ -230,31 +451,33 @@ def create_disk_deltalist(modified_disk,
             # only apply when it is true
             if apply_discard:
                 continue
+        chunk_list.append(chunk)
+
+    # 1-1. read chunks in offset order and xdelta them at worker processes
+    chunk_reader = _read_chunks(modified_disk, chunk_list, chunk_size)
+    delta_list = list()
+    pool = None
+    if num_proc > 1:
+        pool = multiprocessing.Pool(processes=num_proc,
+                initializer=_init_delta_worker, initargs=(basedisk_path,))
+        results = _imap_bounded(pool, _diff_chunks, chunk_reader,
+                num_proc*DELTA_READS_PER_PROCESS)
+    else:
+        _init_delta_worker(basedisk_path)
+        results = itertools.imap(_diff_chunks, chunk_reader)
+    try:
+        for chunk_delta_list in results:
+            delta_list.extend(chunk_delta_list)
+        if pool:
+            pool.close()
+    except:
+        if pool:
+            pool.terminate()
+        raise
+    finally:
+        if pool:
+            pool.join()
 
-        # check file system 
-        modified_fd.seek(offset)
-        data = modified_fd.read(chunk_size)
-        source_data = base_mmap[offset:offset+len(data)]
-        try:
-            patch = tool.diff_data(source_data, data, 2*len(source_data))
-            if len(patch) < len(data):
-                delta_item = DeltaItem(DeltaItem.DELTA_DISK,
-                        offset, len(data),
-                        hash_value=sha256(data).digest(),
-                        ref_id=DeltaItem.REF_XDELTA,
-                        data_len=len(patch),
-                        data=patch)
-            else:
-                raise IOError("xdelta3 patch is bigger than origianl")
-        except IOError as e:
-            #LOG.info("xdelta failed, so save it as raw (%s)" % str(e))
-            delta_item = DeltaItem(DeltaItem.DELTA_DISK,
-                    offset, len(data),
-                    hash_value=sha256(data).digest(),
-                    ref_id=DeltaItem.REF_RAW,
-                    data_len=len(data),
-                    data=data)
-        delta_list.append(delta_item)
     if ret_statistics != None:
         ret_statistics['trimed'] = trim_counter
         ret_statistics['xrayed'] = xray_counter
@@ -280,7 +503,7 @@ def recover_disk(base_disk, base_mem, overlay_mem, overlay_disk, recover_path, c
     # overlay map
     chunk_list = []
     # sort delta list using offset
-    delta_list.sort(key=itemgetter('offset'))
+    delta_list.sort(key=attrgetter('offset'))
     for delta_item in delta_list:
         if len(delta_item.data) != chunk_size:
             raise DiskError("recovered size is not same as page size")
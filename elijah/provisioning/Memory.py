@@ -23,12 +23,15 @@ import sys
 import struct
 import tool
 import mmap
+import collections
 import subprocess
+import multiprocessing
 from optparse import OptionParser
 from hashlib import sha256
 
 import vmnetx
 from Configuration import Const
+from hashindex import HashMetaFile
 from progressbar import AnimatedProgressBar
 from delta import DeltaItem
 from delta import DeltaList
@@ -41,6 +44,12 @@ LOG = logging.getLogger(__name__)
 class MemoryError(Exception):
     pass
 
+
+# (base memory, modified memory path, free_pfn_dict, apply_free_memory)
+# set before forking page diff workers
+_diff_context = None
+_diff_worker_file = None
+
 class Memory(object):
     HASH_FILE_MAGIC = 0x1145511a
     HASH_FILE_VERSION = 0x00000001
@@ -59,6 +68,15 @@ class Memory(object):
     RAM_SAVE_FLAG_CONTINUE = 0x20
     BLK_MIG_FLAG_EOS       = 0x02
 
+    # number of pages compared by a worker at a time
+    DIFF_RANGE_PAGES = 1024
+    # number of pages compared with base memory at once
+    DIFF_BLOCK_PAGES = 256
+    ZERO_PAGE = chr(0x00) * RAM_PAGE_SIZE
+    ZERO_PAGE_HASH = sha256(ZERO_PAGE).digest()
+    # return value of _diff_page for discarded free memory page
+    FREED_PAGE = -1
+
     def __init__(self):
         self.hash_list = []
         self.raw_file = ''
@@ -87,75 +105,176 @@ class Memory(object):
         # kwargs
         #  diff: compare hash_list with self object
         #  free_pfn_dict: free memory physical frame number as a dictionary {'#':1, ... }
+        #  num_proc: number of processes for comparing pages (only for diff)
         diff = kwargs.get("diff", None)
         apply_free_memory = kwargs.get("apply_free_memory", True)
         free_pfn_dict = kwargs.get("free_pfn_dict", None)
+        num_proc = kwargs.get("num_proc", 1)
+        if diff and num_proc > 1:
+            return self._get_mem_hash_parallel(fin.name, end_offset, hash_list,
+                    num_proc, free_pfn_dict=free_pfn_dict,
+                    apply_free_memory=apply_free_memory)
+
         LOG.info("Get hash list of memory page")
         prog_bar = AnimatedProgressBar(end=100, width=80, stdout=sys.stdout)
 
         total_size = end_offset
         ram_offset = 0
         freed_page_counter = 0
-        base_hashlist_length = len(self.hash_list)
+        unchanged_page_counter = 0
         while total_size != ram_offset:
-            data = fin.read(Memory.RAM_PAGE_SIZE)
             if not diff:
+                data = fin.read(Memory.RAM_PAGE_SIZE)
                 hash_list.append((ram_offset, len(data), sha256(data).digest()))
             else:
-                # compare input with hash or corresponding base memory, save only when it is different
-                hash_list_index = ram_offset/Memory.RAM_PAGE_SIZE
-                if hash_list_index < base_hashlist_length:
-                    self_hash_value = self.hash_list[hash_list_index][2]
-                else:
-                    self_hash_value = None
-
-                if self_hash_value != sha256(data).digest():
-                    is_free_memory = False
-                    if (free_pfn_dict != None) and \
-                            (free_pfn_dict.get(long(ram_offset/Memory.RAM_PAGE_SIZE), None) == 1):
-                        is_free_memory = True
-
-                    if is_free_memory and apply_free_memory:
-                        # Do not compare. It is free memory
-                        freed_page_counter += 1
-                    else:
-                        #get xdelta comparing self.raw
-                        source_data = self.get_raw_data(ram_offset, len(data))
-                        #save xdelta as DeltaItem only when it gives smaller
-                        try:
-                            if source_data == None:
-                                raise IOError("launch memory snapshot is bigger than base vm")
-                            patch = tool.diff_data(source_data, data, 2*len(source_data))
-                            if len(patch) < len(data):
-                                delta_item = DeltaItem(DeltaItem.DELTA_MEMORY,
-                                        ram_offset, len(data),
-                                        hash_value=sha256(data).digest(),
-                                        ref_id=DeltaItem.REF_XDELTA,
-                                        data_len=len(patch),
-                                        data=patch)
-                            else:
-                                raise IOError("xdelta3 patch is bigger than origianl")
-                        except IOError as e:
-                            #LOG.info("xdelta failed, so save it as raw (%s)" % str(e))
-                            delta_item = DeltaItem(DeltaItem.DELTA_MEMORY,
-                                    ram_offset, len(data),
-                                    hash_value=sha256(data).digest(),
-                                    ref_id=DeltaItem.REF_RAW,
-                                    data_len=len(data),
-                                    data=data)
-                        hash_list.append(delta_item)
+                # compare a block of pages at once, and hash only changed pages
+                data = fin.read(Memory.RAM_PAGE_SIZE*Memory.DIFF_BLOCK_PAGES)
+                freed_count, unchanged_count = self._diff_block(ram_offset,
+                        data, hash_list, free_pfn_dict, apply_free_memory)
+                freed_page_counter += freed_count
+                unchanged_page_counter += unchanged_count
 
                 # memory over-usage protection
                 if len(hash_list) > Memory.RAM_PAGE_SIZE*1000000: # 400MB for hashlist
                     raise MemoryError("possibly comparing with wrong base VM")
             ram_offset += len(data)
             # print progress bar for every 100 page
-            if (ram_offset % (Memory.RAM_PAGE_SIZE*100)) == 0:
+            if diff or (ram_offset % (Memory.RAM_PAGE_SIZE*100)) == 0:
                 prog_bar.set_percent(100.0*ram_offset/total_size)
                 prog_bar.show_progress()
         prog_bar.finish()
+        if diff:
+            self._report_unchanged(unchanged_page_counter)
         return freed_page_counter
 
+    def _get_mem_hash_parallel(self, filepath, end_offset, hash_list, num_proc,
+            free_pfn_dict=None, apply_free_memory=True):
+        # compare modified memory with base memory using multiple processes.
+        # Each worker mmaps both snapshots and diffs a range of pages.
+        # Results are merged in offset order, so the delta list is the same
+        # as the one from the serial comparison
+        global _diff_context
+        LOG.info("Get hash list of memory page using %d processes" % num_proc)
+        prog_bar = AnimatedProgressBar(end=100, width=80, stdout=sys.stdout)
+
+        range_size = Memory.RAM_PAGE_SIZE*Memory.DIFF_RANGE_PAGES
+        page_ranges = [(start, min(start+range_size, end_offset))
+                for start in xrange(0, end_offset, range_size)]
+        # workers are forked, so they inherit base memory and hash list
+        _diff_context = (self, filepath, free_pfn_dict, apply_free_memory)
+        pool = multiprocessing.Pool(processes=num_proc,
+                initializer=_init_diff_worker)
+        try:
+            freed_page_counter = 0
+            unchanged_page_counter = 0
+            results = pool.imap(_diff_page_range, page_ranges)
+            for index, (delta_items, freed_count, unchanged_count) in enumerate(results):
+                hash_list.extend(delta_items)
+                freed_page_counter += freed_count
+                unchanged_page_counter += unchanged_count
+
+                # memory over-usage protection
+                if len(hash_list) > Memory.RAM_PAGE_SIZE*1000000: # 400MB for hashlist
+                    raise MemoryError("possibly comparing with wrong base VM")
+                prog_bar.set_percent(100.0*(index+1)/len(page_ranges))
+                prog_bar.show_progress()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _diff_context = None
+        prog_bar.finish()
+        self._report_unchanged(unchanged_page_counter)
+        return freed_page_counter
+
+    def _report_unchanged(self, unchanged_page_counter):
+        self.unchanged_counter = unchanged_page_counter
+        LOG.info("Skip %ld pages that are same as base memory (%ld bytes)" % \
+                (unchanged_page_counter, unchanged_page_counter*Memory.RAM_PAGE_SIZE))
+
+    def _diff_block(self, block_offset, data_block, delta_list,
+            free_pfn_dict, apply_free_memory):
+        # compare a block of modified memory with base memory at the same
+        # offset before hashing. Comparing raw bytes is much cheaper than
+        # sha256, so only pages that really differ are hashed and diffed.
+        # return: (freed page count, unchanged page count)
+        base_block = self.get_raw_block(block_offset, len(data_block))
+        if data_block == base_block:
+            page_count = (len(data_block) + Memory.RAM_PAGE_SIZE - 1)/Memory.RAM_PAGE_SIZE
+            return 0, page_count
+
+        freed_page_counter = 0
+        unchanged_page_counter = 0
+        for start in xrange(0, len(data_block), Memory.RAM_PAGE_SIZE):
+            end = start + Memory.RAM_PAGE_SIZE
+            data = data_block[start:end]
+            if data == base_block[start:end]:
+                unchanged_page_counter += 1
+                continue
+            delta_item = self._diff_page(block_offset+start, data,
+                    free_pfn_dict, apply_free_memory)
+            if delta_item == Memory.FREED_PAGE:
+                freed_page_counter += 1
+            elif delta_item:
+                delta_list.append(delta_item)
+        return freed_page_counter, unchanged_page_counter
+
+    def _diff_page(self, ram_offset, data, free_pfn_dict, apply_free_memory):
+        # compare a page of modified memory with base memory
+        # return: DeltaItem if page is modified, Memory.FREED_PAGE if it is
+        #         discarded as free memory, None if it is same as base
+        hash_list_index = ram_offset/Memory.RAM_PAGE_SIZE
+        if hash_list_index < len(self.hash_list):
+            self_hash_value = self.hash_list[hash_list_index][2]
+        else:
+            self_hash_value = None
+
+        hash_value = sha256(data).digest()
+        if self_hash_value == hash_value:
+            return None
+
+        if (free_pfn_dict != None) and apply_free_memory and \
+                (free_pfn_dict.get(long(hash_list_index), None) == 1):
+            # Do not compare. It is free memory
+            return Memory.FREED_PAGE
+
+        if data == Memory.ZERO_PAGE:
+            # no need to diff zero page, it will be deduplicated with zeros
+            return DeltaItem(DeltaItem.DELTA_MEMORY,
+                    ram_offset, len(data),
+                    hash_value=Memory.ZERO_PAGE_HASH,
+                    ref_id=DeltaItem.REF_ZEROS,
+                    data_len=8,
+                    data=long(-1))
+
+        #get xdelta comparing self.raw
+        source_data = self.get_raw_data(ram_offset, len(data))
+        #save xdelta as DeltaItem only when it gives smaller
+        try:
+            if source_data == None:
+                raise IOError("launch memory snapshot is bigger than base vm")
+            patch = tool.diff_data(source_data, data, 2*len(source_data))
+            if len(patch) < len(data):
+                delta_item = DeltaItem(DeltaItem.DELTA_MEMORY,
+                        ram_offset, len(data),
+                        hash_value=hash_value,
+                        ref_id=DeltaItem.REF_XDELTA,
+                        data_len=len(patch),
+                        data=patch)
+            else:
+                raise IOError("xdelta3 patch is bigger than origianl")
+        except IOError as e:
+            #LOG.info("xdelta failed, so save it as raw (%s)" % str(e))
+            delta_item = DeltaItem(DeltaItem.DELTA_MEMORY,
+                    ram_offset, len(data),
+                    hash_value=hash_value,
+                    ref_id=DeltaItem.REF_RAW,
+                    data_len=len(data),
+                    data=data)
+        return delta_item
+
     @staticmethod
     def _seek_to_end_of_ram(fin):
         # get ram total length
@@ -212,6 +331,7 @@ class Memory(object):
         ####
         diff = kwargs.get("diff", None)
         apply_free_memory = kwargs.get("apply_free_memory", True)
+        num_proc = kwargs.get("num_proc", 1)
         if diff and len(self.hash_list) == 0:
             raise MemoryError("Cannot compare give file this self.hashlist")
 
@@ -253,7 +373,7 @@ class Memory(object):
             fin.seek(0)
             freed_counter = self._get_mem_hash(fin, file_size, hash_list, \
                     diff=diff, free_pfn_dict=self.free_pfn_dict, \
-                    apply_free_memory=apply_free_memory)
+                    apply_free_memory=apply_free_memory, num_proc=num_proc)
         else:
             # case for generating base memory hash list
             fin.seek(0)
@@ -277,7 +397,8 @@ class Memory(object):
         memory = Memory()
         memory.raw_file = open(raw_path, "rb")
         memory.raw_filesize = os.path.getsize(raw_path)
-        hashlist = Memory.import_hashlist(meta_path)
+        # hash list is read from mmaped meta file only when it is accessed
+        hashlist = HashMetaFile(meta_path, HashMetaFile.MEMORY_META_FORMAT)
         memory.hash_list = hashlist
         return memory
 
@@ -317,24 +438,159 @@ class Memory(object):
 
     def get_raw_data(self, offset, length):
         # retrieve page data from raw memory
-        if not self.raw_mmap:
-            self.raw_mmap = mmap.mmap(self.raw_file.fileno(), 0, prot=mmap.PROT_READ)
         if offset+length < self.raw_filesize:
-            return self.raw_mmap[offset:offset+length]
+            return self.get_raw_block(offset, length)
         else:
             return None
 
-    def get_modified(self, new_kvm_file, apply_free_memory=True, free_memory_info=None):
+    def get_raw_block(self, offset, length):
+        # retrieve data from raw memory, which can be shorter than length
+        # at the end of raw memory
+        if not self.raw_mmap:
+            self.raw_mmap = mmap.mmap(self.raw_file.fileno(), 0, prot=mmap.PROT_READ)
+        return self.raw_mmap[offset:offset+length]
+
+    def get_modified(self, new_kvm_file, apply_free_memory=True,
+            free_memory_info=None, num_proc=1):
         # get modified pages 
         hash_list = self._load_file(new_kvm_file, diff=True, \
-                apply_free_memory=apply_free_memory)
+                apply_free_memory=apply_free_memory, num_proc=num_proc)
         if free_memory_info != None:
             free_memory_info['free_pfn_dict'] = self.free_pfn_dict
             free_memory_info['freed_counter'] = self.freed_counter
+            free_memory_info['unchanged_counter'] = self.unchanged_counter
 
         return hash_list
     
 
+class MemoryStreamDiff(object):
+    # Compare modified memory with base memory while the memory snapshot is
+    # being saved. Data should be given in the order of the snapshot file
+    # (with aligned libvirt header), and it does not need to be stored in a file.
+    # Free memory pages cannot be applied since it requires whole snapshot.
+    # With num_proc > 1, blocks are compared at a pool of worker processes
+    # so that reading the snapshot stream is not throttled by hashing.
+
+    def __init__(self, base, num_proc=1):
+        if len(base.hash_list) == 0:
+            raise MemoryError("Cannot compare give stream this self.hashlist")
+        self.base = base
+        self.num_proc = num_proc
+        self.pool = None
+        self.pending_results = collections.deque()
+        self.delta_list = list()
+        self.offset = 0
+        self.unchanged_counter = 0
+        self.pending_data = list()
+        self.pending_size = 0
+        self.block_size = Memory.RAM_PAGE_SIZE*Memory.DIFF_BLOCK_PAGES
+
+    def write(self, data):
+        self.pending_data.append(data)
+        self.pending_size += len(data)
+        if self.pending_size < self.block_size:
+            return
+        data = ''.join(self.pending_data)
+        diff_size = len(data) - (len(data) % self.block_size)
+        for start in xrange(0, diff_size, self.block_size):
+            self._diff(data[start:start+self.block_size])
+        self.pending_data = [data[diff_size:]]
+        self.pending_size = len(self.pending_data[0])
+
+    def _start_pool(self):
+        # pool is created at the process reading the stream, and workers
+        # inherit base memory by fork
+        global _diff_context
+        _diff_context = (self.base, None, None, False)
+        self.pool = multiprocessing.Pool(processes=self.num_proc)
+        LOG.info("Compare memory stream using %d processes" % self.num_proc)
+
+    def _diff(self, data_block):
+        if self.num_proc <= 1:
+            delta_items = list()
+            freed_count, unchanged_count = self.base._diff_block(self.offset,
+                    data_block, delta_items, None, False)
+            self._merge((delta_items, unchanged_count))
+        else:
+            if self.pool == None:
+                self._start_pool()
+            self.pending_results.append(self.pool.apply_async(
+                _diff_stream_block, ((self.offset, data_block),)))
+            # bound the blocks in flight, merging results in offset order
+            while len(self.pending_results) > self.num_proc*2:
+                self._merge(self.pending_results.popleft().get())
+        self.offset += len(data_block)
+
+    def _merge(self, result):
+        delta_items, unchanged_count = result
+        self.delta_list.extend(delta_items)
+        self.unchanged_counter += unchanged_count
+
+        # memory over-usage protection
+        if len(self.delta_list) > Memory.RAM_PAGE_SIZE*1000000: # 400MB for hashlist
+            raise MemoryError("possibly comparing with wrong base VM")
+
+    def close(self):
+        # return: (delta list, total size of the memory snapshot)
+        data = ''.join(self.pending_data)
+        if len(data) > 0:
+            self._diff(data)
+        self.pending_data = list()
+        self.pending_size = 0
+        while len(self.pending_results) > 0:
+            self._merge(self.pending_results.popleft().get())
+        if self.pool != None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.base._report_unchanged(self.unchanged_counter)
+        return self.delta_list, self.offset
+
+    def terminate(self):
+        self.pending_results.clear()
+        if self.pool != None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
+def _diff_stream_block(block_task):
+    # compare a block of memory stream at worker process
+    block_offset, data_block = block_task
+    base = _diff_context[0]
+    delta_items = list()
+    freed_count, unchanged_count = base._diff_block(block_offset,
+            data_block, delta_items, None, False)
+    return delta_items, unchanged_count
+
+
+def _init_diff_worker():
+    # mmap base and modified memory at each page diff worker
+    global _diff_worker_file
+    base, modified_path, free_pfn_dict, apply_free_memory = _diff_context
+    base.raw_mmap = mmap.mmap(base.raw_file.fileno(), 0, prot=mmap.PROT_READ)
+    modified_file = open(modified_path, "rb")
+    _diff_worker_file = mmap.mmap(modified_file.fileno(), 0, prot=mmap.PROT_READ)
+    modified_file.close()
+
+
+def _diff_page_range(page_range):
+    # compare pages in [start_offset, end_offset) at worker process
+    start_offset, end_offset = page_range
+    base, modified_path, free_pfn_dict, apply_free_memory = _diff_context
+    delta_items = list()
+    freed_page_counter = 0
+    unchanged_page_counter = 0
+    block_size = Memory.RAM_PAGE_SIZE*Memory.DIFF_BLOCK_PAGES
+    for block_offset in xrange(start_offset, end_offset, block_size):
+        data_block = _diff_worker_file[block_offset:min(block_offset+block_size, end_offset)]
+        freed_count, unchanged_count = base._diff_block(block_offset,
+                data_block, delta_items, free_pfn_dict, apply_free_memory)
+        freed_page_counter += freed_count
+        unchanged_page_counter += unchanged_count
+    return delta_items, freed_page_counter, unchanged_page_counter
+
+
 def hashing(filepath):
     # Contstuct KVM Base Memory DS from KVM migrated memory
     # filepath  : input KVM Memory Snapshot file path
@@ -373,12 +629,14 @@ def _process_cmd(argv):
 def create_memory_deltalist(modified_mempath,
             basemem_meta=None, basemem_path=None,
             apply_free_memory=True,
-            free_memory_info=None):
+            free_memory_info=None,
+            num_proc=1):
     # get memory delta
     # modified_mempath : file path for modified memory
     # basemem_meta : hashlist file for base mem
     # basemem_path : raw base memory path
     # freed_counter_ret : return pointer for freed counter
+    # num_proc : number of processes for comparing memory pages
 
     # Create Base Memory from meta file
     base = Memory.import_from_metafile(basemem_meta, basemem_path)
@@ -387,7 +645,8 @@ def create_memory_deltalist(modified_mempath,
     LOG.debug("1.get modified page list")
     delta_list = base.get_modified(modified_mempath, 
             apply_free_memory=apply_free_memory,
-            free_memory_info=free_memory_info)
+            free_memory_info=free_memory_info,
+            num_proc=num_proc)
 
 
     return delta_list
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#
+# Cloudlet Infrastructure for Mobile Computing
+#
+#   Author: Kiryong Ha <krha@cmu.edu>
+#
+#   Copyright (C) 2011-2013 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import zlib
+from lzma import LZMACompressor
+from lzma import LZMADecompressor
+
+from Configuration import Const
+
+
+class CodecError(Exception):
+    pass
+
+
+class Codec(object):
+    ''' Compression method of overlay blobs
+    Codec and its level are recorded at each blob of overlay meta, and
+    a blob without codec information is xz compressed.
+    '''
+    XZ                  = "xz"
+    ZLIB                = "zlib"
+    NONE                = "none"
+
+    CODECS              = (XZ, ZLIB, NONE)
+    LEVELS              = {XZ: range(0, 10), ZLIB: range(0, 10), NONE: [0]}
+    DEFAULT_LEVEL       = {XZ: 9, ZLIB: 6, NONE: 0}
+    EXTENSION           = {XZ: "xz", ZLIB: "zlib", NONE: "raw"}
+
+
+class _ZlibDecompressor(object):
+    # decompress concatenated zlib streams like LZMADecompressor does
+    def __init__(self):
+        self.decompressor = zlib.decompressobj()
+        self.unconsumed_tail = ''
+
+    def decompress(self, data, max_length=0):
+        decomp_data = ''
+        while True:
+            left_length = 0
+            if max_length > 0:
+                left_length = max_length - len(decomp_data)
+            decomp_data += self.decompressor.decompress(data, left_length)
+            self.unconsumed_tail = self.decompressor.unconsumed_tail
+            if not self.decompressor.unused_data:
+                break
+            # the stream ends and the next stream follows
+            data = self.decompressor.unused_data
+            self.decompressor = zlib.decompressobj()
+            if max_length > 0 and len(decomp_data) >= max_length:
+                self.unconsumed_tail = data
+                break
+        return decomp_data
+
+    def flush(self):
+        return self.decompressor.flush()
+
+
+class _NoneCodec(object):
+    def __init__(self):
+        self.unconsumed_tail = ''
+
+    def compress(self, data):
+        return data
+
+    def decompress(self, data, max_length=0):
+        if max_length > 0:
+            self.unconsumed_tail = data[max_length:]
+            return data[:max_length]
+        return data
+
+    def flush(self):
+        return ''
+
+
+def validate(codec, level):
+    if codec not in Codec.CODECS:
+        raise CodecError("Unknown codec %s (use %s)" % \
+                (codec, ", ".join(Codec.CODECS)))
+    if level not in Codec.LEVELS[codec]:
+        raise CodecError("Invalid level %s for %s codec" % (level, codec))
+
+
+def get_compressor(codec, level):
+    validate(codec, level)
+    if codec == Codec.XZ:
+        return LZMACompressor(options={'format':'xz', 'level':level})
+    elif codec == Codec.ZLIB:
+        return zlib.compressobj(level)
+    return _NoneCodec()
+
+
+def get_decompressor(codec):
+    if codec == Codec.XZ:
+        return LZMADecompressor()
+    elif codec == Codec.ZLIB:
+        return _ZlibDecompressor()
+    elif codec == Codec.NONE:
+        return _NoneCodec()
+    raise CodecError("Unknown codec %s" % codec)
+
+
+def compress(codec, level, data):
+    compressor = get_compressor(codec, level)
+    comp_data = compressor.compress(data)
+    comp_data += compressor.flush()
+    return comp_data
+
+
+def decompress(codec, comp_data):
+    decompressor = get_decompressor(codec)
+    decomp_data = decompressor.decompress(comp_data)
+    decomp_data += decompressor.flush()
+    return decomp_data
+
+
+def iter_decompress(codec, comp_chunks, max_length):
+    '''decompress iterable of compressed data into pieces of max_length
+    Memory use is bounded by the size of input piece and max_length
+    regardless of compression ratio
+    '''
+    decompressor = get_decompressor(codec)
+    for comp_data in comp_chunks:
+        while comp_data:
+            decomp_data = decompressor.decompress(comp_data, max_length)
+            comp_data = decompressor.unconsumed_tail
+            if decomp_data:
+                yield decomp_data
+    decomp_data = decompressor.flush()
+    if decomp_data:
+        yield decomp_data
+
+
+def get_blob_codec(blob_info):
+    # return (codec, level) of a blob at overlay meta
+    codec = blob_info.get(Const.META_OVERLAY_FILE_CODEC, Codec.XZ)
+    level = blob_info.get(Const.META_OVERLAY_FILE_CODEC_LEVEL,
+            Codec.DEFAULT_LEVEL.get(codec, 0))
+    return codec, level
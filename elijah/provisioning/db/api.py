@@ -25,6 +25,7 @@ DB wrapper for cloudlet
 import os
 import sqlalchemy
 import sys
+import threading
 from ..Configuration import Const
 from sqlalchemy.orm import sessionmaker
 
@@ -44,17 +45,23 @@ class DBConnector(object):
             create_db(Const.CLOUDLET_DB)
 
         # mapping existing DB to class
-        self.engine = sqlalchemy.create_engine('sqlite:///%s' % Const.CLOUDLET_DB, echo=False)
+        # session is shared by threads of synthesis server, which
+        # serialize its use with the lock
+        self.engine = sqlalchemy.create_engine('sqlite:///%s' % Const.CLOUDLET_DB,
+                echo=False, connect_args={'check_same_thread': False})
         session_maker = sessionmaker(bind=self.engine)
         self.session = session_maker()
+        self.lock = threading.RLock()
 
     def add_item(self, entry):
-        self.session.add(entry)
-        self.session.commit()
+        with self.lock:
+            self.session.add(entry)
+            self.session.commit()
 
     def del_item(self, entry):
-        self.session.delete(entry)
-        self.session.commit()
+        with self.lock:
+            self.session.delete(entry)
+            self.session.commit()
 
     def list_item(self, entry):
         ret = self.session.query(entry)
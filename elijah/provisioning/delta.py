@@ -18,19 +18,24 @@
 #   limitations under the License.
 #
 
-import sys
 import time
 import struct
 import mmap
 import tool
 import os
 import random
+import signal
+import itertools
 import multiprocessing 
-from operator import itemgetter
+from collections import defaultdict
+from operator import itemgetter, attrgetter
 from hashlib import sha256
-from lzma import LZMACompressor
+from Queue import Empty
 
 from Configuration import Const
+from hashindex import HashIndex
+import codec
+from codec import Codec
 import log as logging
 
 
@@ -54,6 +59,10 @@ class DeltaItem(object):
     REF_BASE_MEM        = 0x50
     REF_ZEROS           = 0x60
 
+    # no per-instance __dict__ since overlay has millions of delta items
+    __slots__ = ('delta_type', 'offset', 'offset_len', 'hash_value',
+            'ref_id', 'data_len', 'data', 'index')
+
     # data exist only when ref_id is not xdelta
     def __init__(self, delta_type, offset, offset_len, hash_value, ref_id, data_len=0, data=None):
         self.delta_type = delta_type
@@ -66,39 +75,62 @@ class DeltaItem(object):
 
         # new field for identify delta_item
         # offset is not unique identifier since we use both memory and disk
-        self.index = DeltaItem.get_index(self.delta_type, self.offset)
+        # same as get_index(), but inlined since it is called for every item
+        self.index = (self.offset << 1) | (delta_type & 0x0F)
 
     @staticmethod
     def get_index(delta_type, offset):
         return long((offset << 1) | (delta_type & 0x0F))
 
+    @staticmethod
+    def get_type_offset(index):
+        # inverse of get_index. Offset is chunk aligned, so the shifted
+        # offset does not overlap with delta type at the lower 4 bits
+        return (index & 0x0F, (index & ~0x0F) >> 1)
+
     def __getitem__(self, item):
-        return self.__dict__[item]
+        return getattr(self, item)
+
+    def __getstate__(self):
+        # delta items are pickled between worker processes
+        return tuple([getattr(self, name) for name in DeltaItem.__slots__])
+
+    def __setstate__(self, state):
+        for name, value in zip(DeltaItem.__slots__, state):
+            setattr(self, name, value)
+
+    def get_serialized_size(self):
+        # length of get_serialized() without hash value
+        if self.ref_id == DeltaItem.REF_RAW or \
+               self.ref_id == DeltaItem.REF_XDELTA:
+            return 8 + 2 + 1 + 8 + self.data_len
+        elif self.ref_id == DeltaItem.REF_SELF or \
+                self.ref_id == DeltaItem.REF_BASE_DISK or \
+                self.ref_id == DeltaItem.REF_BASE_MEM:
+            return 8 + 2 + 1 + 8
+        return 8 + 2 + 1
 
     def get_serialized(self, with_hashvalue=False):
         # offset        : unsigned long long
         # offset_length : unsigned short
         # ref_id        : unsigned char
-        data = struct.pack("!QHc", \
-                self.offset,
-                self.offset_len,
-                chr(self.delta_type | self.ref_id))
-
+        ref_info = chr(self.delta_type | self.ref_id)
         if self.ref_id == DeltaItem.REF_RAW or \
                self.ref_id == DeltaItem.REF_XDELTA:
-            data += struct.pack("!Q", self.data_len)
-            if self.data_len != 0:
-                data += struct.pack("!%ds" % self.data_len, self.data)
-        elif self.ref_id == DeltaItem.REF_SELF:
-            data += struct.pack("!Q", self.data)
-        elif self.ref_id == DeltaItem.REF_BASE_DISK or \
+            data = struct.pack("!QHcQ%ds" % self.data_len, \
+                    self.offset, self.offset_len, ref_info,
+                    self.data_len, self.data or '')
+        elif self.ref_id == DeltaItem.REF_SELF or \
+                self.ref_id == DeltaItem.REF_BASE_DISK or \
                 self.ref_id == DeltaItem.REF_BASE_MEM:
-            data += struct.pack("!Q", self.data)
+            data = struct.pack("!QHcQ", \
+                    self.offset, self.offset_len, ref_info, self.data)
+        else:
+            data = struct.pack("!QHc", self.offset, self.offset_len, ref_info)
 
         if with_hashvalue:
-            LOG.debug("hash size is %d" % len(self.hash_value))
             if self.hash_value and (len(self.hash_value) > 0):
-                data += struct.pack("!%ds" % len(self.hash_value), self.hashvalue)
+                data += self.hash_value
 
         return data
 
@@ -134,7 +166,130 @@ class DeltaItem(object):
         return item
 
 
+class DeltaStreamDecoder(object):
+    ''' Decode delta items from a stream using large reads
+    Stream is read in READ_SIZE blocks and item headers are parsed in place
+    with struct.unpack_from, so there is no small read per field as in
+    DeltaItem.unpack_stream. Payload is copied only once when the item is
+    created. The stream should not have been read through file buffer before
+    since the file descriptor is read directly.
+    '''
+    READ_SIZE           = 1024*1024
+    HEADER_STRUCT       = struct.Struct("!QHB")
+    HEADER_SIZE         = HEADER_STRUCT.size
+    LENGTH_STRUCT       = struct.Struct("!Q")
+    LENGTH_SIZE         = LENGTH_STRUCT.size
+    HASH_SIZE           = 32
+    PAYLOAD_REFS        = (DeltaItem.REF_RAW, DeltaItem.REF_XDELTA)
+    OFFSET_REFS         = (DeltaItem.REF_SELF, DeltaItem.REF_BASE_DISK,
+            DeltaItem.REF_BASE_MEM)
+
+    def __init__(self, stream, with_hashvalue=False, read_size=READ_SIZE):
+        self.stream = stream
+        self.with_hashvalue = with_hashvalue
+        self.read_size = read_size
+        self.fileno = None
+        if hasattr(stream, "fileno"):
+            try:
+                self.fileno = stream.fileno()
+            except (IOError, ValueError):
+                self.fileno = None
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        # append new data to unparsed data. return False at the end of stream
+        if self.fileno != None:
+            data = os.read(self.fileno, self.read_size)
+        else:
+            data = self.stream.read(self.read_size)
+        if not data:
+            self.eof = True
+            return False
+        if self.pos < len(self.buf):
+            self.buf = self.buf[self.pos:] + data
+        else:
+            self.buf = data
+        self.pos = 0
+        return True
+
+    def _parse(self):
+        # parse every complete item in the buffer
+        items = list()
+        append = items.append
+        buf = self.buf
+        buf_len = len(buf)
+        pos = self.pos
+        header_size = self.HEADER_SIZE
+        length_size = self.LENGTH_SIZE
+        hash_size = self.HASH_SIZE if self.with_hashvalue else 0
+        unpack_header = self.HEADER_STRUCT.unpack_from
+        unpack_length = self.LENGTH_STRUCT.unpack_from
+        while pos + header_size <= buf_len:
+            (offset, offset_len, ref_info) = unpack_header(buf, pos)
+            ref_id = ref_info & 0xF0
+            cur = pos + header_size
+            data_len = 0
+            data = None
+            if ref_id in self.PAYLOAD_REFS:
+                if cur + length_size > buf_len:
+                    break
+                data_len = unpack_length(buf, cur)[0]
+                cur += length_size
+                if cur + data_len + hash_size > buf_len:
+                    break
+                data = buf[cur:cur+data_len]
+                cur += data_len
+            elif ref_id in self.OFFSET_REFS:
+                if cur + length_size + hash_size > buf_len:
+                    break
+                data = unpack_length(buf, cur)[0]
+                cur += length_size
+            elif cur + hash_size > buf_len:
+                break
+
+            hash_value = None
+            if hash_size:
+                hash_value = buf[cur:cur+hash_size]
+                cur += hash_size
+            append(DeltaItem(ref_info & 0x0F, offset, offset_len,
+                hash_value, ref_id, data_len, data))
+            pos = cur
+        self.pos = pos
+        return items
+
+    def iter_batches(self):
+        # yield list of delta items decoded from each read
+        while self._fill():
+            items = self._parse()
+            if len(items) > 0:
+                yield items
+        if self.pos < len(self.buf):
+            msg = "Truncated delta stream: %d bytes left" % \
+                    (len(self.buf) - self.pos)
+            raise DeltaError(msg)
+
+
 class DeltaList(object):
+    WRITE_BATCH_SIZE    = 1024*1024
+
+    @staticmethod
+    def write_items(fd, delta_list, with_hashvalue=False):
+        # write serialized items in a batch rather than one write per item
+        batch = list()
+        batch_size = 0
+        for item in delta_list:
+            data = item.get_serialized(with_hashvalue=with_hashvalue)
+            batch.append(data)
+            batch_size += len(data)
+            if batch_size >= DeltaList.WRITE_BATCH_SIZE:
+                fd.write(''.join(batch))
+                batch = list()
+                batch_size = 0
+        if len(batch) > 0:
+            fd.write(''.join(batch))
+
     @staticmethod
     def tofile(delta_list, f_path, with_hashvalue=False):
         if len(delta_list) == 0 or type(delta_list[0]) != DeltaItem:
@@ -142,30 +297,25 @@ class DeltaList(object):
 
         fd = open(f_path, "wb")
         # Write list if delta item
-        for item in delta_list:
-            # save it as little endian format
-            fd.write(item.get_serialized(with_hashvalue=with_hashvalue))
+        DeltaList.write_items(fd, delta_list, with_hashvalue=with_hashvalue)
         fd.close()
 
     @staticmethod
-    def fromfile(f_path):
+    def fromfile(f_path, with_hashvalue=False):
         delta_list = []
         fd = open(f_path, "rb")
-        while True:
-            new_item = DeltaItem.unpack_stream(fd)
-            if not new_item:
-                break
-            delta_list.append(new_item)
+        decoder = DeltaStreamDecoder(fd, with_hashvalue=with_hashvalue)
+        for items in decoder.iter_batches():
+            delta_list.extend(items)
         fd.close()
         return delta_list 
 
     @staticmethod
-    def from_stream(stream):
-        while True:
-            new_item = DeltaItem.unpack_stream(stream)
-            if new_item == None:
-                raise StopIteration()
-            yield new_item
+    def from_stream(stream, with_hashvalue=False):
+        decoder = DeltaStreamDecoder(stream, with_hashvalue=with_hashvalue)
+        for items in decoder.iter_batches():
+            for new_item in items:
+                yield new_item
 
     @staticmethod
     def from_chunk(in_queue):
@@ -189,23 +339,21 @@ class DeltaList(object):
         fd.write(footer_delta)
 
         # Write list if delta item
-        for item in delta_list:
-            # save it as little endian format
-            fd.write(item.get_serialized())
+        DeltaList.write_items(fd, delta_list)
         fd.close()
 
     @staticmethod
     def get_self_delta(delta_list):
         if len(delta_list) == 0:
             LOG.debug("Nothing to compare. Length is 0")
-            delta_list.sort(key=itemgetter('offset'))
+            delta_list.sort(key=attrgetter('offset'))
             return
         if type(delta_list[0]) != DeltaItem:
             raise DeltaError("Need list of DeltaItem")
 
         # delta_list : list of (type, start, end, ref_id, hash/data)
         # sort by (hash/start offset)
-        delta_list.sort(key=itemgetter('hash_value', 'delta_type', 'offset'))
+        delta_list.sort(key=attrgetter('hash_value', 'delta_type', 'offset'))
 
         pivot = delta_list[0]
         matching = 0
@@ -233,7 +381,7 @@ class DeltaList(object):
     def statistics(delta_list, mem_discarded=0, disk_discarded=0):
         if len(delta_list) == 0:
             LOG.debug("Nothing to compare. Length is 0")
-            delta_list.sort(key=itemgetter('offset'))
+            delta_list.sort(key=attrgetter('offset'))
             return
         if type(delta_list[0]) != DeltaItem:
             raise DeltaError("Need list of DeltaItem")
@@ -382,8 +530,8 @@ def diff_with_deltalist(delta_list, const_deltalist, ref_id):
     if len(const_deltalist) == 0 or type(const_deltalist[0]) != DeltaItem:
         raise DeltaError("Need list of DeltaItem for const")
 
-    delta_list.sort(key=itemgetter('hash_value')) # sort by hash value
-    const_deltalist.sort(key=itemgetter('hash_value')) # sort by hash value
+    delta_list.sort(key=attrgetter('hash_value')) # sort by hash value
+    const_deltalist.sort(key=attrgetter('hash_value')) # sort by hash value
 
     matching_count = 0
     s_index = 0
@@ -418,8 +566,23 @@ def diff_with_hashlist(base_hashlist, delta_list, ref_id):
     if type(delta_list[0]) != DeltaItem:
         raise DeltaError("Need list of DeltaItem")
 
+    if isinstance(base_hashlist, HashIndex):
+        # hash index is already sorted, so look up each item
+        matching_count = 0
+        for delta in delta_list:
+            if (delta.ref_id != DeltaItem.REF_XDELTA) and (delta.ref_id != DeltaItem.REF_RAW):
+                continue
+            found = base_hashlist.find(delta.hash_value)
+            if found != None:
+                matching_count += 1
+                delta.ref_id = ref_id
+                delta.data_len = 8
+                delta.data = long(found[0])
+        LOG.debug("matching (%d/%d) with base" % (matching_count, len(delta_list)))
+        return delta_list
+
     base_hashlist.sort(key=itemgetter(2)) # sort by hash value
-    delta_list.sort(key=itemgetter('hash_value')) # sort by hash value
+    delta_list.sort(key=attrgetter('hash_value')) # sort by hash value
 
     matching_count = 0
     s_index = 0
@@ -445,17 +608,86 @@ def diff_with_hashlist(base_hashlist, delta_list, ref_id):
     return delta_list
 
 
+class _ContiguousWriter(object):
+    # coalesce writes at contiguous offsets into a single seek and write
+    def __init__(self, fd):
+        self.fd = fd
+        self.start_offset = None
+        self.end_offset = None
+        self.buffers = list()
+
+    def add(self, offset, data):
+        if offset != self.end_offset:
+            self.write_pending()
+            self.start_offset = offset
+            self.end_offset = offset
+        self.buffers.append(data)
+        self.end_offset += len(data)
+
+    def write_pending(self):
+        if len(self.buffers) > 0:
+            self.fd.seek(self.start_offset)
+            self.fd.write(''.join(self.buffers))
+            self.buffers = list()
+        self.start_offset = None
+        self.end_offset = None
+
+    def flush(self):
+        self.write_pending()
+        self.fd.flush()
+
+
+# base VM mapped at each xdelta worker process
+_xdelta_base = dict()
+
+
+def _init_xdelta_worker(base_disk, base_mem):
+    for (delta_type, base_path) in ((DeltaItem.DELTA_DISK, base_disk),
+            (DeltaItem.DELTA_MEMORY, base_mem)):
+        base_fd = open(base_path, "rb")
+        _xdelta_base[delta_type] = mmap.mmap(base_fd.fileno(), 0, prot=mmap.PROT_READ)
+        base_fd.close()
+
+
+def _exit_on_sigterm(signum, frame):
+    # unwind so that the xdelta pool is terminated with the process
+    raise SystemExit(1)
+
+
+def _recover_xdelta(xdelta_task):
+    (delta_type, offset, offset_len, patch_data) = xdelta_task
+    raw_base = _xdelta_base.get(delta_type, None)
+    if raw_base == None:
+        raise DeltaError("Delta type should be either disk or memory")
+    base_data = raw_base[offset:offset+offset_len]
+    return tool.merge_data(base_data, patch_data, len(base_data)*5)
+
+
 class Recovered_delta(multiprocessing.Process):
     FUSE_INDEX_DISK = 1
     FUSE_INDEX_MEMORY = 2
     END_OF_PIPE = "end_of_pipe"
 
+    # recovered chunks are written and notified to FUSE in a batch
+    # when one of these is met, or before waiting for more overlay data
+    NOTIFY_BATCH_SIZE   = 1024  # number of chunks
+    NOTIFY_INTERVAL     = 0.01  # seconds
+    DEMAND_INTERVAL     = 0.001 # seconds between checking demanded chunks
+    RESULT_WAIT_INTERVAL = 1.0  # seconds of waiting xdelta result at once
+
     def __init__(self, base_disk, base_mem, overlay_path, 
             output_mem_path, output_mem_size, 
             output_disk_path, output_disk_size, chunk_size,
-            out_pipename=None, time_queue=None, deltalist_savepath=None):
+            out_pipename=None, time_queue=None, deltalist_savepath=None,
+            demand_queue=None, self_ref_counts=None, num_proc=1):
         ''' recover delta list using base disk/memory
         Args:
+            demand_queue: (delta type, chunk) requested by FUSE. Batch is
+                notified right away when it has a demanded chunk
+            self_ref_counts: {index: number of self references}. Only data
+                of these chunks are cached until their last reference.
+                Otherwise, self referenced data is read from the output file
+            num_proc: number of processes recovering xdelta items
         '''
 
         if base_disk == None and base_mem == None:
@@ -468,6 +700,8 @@ class Recovered_delta(multiprocessing.Process):
         self.output_disk_size = output_disk_size
         self.out_pipename = out_pipename
         self.time_queue = time_queue
+        self.demand_queue = demand_queue
+        self.num_proc = num_proc
         self.base_disk = base_disk
         self.base_mem = base_mem
         self.deltalist_savepath = deltalist_savepath
@@ -480,8 +714,12 @@ class Recovered_delta(multiprocessing.Process):
         self.raw_mem_overlay = None
         self.chunk_size = chunk_size
         self.zero_data = struct.pack("!s", chr(0x00)) * chunk_size
-        self.recovered_delta_dict = dict()
-        self.delta_list = list()
+        self.self_ref_counts = None
+        if self_ref_counts != None:
+            self.self_ref_counts = dict(self_ref_counts)
+        self.self_ref_cache = dict()
+        self.mem_writer = None
+        self.disk_writer = None
         
         # initialize reference data to use mmap
         self.base_disk_fd = open(base_disk, "rb")
@@ -491,55 +729,187 @@ class Recovered_delta(multiprocessing.Process):
 
         multiprocessing.Process.__init__(self)
 
+    def _recover_xdelta_items(self, pool, delta_items):
+        # other items are cheap to recover, so only xdelta goes to workers.
+        # Recovered item becomes REF_RAW before the ordered pass
+        xdelta_items = [item for item in delta_items \
+                if item.ref_id == DeltaItem.REF_XDELTA]
+        if len(xdelta_items) < 2:
+            return
+        xdelta_tasks = [(item.delta_type, item.offset, item.offset_len, item.data) \
+                for item in xdelta_items]
+        task_chunksize = max(1, len(xdelta_tasks)/(self.num_proc*4))
+        result = pool.map_async(_recover_xdelta, xdelta_tasks, task_chunksize)
+        # wait with timeout, otherwise SIGTERM is not handled while waiting
+        while True:
+            try:
+                recover_list = result.get(Recovered_delta.RESULT_WAIT_INTERVAL)
+                break
+            except multiprocessing.TimeoutError:
+                continue
+        for delta_item, recover_data in itertools.izip(xdelta_items, recover_list):
+            delta_item.ref_id = DeltaItem.REF_RAW
+            delta_item.data_len = len(recover_data)
+            delta_item.data = recover_data
+
+    def get_self_reference(self, ref_index, length):
+        # cached data is evicted at its last reference
+        recover_data = self.self_ref_cache.get(ref_index, None)
+        if self.self_ref_counts != None:
+            remaining = self.self_ref_counts.get(ref_index, 0) - 1
+            if remaining > 0:
+                self.self_ref_counts[ref_index] = remaining
+            else:
+                self.self_ref_counts.pop(ref_index, None)
+                self.self_ref_cache.pop(ref_index, None)
+        if recover_data == None:
+            recover_data = self._read_recovered(ref_index, length)
+        return recover_data
+
+    def _read_recovered(self, ref_index, length):
+        # read already recovered chunk from the output file
+        delta_type, offset = DeltaItem.get_type_offset(ref_index)
+        if delta_type == DeltaItem.DELTA_MEMORY:
+            writer = self.mem_writer
+        elif delta_type == DeltaItem.DELTA_DISK:
+            writer = self.disk_writer
+        else:
+            return None
+        if writer == None:
+            return None
+        writer.write_pending()
+        writer.fd.seek(offset)
+        data = writer.fd.read(length)
+        if len(data) != length:
+            return None
+        return data
+
+    def _get_demand(self):
+        # return newly demanded chunks without blocking
+        demanded = list()
+        if self.demand_queue == None:
+            return demanded
+        while True:
+            try:
+                demanded.append(self.demand_queue.get_nowait())
+            except Empty:
+                break
+        return demanded
+
+    def _notify(self, writers, overlay_chunk_ids):
+        # chunks should be on the file before FUSE is notified
+        for writer in writers:
+            writer.flush()
+        if len(overlay_chunk_ids) > 0:
+            self.out_pipe.write(",".join(overlay_chunk_ids) + '\n')
+            self.out_pipe.flush()
+
     def run(self):
         start_time = time.time()
         self.out_pipe = open(self.out_pipename, "w")
         count = 0
-        self.recover_mem_fd = open(self.output_mem_path, "wrb")
-        self.recover_disk_fd = open(self.output_disk_path, "wrb")
+        # output is read back for self reference
+        self.recover_mem_fd = open(self.output_mem_path, "w+b")
+        self.recover_disk_fd = open(self.output_disk_path, "w+b")
         overlay_stream = open(self.overlay_path, "r")
+        mem_writer = self.mem_writer = _ContiguousWriter(self.recover_mem_fd)
+        disk_writer = self.disk_writer = _ContiguousWriter(self.recover_disk_fd)
+        writers = (mem_writer, disk_writer)
+        deltalist_fd = None
+        if self.deltalist_savepath:
+            deltalist_fd = open(self.deltalist_savepath, "wb")
+        self_ref_counts = self.self_ref_counts
+        self_ref_cache = self.self_ref_cache
 
         overlay_chunk_ids = []
-        for delta_item in DeltaList.from_stream(overlay_stream):
-            self.recover_item(delta_item)
-            if len(delta_item.data) != delta_item.offset_len:
-                msg = "recovered size is not same as page size, %ld != %ld" % \
-                        (len(delta_item.data), delta_item.offset_len)
-                raise DeltaError(msg)
-
-            # save it to dictionary to find self_reference easily
-            self.recovered_delta_dict[delta_item.index] = delta_item
-            self.delta_list.append(delta_item)
-
-            # write to output file 
-            overlay_chunk_id = long(delta_item.offset/self.chunk_size)
-            if delta_item.delta_type == DeltaItem.DELTA_MEMORY:
-                self.recover_mem_fd.seek(delta_item.offset)
-                self.recover_mem_fd.write(delta_item.data)
-                overlay_chunk_ids.append("%d:%ld" % 
-                        (Recovered_delta.FUSE_INDEX_MEMORY, overlay_chunk_id))
-            elif delta_item.delta_type == DeltaItem.DELTA_DISK:
-                self.recover_disk_fd.seek(delta_item.offset)
-                self.recover_disk_fd.write(delta_item.data)
-                overlay_chunk_ids.append("%d:%ld" % 
-                        (Recovered_delta.FUSE_INDEX_DISK, overlay_chunk_id))
-
-            if len(overlay_chunk_ids) % 1 == 0:
-                self.recover_mem_fd.flush()
-                self.recover_disk_fd.flush()
-
-                self.out_pipe.write(",".join(overlay_chunk_ids) + '\n')
+        demanded_chunks = set()
+        last_notify = time.time()
+        next_demand_check = last_notify
+        decoder = DeltaStreamDecoder(overlay_stream)
+
+        # xdelta items are recovered at worker processes, while output
+        # and FUSE notification are done here in the overlay order
+        pool = None
+        if self.num_proc > 1:
+            pool = multiprocessing.Pool(processes=self.num_proc,
+                    initializer=_init_xdelta_worker,
+                    initargs=(self.base_disk, self.base_mem))
+            signal.signal(signal.SIGTERM, _exit_on_sigterm)
+        try:
+            for delta_items in decoder.iter_batches():
+                if pool:
+                    self._recover_xdelta_items(pool, delta_items)
+                for delta_item in delta_items:
+                    self.recover_item(delta_item)
+                    if len(delta_item.data) != delta_item.offset_len:
+                        msg = "recovered size is not same as page size, %ld != %ld" % \
+                                (len(delta_item.data), delta_item.offset_len)
+                        raise DeltaError(msg)
+
+                    # keep data only until the last self reference
+                    if self_ref_counts != None and \
+                            delta_item.index in self_ref_counts:
+                        self_ref_cache[delta_item.index] = delta_item.data
+
+                    # write to output file 
+                    overlay_chunk_id = long(delta_item.offset/self.chunk_size)
+                    if delta_item.delta_type == DeltaItem.DELTA_MEMORY:
+                        mem_writer.add(delta_item.offset, delta_item.data)
+                        overlay_chunk_ids.append("%d:%ld" % 
+                                (Recovered_delta.FUSE_INDEX_MEMORY, overlay_chunk_id))
+                    elif delta_item.delta_type == DeltaItem.DELTA_DISK:
+                        disk_writer.add(delta_item.offset, delta_item.data)
+                        overlay_chunk_ids.append("%d:%ld" % 
+                                (Recovered_delta.FUSE_INDEX_DISK, overlay_chunk_id))
+
+                    is_demanded = False
+                    now = time.time()
+                    if self.demand_queue != None and now >= next_demand_check:
+                        next_demand_check = now + Recovered_delta.DEMAND_INTERVAL
+                        new_demands = self._get_demand()
+                        if len(new_demands) > 0:
+                            # demanded chunk can be in the current batch
+                            demanded_chunks.update(new_demands)
+                            is_demanded = True
+                    chunk_key = (delta_item.delta_type, overlay_chunk_id)
+                    if chunk_key in demanded_chunks:
+                        demanded_chunks.discard(chunk_key)
+                        is_demanded = True
+
+                    if is_demanded or \
+                            len(overlay_chunk_ids) >= Recovered_delta.NOTIFY_BATCH_SIZE or \
+                            now - last_notify >= Recovered_delta.NOTIFY_INTERVAL:
+                        self._notify(writers, overlay_chunk_ids)
+                        count += len(overlay_chunk_ids)
+                        overlay_chunk_ids[:] = []
+                        last_notify = now
+
+                if deltalist_fd:
+                    DeltaList.write_items(deltalist_fd, delta_items,
+                            with_hashvalue=True)
+
+                # do not hold recovered chunks while waiting for the next read
+                self._notify(writers, overlay_chunk_ids)
                 count += len(overlay_chunk_ids)
                 overlay_chunk_ids[:] = []
-
-        if len(overlay_chunk_ids) > 0:
-            self.out_pipe.send(overlay_chunk_ids)
-            count += len(overlay_chunk_ids)
+                last_notify = time.time()
+            if pool:
+                pool.close()
+        except:
+            if pool:
+                pool.terminate()
+            raise
+        finally:
+            if pool:
+                pool.join()
 
         self.out_pipe.write(str(Recovered_delta.END_OF_PIPE) + "\n")
         self.out_pipe.close()
         self.recover_mem_fd.close()
         self.recover_disk_fd.close()
+        overlay_stream.close()
+        if deltalist_fd:
+            deltalist_fd.close()
         end_time = time.time()
 
         if self.time_queue != None: 
@@ -547,9 +917,6 @@ class Recovered_delta(multiprocessing.Process):
         LOG.info("[Delta] : (%s)-(%s)=(%s), delta %ld chunks" % \
                 (start_time, end_time, (end_time-start_time), count))
 
-        if self.deltalist_savepath:
-            DeltaList.tofile(self.delta_list, self.deltalist_savepath, with_hashvalue=True)
-
     def recover_item(self, delta_item):
         if type(delta_item) != DeltaItem:
             raise MemoryError("Need list of DeltaItem")
@@ -567,12 +934,11 @@ class Recovered_delta(multiprocessing.Process):
             recover_data = self.raw_disk[offset:offset+self.chunk_size]
         elif delta_item.ref_id == DeltaItem.REF_SELF:
             ref_index = delta_item.data
-            self_ref_delta_item = self.recovered_delta_dict.get(ref_index, None)
-            if self_ref_delta_item == None:
+            recover_data = self.get_self_reference(ref_index, delta_item.offset_len)
+            if recover_data == None:
                 msg = "Cannot find self reference: type(%ld), offset(%ld), index(%ld), ref_index(%ld)" % \
                         (delta_item.delta_type, delta_item.offset, delta_item.index, ref_index)
                 raise MemoryError(msg)
-            recover_data = self_ref_delta_item.data
         elif delta_item.ref_id == DeltaItem.REF_XDELTA:
             patch_data = delta_item.data
             patch_original_size = delta_item.offset_len
@@ -594,6 +960,7 @@ class Recovered_delta(multiprocessing.Process):
 
         # recover
         delta_item.ref_id = DeltaItem.REF_RAW
+        delta_item.data_len = len(recover_data)
         delta_item.data = recover_data
 
         return delta_item
@@ -612,32 +979,112 @@ class Recovered_delta(multiprocessing.Process):
         LOG.debug("Recover finishes")
 
 
+def _get_base_finder(base_hashlist):
+    # return function finding offset of a hash at base VM
+    if base_hashlist == None:
+        return lambda hash_value: None
+    if isinstance(base_hashlist, HashIndex):
+        def find_in_index(hash_value):
+            found = base_hashlist.find(hash_value)
+            if found == None:
+                return None
+            return found[0]
+        return find_in_index
+
+    # list of (offset, length, hash), where the first one is used for the same hash
+    base_dict = dict()
+    for (start, length, hash_value) in base_hashlist:
+        if hash_value not in base_dict:
+            base_dict[hash_value] = start
+    return base_dict.get
+
+
 def create_overlay(memory_deltalist, memory_chunk_size,
         disk_deltalist, disk_chunk_size,
         basedisk_hashlist=None, basemem_hashlist=None):
+    """Find reference of each delta item in a single pass
+    Each modified chunk refers to zero page, base memory, base disk, or
+    a previous chunk of itself in this order. Return delta list is sorted
+    by (delta_type, offset) and the first chunk of the same hash is kept
+    as a reference of the other chunks.
+    """
 
     if memory_chunk_size != disk_chunk_size:
         raise DeltaError("Expect same chunk size for Disk and Memory")
     chunk_size = disk_chunk_size
     delta_list = memory_deltalist+disk_deltalist
 
-    #Memory
-    # Create Base Memory from meta file
-    LOG.debug("2-1.Find zero page")
-    zero_hash = sha256(struct.pack("!s", chr(0x00))*chunk_size).digest()
-    zero_hash_list = [(-1, chunk_size, zero_hash)]
-    diff_with_hashlist(zero_hash_list, delta_list, ref_id=DeltaItem.REF_ZEROS)
+    # memory and disk delta list are sorted by offset in most cases
+    sort_key = attrgetter('delta_type', 'offset')
+    for index in xrange(1, len(delta_list)):
+        if sort_key(delta_list[index-1]) > sort_key(delta_list[index]):
+            delta_list.sort(key=sort_key)
+            break
 
-    LOG.debug("2-2.get delta from base Memory")
-    diff_with_hashlist(basemem_hashlist, delta_list, ref_id=DeltaItem.REF_BASE_MEM)
-    LOG.debug("2-3.get delta from base Disk")
-    diff_with_hashlist(basedisk_hashlist, delta_list, ref_id=DeltaItem.REF_BASE_DISK)
+    LOG.debug("2.get reference of delta item")
+    zero_hash = sha256(struct.pack("!s", chr(0x00))*chunk_size).digest()
+    base_finders = [
+            ({zero_hash:-1}.get, DeltaItem.REF_ZEROS),
+            (_get_base_finder(basemem_hashlist), DeltaItem.REF_BASE_MEM),
+            (_get_base_finder(basedisk_hashlist), DeltaItem.REF_BASE_DISK),
+            ]
+
+    # hash_value -> (ref_id, reference)
+    reference_dict = dict()
+    matching_count = dict()
+    for delta_item in delta_list:
+        if (delta_item.ref_id != DeltaItem.REF_XDELTA) and \
+                (delta_item.ref_id != DeltaItem.REF_RAW):
+            continue
+        reference = reference_dict.get(delta_item.hash_value, None)
+        if reference == None:
+            for (find_base, ref_id) in base_finders:
+                start = find_base(delta_item.hash_value)
+                if start != None:
+                    reference = (ref_id, start)
+                    break
+            if reference == None:
+                # first chunk of this hash. Following chunks will refer it
+                reference_dict[delta_item.hash_value] = \
+                        (DeltaItem.REF_SELF, delta_item.index)
+                continue
+            reference_dict[delta_item.hash_value] = reference
+
+        ref_id, start = reference
+        delta_item.ref_id = ref_id
+        delta_item.data_len = 8
+        delta_item.data = long(start)
+        matching_count[ref_id] = matching_count.get(ref_id, 0) + 1
+
+    LOG.debug("matching with zeros (%d), base memory (%d), base disk (%d), self (%d) out of %d" % \
+            (matching_count.get(DeltaItem.REF_ZEROS, 0),
+            matching_count.get(DeltaItem.REF_BASE_MEM, 0),
+            matching_count.get(DeltaItem.REF_BASE_DISK, 0),
+            matching_count.get(DeltaItem.REF_SELF, 0), len(delta_list)))
+    return delta_list
 
-    # 3.find shared within self
-    LOG.debug("3.get delta from itself")
-    DeltaList.get_self_delta(delta_list)
 
-    return delta_list
+def _order_with_reference(ordered_items, delta_dict, list_size):
+    # return list of delta items in the given order, but the reference of
+    # REF_SELF item is placed right before its first referrer
+    new_list = list()
+    emitted = set()
+    for delta_item in ordered_items:
+        if delta_item.index in emitted:
+            continue
+        if delta_item.ref_id == DeltaItem.REF_SELF:
+            ref_item = delta_dict.get(long(delta_item.data), None)
+            if ref_item == None:
+                msg = "Cannot find self reference of index(%ld)" % delta_item.index
+                raise DeltaError(msg)
+            if ref_item.index not in emitted:
+                emitted.add(ref_item.index)
+                new_list.append(ref_item)
+        emitted.add(delta_item.index)
+        new_list.append(delta_item)
+    if len(new_list) != list_size:
+        raise DeltaError("DeltaList size shouldn't be changed after reordering")
+    return new_list
 
 
 def reorder_deltalist_linear(chunk_size, delta_list):
@@ -648,16 +1095,8 @@ def reorder_deltalist_linear(chunk_size, delta_list):
     for item in delta_list:
         delta_dict[item.index] = item
 
-    delta_list.sort(key=itemgetter('delta_type', 'offset'))
-    for index, delta_item in enumerate(delta_list):
-        if delta_item.ref_id == DeltaItem.REF_SELF:
-            ref_index = long(delta_item.data)
-            ref_item = delta_dict.get(ref_index, None)
-            ref_pos = delta_list.index(ref_item)
-            if ref_pos > index:
-                LOG.debug("REORDER] move reference from %d to %d" % (ref_pos, (index-1)))
-                delta_list.remove(ref_item)
-                delta_list.insert(index, ref_item)
+    delta_list.sort(key=attrgetter('delta_type', 'offset'))
+    delta_list[:] = _order_with_reference(delta_list, delta_dict, len(delta_list))
     LOG.debug("[Debug][REORDER] reordering takes : %f" % (time.time()-start_time))
 
 
@@ -679,134 +1118,151 @@ def reorder_deltalist_random(chunk_size, delta_list):
 
 
 def reorder_deltalist(access_list, chunk_size, delta_list):
+    # Chunks in the access list come first in the access order, and the
+    # others follow in offset order. The first access of a chunk decides
+    # its position. The reference of a REF_SELF chunk, accessed or not,
+    # moves right before its first referrer.
     start_time = time.time()
     delta_dict = dict()
     for item in delta_list:
         delta_dict[item.index] = item
 
     # first sort the chunks with offset
-    delta_list.sort(key=itemgetter('delta_type', 'offset'))
+    delta_list.sort(key=attrgetter('delta_type', 'offset'))
 
-    access_list.reverse()
-    before_length = len(delta_list)
-    count = 0 
+    accessed_items = list()
     for chunk_number in access_list:
         chunk_index = DeltaItem.get_index(DeltaItem.DELTA_MEMORY, long(chunk_number)*chunk_size)
         delta_item = delta_dict.get(chunk_index, None)
-        #LOG.debug("%ld in access list" % (long(chunk_number)))
         if delta_item:
-            #LOG.debug("chunk(%ld) moved from %d --> 0" % (delta_item.offset/chunk_size, delta_list.index(delta_item)))
-            delta_list.remove(delta_item)
-            delta_list.insert(0, delta_item)
-            count += 1
-
-            # moved item has reference
-            if delta_item.ref_id == DeltaItem.REF_SELF:
-                ref_index = delta_item.data
-                ref_delta = delta_dict[ref_index]
-                delta_list.remove(ref_delta)
-                delta_list.insert(0, ref_delta)
-                #LOG.debug("chunk(%ld) moving because its reference of chunk(%ld)" % \
-                #        (ref_delta.offset/chunk_size, delta_item.offset/chunk_size))
-    after_length = len(delta_list)
-    if before_length != after_length:
-        raise DeltaError("DeltaList size shouldn't be changed after reordering")
+            accessed_items.append(delta_item)
+    count = len(accessed_items)
 
-    delta_dict_new = dict()
-    for item in delta_list:
-        delta_dict_new[item.index] = item
+    # stable partition: accessed chunks first, then the others
+    accessed_items.extend(delta_list)
+    new_list = _order_with_reference(accessed_items, delta_dict, len(delta_list))
 
-    prev_indexes = delta_dict.keys().sort()
-    new_indexes = delta_dict_new.keys().sort()
+    prev_indexes = sorted([item.index for item in delta_list])
+    new_indexes = sorted([item.index for item in new_list])
     if prev_indexes != new_indexes:
-        LOG.info("Reordered delta list is not same as previous")
-        sys.exit(1)
+        raise DeltaError("Reordered delta list is not same as previous")
+    delta_list[:] = new_list
 
     end_time = time.time()
     LOG.info("[DEBUG][REORDER] time %f" % (end_time-start_time))
     LOG.info("[DEBUG][REORDER] changed %d deltaitem (total access pattern: %d)" % (count, len(access_list)))
 
 
-def _save_blob(start_index, delta_list, self_ref_dict, blob_name, blob_size, statistics=None):
-    # mode = 2 indicates LZMA_SYNC_FLUSH, which show all output right after input
-    comp_option = {'format':'xz', 'level':9}
-    comp = LZMACompressor(options=comp_option)
-    disk_offset_list = list()
-    memory_offset_list= list()
-    comp_data = ''
-    original_length = 0
-    index = start_index
-    item_count = 0
+def _compress_frame(frame_task):
+    # each frame is compressed as an independent stream, so it can be
+    # decompressed alone, and concatenated frames are decompressed as one
+    # by the decompressor
+    (codec_name, codec_level, frame_data) = frame_task
+    return codec.compress(codec_name, codec_level, frame_data)
 
-    memory_overlay_size = 0
-    disk_overlay_size = 0
-    
-    while index < len(delta_list):
-        delta_item = delta_list[index]
-
-        if delta_item.ref_id != DeltaItem.REF_SELF:
-            # Those deduped chunks will be put right after original data
-            # using deduped_list
-            delta_bytes = delta_item.get_serialized()
-            original_length += len(delta_bytes)
-            comp_delta_bytes = comp.compress(delta_bytes)
-            comp_data += comp_delta_bytes
-            item_count += 1
-            if delta_item.delta_type == DeltaItem.DELTA_MEMORY:
-                memory_offset_list.append(delta_item.offset)
-                memory_overlay_size += len(comp_delta_bytes)
-            elif delta_item.delta_type == DeltaItem.DELTA_DISK:
-                disk_offset_list.append(delta_item.offset)
-                disk_overlay_size += len(comp_delta_bytes)
-            else:
-                raise DeltaError("Delta should be either memory or disk")
-
-            # remove dependece getting required index by finding reference
-            deduped_list = self_ref_dict.get(delta_item.index, None)
-            if deduped_list != None:
-                #LOG.debug("moving %d deduped delta item" % (len(deduped_list)))
-                for deduped_item in deduped_list:
-                    deduped_bytes = deduped_item.get_serialized()
-                    original_length += len(deduped_bytes)
-                    comp_deduped_bytes = comp.compress(deduped_bytes)
-                    comp_data += comp_deduped_bytes
-                    item_count += 1
-                    if deduped_item.delta_type == DeltaItem.DELTA_MEMORY:
-                        memory_offset_list.append(deduped_item.offset)
-                        memory_overlay_size += len(comp_deduped_bytes)
-                    elif deduped_item.delta_type == DeltaItem.DELTA_DISK:
-                        disk_offset_list.append(deduped_item.offset)
-                        disk_overlay_size += len(comp_deduped_bytes)
-                    else:
-                        raise DeltaError("Delta should be either memory or disk")
-            
-        if len(comp_data) >= blob_size:
-            LOG.debug("savefile for %s(%ld delta item) %ld --> %ld" % \
-                    (blob_name, item_count, original_length, len(comp_data)))
-            comp_data += comp.flush()
-            blob_file = open(blob_name, "w+b")
-            blob_file.write(comp_data)
-            blob_file.close()
-            if statistics != None:
-                statistics['item_count'] = item_count
-            return index, memory_offset_list, disk_offset_list
-        index += 1
-
-    comp_data += comp.flush()
-    if len(comp_data) > 0 :
-        blob_file = open(blob_name, "w+b")
-        blob_file.write(comp_data)
-        blob_file.close()
-        if statistics != None:
-            statistics['item_count'] = item_count
-        return index, memory_offset_list, disk_offset_list
-    else:
-        raise DeltaError("LZMA compression is zero")
+
+def _plan_blobs(delta_list, self_ref_dict, blob_size):
+    # decide blob boundaries with serialized size before compression.
+    # Deduped chunks are put right after original data, so every blob can
+    # be recovered without the other blobs. Memory and disk chunks are not
+    # mixed in a blob.
+    blob_list = list()
+    blob_items = list()
+    blob_length = 0
+    for delta_item in delta_list:
+        if delta_item.ref_id == DeltaItem.REF_SELF:
+            continue
+        if delta_item.delta_type != DeltaItem.DELTA_MEMORY and \
+                delta_item.delta_type != DeltaItem.DELTA_DISK:
+            raise DeltaError("Delta should be either memory or disk")
+        if len(blob_items) > 0 and \
+                blob_items[0].delta_type != delta_item.delta_type:
+            blob_list.append(blob_items)
+            blob_items = list()
+            blob_length = 0
+        blob_items.append(delta_item)
+        blob_length += delta_item.get_serialized_size()
+        for deduped_item in self_ref_dict.get(delta_item.index, []):
+            blob_items.append(deduped_item)
+            blob_length += deduped_item.get_serialized_size()
+
+        if blob_length >= blob_size:
+            blob_list.append(blob_items)
+            blob_items = list()
+            blob_length = 0
+    if len(blob_items) > 0:
+        blob_list.append(blob_items)
+    return blob_list
+
+
+def _split_frames(blob_list, frame_size):
+    # return list of (blob number, delta items) to compress in parallel.
+    # Frame is split only before an original chunk, so deduped chunks
+    # are in the same frame as their reference
+    frame_list = list()
+    for blob_number, blob_items in enumerate(blob_list):
+        frame_items = list()
+        frame_length = 0
+        for delta_item in blob_items:
+            if frame_length >= frame_size and \
+                    delta_item.ref_id != DeltaItem.REF_SELF:
+                frame_list.append((blob_number, frame_items))
+                frame_items = list()
+                frame_length = 0
+            frame_items.append(delta_item)
+            frame_length += delta_item.get_serialized_size()
+        if len(frame_items) > 0:
+            frame_list.append((blob_number, frame_items))
+    return frame_list
+
+
+def _serialize_frames(frame_list, codec_name, codec_level):
+    for (blob_number, frame_items) in frame_list:
+        frame_data = ''.join([item.get_serialized() for item in frame_items])
+        yield (codec_name, codec_level, frame_data)
+
+
+def get_blob_frames(blob_info):
+    '''return list of (frame index, frame info, memory chunks, disk chunks)
+    A blob without frame information is a single frame covering the blob
+    '''
+    memory_chunks = blob_info[Const.META_OVERLAY_FILE_MEMORY_CHUNKS]
+    disk_chunks = blob_info[Const.META_OVERLAY_FILE_DISK_CHUNKS]
+    frames = blob_info.get(Const.META_OVERLAY_FILE_FRAMES, None)
+    if not frames:
+        return [(None, None, memory_chunks, disk_chunks)]
+
+    ret_list = list()
+    memory_index = 0
+    disk_index = 0
+    for frame_index, frame in enumerate(frames):
+        memory_count = frame[Const.META_FRAME_MEMORY_CHUNK_COUNT]
+        disk_count = frame[Const.META_FRAME_DISK_CHUNK_COUNT]
+        ret_list.append((frame_index, frame,
+            memory_chunks[memory_index:memory_index+memory_count],
+            disk_chunks[disk_index:disk_index+disk_count]))
+        memory_index += memory_count
+        disk_index += disk_count
+    return ret_list
+
+
+def get_frame_hashes(chunk_hashes, blob_name, frame_index):
+    # sha256 list of a frame at chunk hashes of overlay, or empty list
+    frame_hashes = (chunk_hashes or dict()).get(blob_name, list())
+    if frame_index == None or frame_index >= len(frame_hashes):
+        return list()
+    return frame_hashes[frame_index]
 
 
 def divide_blobs(delta_list, overlay_path, blob_size_kb, 
-        disk_chunk_size, memory_chunk_size):
-    # save delta list into multiple files with LZMA compression
+        disk_chunk_size, memory_chunk_size, num_proc=1,
+        codec_name=Codec.XZ, codec_level=9, frame_size_kb=256,
+        chunk_hashes=None):
+    # save delta list into multiple files with given compression
+    # chunk_hashes: if given, blob name -> list of sha256 of memory chunks
+    #   followed by disk chunks of each frame is filled. List is empty for
+    #   a frame having a chunk without hash value
+    codec.validate(codec_name, codec_level)
     start_time = time.time()
 
     # build reference table
@@ -821,35 +1277,106 @@ def divide_blobs(delta_list, overlay_path, blob_size_kb,
             self_ref_dict[ref_index].append(delta_item)
 
     blob_size = blob_size_kb*1024
-    blob_number = 1
+    blob_list = _plan_blobs(delta_list, self_ref_dict, blob_size)
+    frame_list = _split_frames(blob_list, frame_size_kb*1024)
+
+    pool = None
+    if num_proc > 1 and len(frame_list) > 1:
+        pool = multiprocessing.Pool(processes=min(num_proc, len(frame_list)))
+        results = pool.imap(_compress_frame,
+                _serialize_frames(frame_list, codec_name, codec_level))
+    else:
+        results = itertools.imap(_compress_frame,
+                _serialize_frames(frame_list, codec_name, codec_level))
+
+    # write compressed frames in order
+    blob_frames = [list() for blob_items in blob_list]
+    blob_frame_hashes = [list() for blob_items in blob_list]
+    blob_hashes = [sha256() for blob_items in blob_list]
+    blob_fd = None
+    current_blob = -1
+    try:
+        for (blob_number, frame_items), comp_data in \
+                itertools.izip(frame_list, results):
+            if len(comp_data) == 0:
+                raise DeltaError("Compressed data size is zero")
+            if blob_number != current_blob:
+                if blob_fd:
+                    blob_fd.close()
+                blob_name = "%s_%d.%s" % (overlay_path, blob_number+1,
+                        Codec.EXTENSION[codec_name])
+                blob_fd = open(blob_name, "w+b")
+                current_blob = blob_number
+            memory_hashes = [item.hash_value for item in frame_items \
+                    if item.delta_type == DeltaItem.DELTA_MEMORY]
+            disk_hashes = [item.hash_value for item in frame_items \
+                    if item.delta_type != DeltaItem.DELTA_MEMORY]
+            frame_info = {
+                Const.META_FRAME_OFFSET: blob_fd.tell(),
+                Const.META_FRAME_SIZE: len(comp_data),
+                Const.META_FRAME_DECOMP_SIZE: sum([item.get_serialized_size() \
+                        for item in frame_items]),
+                Const.META_FRAME_MEMORY_CHUNK_COUNT: len(memory_hashes),
+                Const.META_FRAME_DISK_CHUNK_COUNT: len(disk_hashes),
+                }
+            frame_hashes = memory_hashes + disk_hashes
+            if None in frame_hashes:
+                frame_hashes = list()
+            blob_frames[blob_number].append(frame_info)
+            blob_frame_hashes[blob_number].append(frame_hashes)
+            blob_fd.write(comp_data)
+            blob_hashes[blob_number].update(comp_data)
+        if pool:
+            pool.close()
+    except:
+        if pool:
+            pool.terminate()
+        raise
+    finally:
+        if pool:
+            pool.join()
+        if blob_fd:
+            blob_fd.close()
+
     overlay_list = list()
-    statistics = dict()
-    index = 0
     comp_counter = 0
     blob_output_size = 0
-    while index < len(delta_list):
-        blob_name = "%s_%d.xz" % (overlay_path, blob_number)
-        end_index, memory_offsets, disk_offsets = \
-                _save_blob(index, delta_list, self_ref_dict, blob_name, blob_size, statistics)
-        index = (end_index+1)
-        blob_number += 1
-        if statistics.get('item_count', None) != None:
-            comp_counter += statistics.get('item_count')
-
-        memory_chunks = [offset/memory_chunk_size for offset in memory_offsets]
-        disk_chunks = [offset/disk_chunk_size for offset in disk_offsets]
+    for blob_number, blob_items in enumerate(blob_list):
+        blob_name = "%s_%d.%s" % (overlay_path, blob_number+1,
+                Codec.EXTENSION[codec_name])
+        memory_chunks = list()
+        disk_chunks = list()
+        for delta_item in blob_items:
+            if delta_item.delta_type == DeltaItem.DELTA_MEMORY:
+                memory_chunks.append(delta_item.offset/memory_chunk_size)
+            else:
+                disk_chunks.append(delta_item.offset/disk_chunk_size)
+        comp_counter += len(blob_items)
+        self_ref_counts = defaultdict(int)
+        for delta_item in blob_items:
+            if delta_item.ref_id == DeltaItem.REF_SELF:
+                self_ref_counts[delta_item.data] += 1
+
         file_size = os.path.getsize(blob_name)
         blob_dict = {
             Const.META_OVERLAY_FILE_NAME:os.path.basename(blob_name),
             Const.META_OVERLAY_FILE_SIZE:file_size,
             Const.META_OVERLAY_FILE_DISK_CHUNKS: disk_chunks,
-            Const.META_OVERLAY_FILE_MEMORY_CHUNKS: memory_chunks
+            Const.META_OVERLAY_FILE_MEMORY_CHUNKS: memory_chunks,
+            Const.META_OVERLAY_FILE_CODEC: codec_name,
+            Const.META_OVERLAY_FILE_CODEC_LEVEL: codec_level,
+            Const.META_OVERLAY_FILE_FRAMES: blob_frames[blob_number],
+            Const.META_OVERLAY_FILE_SELF_REFS: \
+                    [[index, count] for (index, count) in self_ref_counts.iteritems()],
+            Const.META_OVERLAY_FILE_SHA256: blob_hashes[blob_number].hexdigest(),
             }
         overlay_list.append(blob_dict)
         blob_output_size += file_size
+        if chunk_hashes != None:
+            chunk_hashes[os.path.basename(blob_name)] = blob_frame_hashes[blob_number]
     end_time = time.time()
-    LOG.debug("Overlay Compression time: %f, delta_item: %ld" % 
-            ((end_time-start_time), comp_counter))
+    LOG.debug("Overlay Compression time: %f, delta_item: %ld, blobs: %d, frames: %d" % 
+            ((end_time-start_time), comp_counter, len(blob_list), len(frame_list)))
     LOG.debug("Total OVerlay Size : %ld" % blob_output_size)
     return overlay_list 
 
@@ -876,87 +1403,74 @@ def discard_free_chunks(merged_modified_list, chunk_size, disk_discard, memory_d
 
 def residue_merge_deltalist(old_deltalist, new_deltalist):
     '''return new_detlalist = old_deltalist+new_deltalist
+    Old delta items keep their slots and overwritten ones are emptied,
+    so the merged list is built once at the end: remaining old items
+    followed by new items in the given order.
     '''
-    ret_deltalist = list()
-
-    delta_dict = dict()
-    # construct dictionary for O(1) search
-    for item in old_deltalist:
-        delta_dict[item.index] = item
+    # construct dictionary for O(1) search of position
+    slots = list(old_deltalist)
+    position_dict = dict()
+    for position, item in enumerate(slots):
+        position_dict[item.index] = position
     # construct dictionary to get SELF_REFERENCE information
-    from collections import defaultdict
+    # index of original item -> list of referring items
     reference_dict = defaultdict(list)
     for item in old_deltalist:
         if item.ref_id == DeltaItem.REF_SELF:
-            original_item = delta_dict[item.data]
-            reference_dict[original_item].append(item)
-
-    for item in old_deltalist:
-        ret_deltalist.append(item)
+            if long(item.data) not in position_dict:
+                msg = "Cannot find self reference of index(%ld)" % item.index
+                raise DeltaError(msg)
+            reference_dict[long(item.data)].append(item)
 
+    appended_list = list()
     count_new_disk = 0
     count_new_mem = 0
     count_overwrite_disk = 0
     count_overwrite_mem = 0
 
     for new_item in new_deltalist:
-        old_item = delta_dict.get(new_item.index, None)
-        if old_item == None:
+        position = position_dict.get(new_item.index, None)
+        if position == None:
             # newly generate chunk. Just append
-            ret_deltalist.append(new_item)
+            appended_list.append(new_item)
             if new_item.delta_type == DeltaItem.DELTA_DISK:
                 count_new_disk += 1
             else:
                 count_new_mem += 1
+            continue
+
+        # overwrite existing one
+        old_item = slots[position]
+        if old_item == None:
+            msg = "Duplicated delta item at new delta list: index(%ld)" % new_item.index
+            raise DeltaError(msg)
+        referred_deltalist = reference_dict.pop(old_item.index, None)
+        if referred_deltalist:
+            # if old_deltaitem is referenced by other deltaitem,
+            # then, make the next one as a origin of reference.
+            # referred item can be already overwritten
+            remained_list = [item for item in referred_deltalist \
+                    if slots[position_dict[item.index]] is item]
+            if len(remained_list) > 0:
+                new_pivot = remained_list[0]
+                new_pivot.ref_id = old_item.ref_id
+                new_pivot.data_len = old_item.data_len
+                new_pivot.data = old_item.data
+                new_pivot.hash_value = old_item.hash_value
+                for referred_item in remained_list[1:]:
+                    referred_item.data = new_pivot.index
+                reference_dict[new_pivot.index].extend(remained_list[1:])
+
+        # make sure to replace origin, not reference
+        slots[position] = None
+        appended_list.append(new_item)
+        if new_item.delta_type == DeltaItem.DELTA_DISK:
+            count_overwrite_disk += 1
         else:
-            # overwrite existing one
-            referred_deltalist = reference_dict.get(old_item, None)
-            if referred_deltalist != None:
-                #msg = "Currently RESONCSTRUCT ALL SELF_REF pointer to RAW\n"
-                #msg += "Windows makes kernel panic with below code"
-                #raise DeltaError(msg)
-
-                # if old_deltaitem is referenced by other deltaitem,
-                # then, make the next one as a origin of reference
-                new_pivot = None
-                position_inlist = -1
-                new_pivot_position = -1
-                for position, item in enumerate(referred_deltalist):
-                    try:
-                        new_pivot_position = ret_deltalist.index(item)
-                        new_pivot = item
-                        position_inlist = position
-                        break
-                    except ValueError, e:
-                        continue
-
-                if new_pivot== None:
-                    # all REF_SELF deltaitem is now replace
-                    pass
-                else:
-                    ret_deltalist[new_pivot_position].ref_id = old_item.ref_id
-                    ret_deltalist[new_pivot_position].data_len = old_item.data_len
-                    ret_deltalist[new_pivot_position].data = old_item.data
-                    ret_deltalist[new_pivot_position].hash_value = old_item.hash_value
-                    del reference_dict[old_item]
-                    for referred_item in referred_deltalist[position_inlist+1:]: 
-                        try:
-                            ref_item_index = ret_deltalist.index(referred_item)
-                            ret_deltalist[ref_item_index].data = ret_deltalist[new_pivot_position].index
-                            reference_dict[new_pivot].append(referred_item)
-                        except ValueError, e:
-                            # referred item can be already overwritten
-                            pass
-
-            # make sure to replace origin, not reference
-            old_item_position = ret_deltalist.index(old_item)
-            del ret_deltalist[old_item_position]
-            ret_deltalist.append(new_item)
+            count_overwrite_mem += 1
 
-            if new_item.delta_type == DeltaItem.DELTA_DISK:
-                count_overwrite_disk += 1
-            else:
-                count_overwrite_mem += 1
+    ret_deltalist = [item for item in slots if item != None]
+    ret_deltalist.extend(appended_list)
         
     LOG.debug("merge residue with previous :")
     LOG.debug("    add new disk   : %d" % (count_new_disk))
@@ -992,6 +1506,7 @@ def residue_diff_deltalists(old_deltalist, new_deltalist, base_mem):
     statics_duplicated_item = 0
     statics_overwrite_item = 0
     statics_reverted = 0
+    base_mem_fd = None
     for item in new_deltalist:
         old_deltaitem = old_deltadict.get(item.index, None)
         if old_deltaitem == None:
@@ -1024,7 +1539,8 @@ def residue_diff_deltalists(old_deltalist, new_deltalist, base_mem):
             # special case: end of memory snapshot
             # memory snapshot size is not aligned with CHUNK_SIZE.
             # memory snapshot size can change every time
-            base_mem_fd = open(base_mem, "r")
+            if base_mem_fd == None:
+                base_mem_fd = open(base_mem, "r")
             base_mem_fd.seek(item.offset)
             base_mem_data = base_mem_fd.read(Const.CHUNK_SIZE)
             base_mem_hash = sha256(base_mem_data).digest()
@@ -1043,6 +1559,8 @@ def residue_diff_deltalists(old_deltalist, new_deltalist, base_mem):
                     data_len=8, data=item.offset)
         ret_deltalist.append(delta_item)
         statics_reverted += 1
+    if base_mem_fd != None:
+        base_mem_fd.close()
 
     LOG.debug("residue_diff_statistics")
     LOG.debug("  newly create chunks   : %d" % (statics_new_item))
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+#
+# Cloudlet Infrastructure for Mobile Computing
+#
+#   Author: Kiryong Ha <krha@cmu.edu>
+#
+#   Copyright (C) 2011-2013 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os
+import sys
+import mmap
+import struct
+from bisect import bisect_left
+from operator import itemgetter
+from optparse import OptionParser
+
+from Configuration import Const
+import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class HashIndexError(Exception):
+    pass
+
+
+class HashMetaFile(object):
+    ''' Read-only view of base VM meta file (.base-mem-meta, .base-img-meta)
+    Each item is (offset, length, sha256) as in the hash list imported
+    from meta file, but it is decoded from mmap only when it is accessed.
+    '''
+    MEMORY_META_FORMAT  = "!qI32s"
+    DISK_META_FORMAT    = "!QI32s"
+    RECORD_SIZE         = struct.calcsize(MEMORY_META_FORMAT)
+
+    def __init__(self, meta_path, meta_format=MEMORY_META_FORMAT):
+        self.meta_path = meta_path
+        self.meta_format = meta_format
+        self.count = os.path.getsize(meta_path)/self.RECORD_SIZE
+        self.meta_mmap = None
+        if self.count > 0:
+            fd = open(meta_path, "rb")
+            self.meta_mmap = mmap.mmap(fd.fileno(), 0, prot=mmap.PROT_READ)
+            fd.close()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError("meta file index out of range: %d" % index)
+        return struct.unpack_from(self.meta_format, self.meta_mmap,
+                index*self.RECORD_SIZE)
+
+    def __iter__(self):
+        for index in xrange(self.count):
+            yield struct.unpack_from(self.meta_format, self.meta_mmap,
+                    index*self.RECORD_SIZE)
+
+    def close(self):
+        if self.meta_mmap:
+            self.meta_mmap.close()
+            self.meta_mmap = None
+
+
+class _HashKeys(object):
+    # sequence of hash values in the index for bisect
+    def __init__(self, hash_index):
+        self.hash_index = hash_index
+
+    def __len__(self):
+        return self.hash_index.count
+
+    def __getitem__(self, index):
+        return self.hash_index.get_hash(index)
+
+
+class HashIndex(object):
+    ''' Hash index of base VM meta file
+    Records are sorted by hash value, so a hash can be found with binary
+    search over mmaped file without loading it. Since the file is mapped
+    read-only, page cache is shared by every process using the same base VM.
+    For the same hash value, the record that comes first at the meta file
+    is located first.
+
+    File format:
+        header : magic(4), version(4), number of records(8)
+        record : sha256(32), offset(8), length(4)
+    '''
+    MAGIC           = 0x1145511b
+    VERSION         = 0x00000001
+    HEADER_FORMAT   = "!IIQ"
+    HEADER_SIZE     = struct.calcsize(HEADER_FORMAT)
+    RECORD_FORMAT   = "!32sQI"
+    RECORD_SIZE     = struct.calcsize(RECORD_FORMAT)
+    HASH_SIZE       = 32
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        fd = open(index_path, "rb")
+        header = fd.read(self.HEADER_SIZE)
+        if len(header) != self.HEADER_SIZE:
+            fd.close()
+            raise HashIndexError("Invalid hash index file at %s" % index_path)
+        magic, version, self.count = struct.unpack(self.HEADER_FORMAT, header)
+        if magic != self.MAGIC:
+            fd.close()
+            raise HashIndexError("Invalid hash index magic at %s" % index_path)
+        if version != self.VERSION:
+            fd.close()
+            raise HashIndexError("Not supported hash index version %d at %s" % \
+                    (version, index_path))
+        expected_size = self.HEADER_SIZE + self.count*self.RECORD_SIZE
+        if os.path.getsize(index_path) != expected_size:
+            fd.close()
+            raise HashIndexError("Corrupted hash index at %s" % index_path)
+        self.index_mmap = mmap.mmap(fd.fileno(), 0, prot=mmap.PROT_READ)
+        fd.close()
+        self._keys = _HashKeys(self)
+
+    def __len__(self):
+        return self.count
+
+    def get_hash(self, index):
+        start = self.HEADER_SIZE + index*self.RECORD_SIZE
+        return self.index_mmap[start:start+self.HASH_SIZE]
+
+    def find(self, hash_value):
+        # return: (offset, length) of the hash value, None if not exist
+        index = bisect_left(self._keys, hash_value)
+        if index < self.count and self.get_hash(index) == hash_value:
+            start = self.HEADER_SIZE + index*self.RECORD_SIZE
+            (hash_value, offset, length) = struct.unpack_from(self.RECORD_FORMAT,
+                    self.index_mmap, start)
+            return offset, length
+        return None
+
+    def __contains__(self, hash_value):
+        return self.find(hash_value) != None
+
+    def __iter__(self):
+        # iterate in (offset, length, hash) format as base hash list
+        for index in xrange(self.count):
+            start = self.HEADER_SIZE + index*self.RECORD_SIZE
+            (hash_value, offset, length) = struct.unpack_from(self.RECORD_FORMAT,
+                    self.index_mmap, start)
+            yield (offset, length, hash_value)
+
+    def close(self):
+        if self.index_mmap:
+            self.index_mmap.close()
+            self.index_mmap = None
+
+    @staticmethod
+    def create(hash_list, index_path):
+        # hash_list: list of (offset, length, hash) as in meta file
+        # sort is stable, so the first record is kept first for the same hash
+        sorted_list = sorted(hash_list, key=itemgetter(2))
+        temp_path = index_path + ".tmp"
+        fd = open(temp_path, "wb")
+        fd.write(struct.pack(HashIndex.HEADER_FORMAT, HashIndex.MAGIC,
+            HashIndex.VERSION, len(sorted_list)))
+        for (offset, length, hash_value) in sorted_list:
+            fd.write(struct.pack(HashIndex.RECORD_FORMAT, hash_value, offset, length))
+        fd.close()
+        os.rename(temp_path, index_path)
+        return HashIndex(index_path)
+
+    @staticmethod
+    def from_metafile(meta_path, index_path=None,
+            meta_format=HashMetaFile.MEMORY_META_FORMAT):
+        # convert existing meta file to hash index
+        if index_path == None:
+            index_path = Const.get_hashindex_path(meta_path)
+        LOG.info("Create hash index of %s" % os.path.basename(meta_path))
+        meta_file = HashMetaFile(meta_path, meta_format)
+        try:
+            return HashIndex.create(meta_file, index_path)
+        finally:
+            meta_file.close()
+
+
+def load_index(meta_path, meta_format=HashMetaFile.MEMORY_META_FORMAT):
+    ''' return HashIndex of the meta file
+    Hash index is created if it does not exist or it is older than meta file
+    '''
+    index_path = Const.get_hashindex_path(meta_path)
+    if os.path.exists(index_path) and \
+            os.path.getmtime(index_path) >= os.path.getmtime(meta_path):
+        try:
+            return HashIndex(index_path)
+        except HashIndexError, e:
+            LOG.warning("Recreate hash index: %s" % str(e))
+    return HashIndex.from_metafile(meta_path, index_path, meta_format)
+
+
+def load_memory_index(base_memmeta):
+    return load_index(base_memmeta, HashMetaFile.MEMORY_META_FORMAT)
+
+
+def load_disk_index(base_diskmeta):
+    return load_index(base_diskmeta, HashMetaFile.DISK_META_FORMAT)
+
+
+def _process_cmd(argv):
+    USAGE = "Usage: %prog [option]"
+    DESCRIPTION = "Convert base VM meta file to hash index"
+
+    parser = OptionParser(usage=USAGE, description=DESCRIPTION)
+    parser.add_option("-m", "--memory-meta", type="string", dest="memory_meta",
+            action='store', help="base memory meta file path")
+    parser.add_option("-d", "--disk-meta", type="string", dest="disk_meta",
+            action='store', help="base disk meta file path")
+    settings, args = parser.parse_args(argv)
+    if not settings.memory_meta and not settings.disk_meta:
+        parser.error("Need base memory or disk meta file")
+    return settings
+
+
+if __name__ == "__main__":
+    settings = _process_cmd(sys.argv[1:])
+    if settings.memory_meta:
+        HashIndex.from_metafile(settings.memory_meta,
+                meta_format=HashMetaFile.MEMORY_META_FORMAT).close()
+    if settings.disk_meta:
+        HashIndex.from_metafile(settings.disk_meta,
+                meta_format=HashMetaFile.DISK_META_FORMAT).close()
@@ -0,0 +1,549 @@
+#!/usr/bin/env python
+#
+# Cloudlet Infrastructure for Mobile Computing
+#
+#   Author: Kiryong Ha <krha@cmu.edu>
+#
+#   Copyright (C) 2011-2013 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os
+import re
+import shutil
+import threading
+import tempfile
+import struct
+import subprocess
+import Queue
+from hashlib import sha256
+from collections import OrderedDict
+
+from Configuration import Const
+import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class OverlayCacheError(Exception):
+    pass
+
+
+def get_overlay_digest(meta_info):
+    '''return digest of overlay from digests of its blobs
+    or None if a blob does not have digest
+    '''
+    overlay_hash = sha256()
+    for blob in meta_info[Const.META_OVERLAY_FILES]:
+        digest = blob.get(Const.META_OVERLAY_FILE_SHA256, None)
+        if digest == None:
+            return None
+        overlay_hash.update(digest)
+    return overlay_hash.hexdigest()
+
+
+def copy_sparse(src_path, dest_path):
+    # share extents if file system supports reflink, otherwise keep holes
+    # of sparse file
+    try:
+        subprocess.check_call(["cp", "--reflink=auto", "--sparse=always",
+            src_path, dest_path], close_fds=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise OverlayCacheError("Cannot copy %s to %s : %s" % \
+                (src_path, dest_path, str(e)))
+
+
+def _get_disk_usage(path):
+    # allocated size of sparse files
+    usage = 0
+    for filename in os.listdir(path):
+        usage += os.stat(os.path.join(path, filename)).st_blocks*512
+    return usage
+
+
+class _QuotaCache(object):
+    # entries bounded by disk quota with least recently used eviction
+    DIGEST_PATTERN      = re.compile("^[0-9a-f]{64}$")
+
+    def __init__(self, cache_dir, quota):
+        if quota <= 0:
+            raise OverlayCacheError("Invalid cache quota : %d" % quota)
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.quota = quota
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # key -> size, least recent first
+        self.total_size = 0
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _load(self, entry_list):
+        # entry_list : [(mtime, key, size), ...] found at cache directory
+        for (mtime, key, size) in sorted(entry_list):
+            self.entries[key] = size
+            self.total_size += size
+        with self.lock:
+            self._evict()
+        LOG.info("%s at %s : %d entries, %d/%d bytes" % \
+                (self.__class__.__name__, self.cache_dir, len(self.entries),
+                self.total_size, self.quota))
+
+    def _get_path(self, key):
+        raise NotImplementedError()
+
+    def _remove_path(self, path):
+        raise NotImplementedError()
+
+    def _touch(self, key):
+        # caller should hold the lock
+        # return True if key is cached, and mark it most recently used
+        size = self.entries.pop(key, None)
+        if size == None:
+            return False
+        self.entries[key] = size
+        try:
+            os.utime(self._get_path(key), None)
+        except OSError as e:
+            LOG.warning("Cannot access cached entry %s : %s" % (key, str(e)))
+            del self.entries[key]
+            self.total_size -= size
+            return False
+        return True
+
+    def _insert(self, key, temp_path, size):
+        if size > self.quota:
+            self._remove_path(temp_path)
+            return False
+        with self.lock:
+            path = self._get_path(key)
+            prev_size = self.entries.pop(key, None)
+            if prev_size != None:
+                self.total_size -= prev_size
+                self._remove_path(path)
+            os.rename(temp_path, path)
+            self.entries[key] = size
+            self.total_size += size
+            self._evict()
+        return True
+
+    def _evict(self):
+        # caller should hold the lock
+        while self.total_size > self.quota and len(self.entries) > 0:
+            key, size = self.entries.popitem(last=False)
+            self.total_size -= size
+            try:
+                self._remove_path(self._get_path(key))
+            except OSError as e:
+                LOG.warning("Cannot remove cached entry %s : %s" % (key, str(e)))
+            LOG.debug("Evict cached entry %s (%d bytes)" % (key, size))
+
+    def has_key(self, key):
+        with self.lock:
+            return key in self.entries
+
+
+class OverlayBlobCache(_QuotaCache):
+    ''' Content addressed store of received overlay blobs
+    Each blob is saved as a file named by sha256 hex digest of the
+    compressed blob. Total size is bounded by quota and the least recently
+    used blobs are evicted first. Modified time of a file is updated at
+    each use, so that the order survives server restart.
+    '''
+    BLOB_EXT            = ".blob"
+    TEMP_EXT            = ".tmp"
+
+    def __init__(self, cache_dir, quota):
+        _QuotaCache.__init__(self, cache_dir, quota)
+        blob_list = list()
+        for filename in os.listdir(self.cache_dir):
+            filepath = os.path.join(self.cache_dir, filename)
+            if filename.endswith(OverlayBlobCache.TEMP_EXT):
+                # incomplete blob of previous run
+                os.remove(filepath)
+                continue
+            digest, ext = os.path.splitext(filename)
+            if ext != OverlayBlobCache.BLOB_EXT or \
+                    not _QuotaCache.DIGEST_PATTERN.match(digest):
+                continue
+            stat = os.stat(filepath)
+            blob_list.append((stat.st_mtime, digest, stat.st_size))
+        self._load(blob_list)
+
+    def _get_path(self, digest):
+        return os.path.join(self.cache_dir, digest + OverlayBlobCache.BLOB_EXT)
+
+    def _remove_path(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    def has_blob(self, digest):
+        return self.has_key(digest)
+
+    def open_blob(self, digest):
+        '''return file object of the cached blob or None
+        Opened blob can be read even if it is evicted later
+        '''
+        with self.lock:
+            if not self._touch(digest):
+                return None
+            try:
+                return open(self._get_path(digest), "rb")
+            except IOError as e:
+                LOG.warning("Cannot open cached blob %s : %s" % (digest, str(e)))
+                self.total_size -= self.entries.pop(digest)
+                return None
+
+    def new_writer(self, digest):
+        return BlobCacheWriter(self, digest)
+
+    def _add(self, digest, temp_path):
+        return self._insert(digest, temp_path, os.path.getsize(temp_path))
+
+
+class BlobCacheWriter(object):
+    ''' Save a blob into the cache while it is being received
+    Blob is added only when its digest matches. Failure to write the cache
+    does not fail the caller, and the blob is just not cached.
+    '''
+    def __init__(self, cache, digest):
+        self.cache = cache
+        self.digest = digest
+        self.hash = sha256()
+        self.temp_fd = None
+        self.temp_path = None
+        try:
+            fd, self.temp_path = tempfile.mkstemp(dir=cache.cache_dir,
+                    suffix=OverlayBlobCache.TEMP_EXT)
+            self.temp_fd = os.fdopen(fd, "wb")
+        except (IOError, OSError) as e:
+            LOG.warning("Cannot cache blob %s : %s" % (digest, str(e)))
+            self.abort()
+
+    def write(self, data):
+        if self.temp_fd == None:
+            return
+        try:
+            self.temp_fd.write(data)
+            self.hash.update(data)
+        except (IOError, OSError) as e:
+            LOG.warning("Cannot cache blob %s : %s" % (self.digest, str(e)))
+            self.abort()
+
+    def commit(self):
+        if self.temp_fd == None:
+            return False
+        try:
+            self.temp_fd.close()
+            self.temp_fd = None
+            if self.hash.hexdigest() != self.digest:
+                LOG.warning("Digest of blob does not match %s" % self.digest)
+                self.abort()
+                return False
+            return self.cache._add(self.digest, self.temp_path)
+        except (IOError, OSError) as e:
+            LOG.warning("Cannot cache blob %s : %s" % (self.digest, str(e)))
+            self.abort()
+            return False
+
+    def abort(self):
+        if self.temp_fd != None:
+            self.temp_fd.close()
+            self.temp_fd = None
+        if self.temp_path != None and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+        self.temp_path = None
+
+
+class BlobCacheWriteThread(threading.Thread):
+    ''' Write received blobs into the cache at a separate thread
+    The receiver only queues data, so the transfer does not wait for the
+    disk. When the queue is full, the blob is not cached rather than
+    blocking the receiver. Blobs not committed by finish() are dropped.
+    '''
+    QUEUE_SIZE          = 1024  # number of queued data pieces
+    BEGIN               = "begin"
+    DATA                = "data"
+    COMMIT              = "commit"
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.queue = Queue.Queue(maxsize=BlobCacheWriteThread.QUEUE_SIZE)
+        self.writers = dict()   # blob id -> BlobCacheWriter
+        threading.Thread.__init__(self, target=self.write_blobs)
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except Queue.Full:
+            return False
+
+    def begin(self, blob_id, digest):
+        return self._put((BlobCacheWriteThread.BEGIN, blob_id, digest))
+
+    def write(self, blob_id, data):
+        return self._put((BlobCacheWriteThread.DATA, blob_id, data))
+
+    def commit(self, blob_id):
+        return self._put((BlobCacheWriteThread.COMMIT, blob_id, None))
+
+    def finish(self):
+        self.queue.put(None)
+
+    def write_blobs(self):
+        while True:
+            item = self.queue.get()
+            if item == None:
+                break
+            (command, blob_id, value) = item
+            if command == BlobCacheWriteThread.BEGIN:
+                self.writers[blob_id] = self.cache.new_writer(value)
+                continue
+            cache_writer = self.writers.get(blob_id, None)
+            if cache_writer == None:
+                continue
+            if command == BlobCacheWriteThread.DATA:
+                cache_writer.write(value)
+            elif command == BlobCacheWriteThread.COMMIT:
+                cache_writer.commit()
+                del self.writers[blob_id]
+        for cache_writer in self.writers.itervalues():
+            cache_writer.abort()
+        self.writers.clear()
+
+
+class LaunchImageCache(_QuotaCache):
+    ''' Store of recovered launch disk and memory of overlay VMs
+    Recovered images only depend on base VM and overlay, so an entry is
+    keyed by (base VM hash, overlay digest). Images are sparse files having
+    modified chunks only, and they are copied with reflink if the file
+    system supports it. Total disk usage is bounded by quota and the least
+    recently used entries are evicted first.
+    '''
+    LAUNCH_DISK         = "launch-disk"
+    LAUNCH_MEM          = "launch-mem"
+    TEMP_PREFIX         = "tmp-"
+
+    def __init__(self, cache_dir, quota):
+        _QuotaCache.__init__(self, cache_dir, quota)
+        entry_list = list()
+        for dirname in os.listdir(self.cache_dir):
+            dirpath = os.path.join(self.cache_dir, dirname)
+            if dirname.startswith(LaunchImageCache.TEMP_PREFIX):
+                # incomplete entry of previous run
+                shutil.rmtree(dirpath)
+                continue
+            if not os.path.isdir(dirpath) or \
+                    not _QuotaCache.DIGEST_PATTERN.match(dirname):
+                continue
+            entry_list.append((os.stat(dirpath).st_mtime, dirname,
+                _get_disk_usage(dirpath)))
+        self._load(entry_list)
+
+    @staticmethod
+    def get_key(base_hashvalue, overlay_digest):
+        return sha256("%s:%s" % (base_hashvalue, overlay_digest)).hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _remove_path(self, path):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    def get_launch_images(self, base_hashvalue, overlay_digest,
+            launch_disk, launch_mem):
+        '''copy cached images to launch_disk and launch_mem
+        return False if the images are not cached
+        '''
+        key = LaunchImageCache.get_key(base_hashvalue, overlay_digest)
+        image_names = (LaunchImageCache.LAUNCH_DISK, LaunchImageCache.LAUNCH_MEM)
+        with self.lock:
+            if not self._touch(key):
+                return False
+            # pin images by hard links, so that they can be copied without
+            # the lock even if the entry is evicted meanwhile
+            entry_path = self._get_path(key)
+            pin_path = tempfile.mkdtemp(dir=self.cache_dir,
+                    prefix=LaunchImageCache.TEMP_PREFIX)
+            try:
+                for name in image_names:
+                    os.link(os.path.join(entry_path, name),
+                            os.path.join(pin_path, name))
+            except OSError as e:
+                LOG.warning("Cannot pin cached launch images : %s" % str(e))
+                shutil.rmtree(pin_path)
+                return False
+        try:
+            for name, dest_path in zip(image_names, (launch_disk, launch_mem)):
+                copy_sparse(os.path.join(pin_path, name), dest_path)
+        except OverlayCacheError as e:
+            LOG.warning(str(e))
+            return False
+        finally:
+            shutil.rmtree(pin_path)
+        return True
+
+    def add_launch_images(self, base_hashvalue, overlay_digest,
+            launch_disk, launch_mem):
+        key = LaunchImageCache.get_key(base_hashvalue, overlay_digest)
+        if self.has_key(key):
+            return True
+        temp_path = tempfile.mkdtemp(dir=self.cache_dir,
+                prefix=LaunchImageCache.TEMP_PREFIX)
+        try:
+            copy_sparse(launch_disk,
+                    os.path.join(temp_path, LaunchImageCache.LAUNCH_DISK))
+            copy_sparse(launch_mem,
+                    os.path.join(temp_path, LaunchImageCache.LAUNCH_MEM))
+            return self._insert(key, temp_path, _get_disk_usage(temp_path))
+        except (OverlayCacheError, OSError) as e:
+            LOG.warning("Cannot cache launch images : %s" % str(e))
+            self._remove_path(temp_path)
+            return False
+
+
+class ChunkStore(object):
+    ''' Content addressed store of chunks of recovered overlays
+    Chunks are appended to segment files with a companion index file of
+    (sha256, offset, length) records. A new segment is started at each run
+    and when the current one is full. When disk usage exceeds quota, the
+    oldest segment is dropped as a whole.
+    '''
+    SEGMENT_SIZE        = 1024*1024*64  # 64 MB
+    DATA_EXT            = ".chunks"
+    INDEX_EXT           = ".index"
+    RECORD_FORMAT       = "!32sQI"
+    RECORD_SIZE         = struct.calcsize(RECORD_FORMAT)
+
+    def __init__(self, store_dir, quota):
+        if quota <= 0:
+            raise OverlayCacheError("Invalid chunk store quota : %d" % quota)
+        self.store_dir = os.path.abspath(store_dir)
+        self.quota = quota
+        self.lock = threading.Lock()
+        self.chunks = dict()            # sha256 -> (segment, offset, length)
+        self.segments = OrderedDict()   # segment -> size, oldest first
+        self.total_size = 0
+        self.data_fd = None
+        self.index_fd = None
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+        self._load()
+        self.current_segment = max(self.segments.keys() or [-1]) + 1
+
+    def _get_path(self, segment, ext):
+        return os.path.join(self.store_dir, "%08d%s" % (segment, ext))
+
+    def _read_index(self, segment):
+        # return records whose data is completely written
+        index_path = self._get_path(segment, ChunkStore.INDEX_EXT)
+        data_path = self._get_path(segment, ChunkStore.DATA_EXT)
+        if not os.path.exists(data_path):
+            return list()
+        data_size = os.path.getsize(data_path)
+        index_data = open(index_path, "rb").read()
+        record_list = list()
+        for start in xrange(0, len(index_data)-ChunkStore.RECORD_SIZE+1,
+                ChunkStore.RECORD_SIZE):
+            (hash_value, offset, length) = struct.unpack_from(
+                    ChunkStore.RECORD_FORMAT, index_data, start)
+            if offset + length > data_size:
+                break
+            record_list.append((hash_value, offset, length))
+        return record_list
+
+    def _load(self):
+        segment_list = list()
+        for filename in os.listdir(self.store_dir):
+            name, ext = os.path.splitext(filename)
+            if ext == ChunkStore.INDEX_EXT and name.isdigit():
+                segment_list.append(int(name))
+        for segment in sorted(segment_list):
+            for (hash_value, offset, length) in self._read_index(segment):
+                self.chunks[hash_value] = (segment, offset, length)
+            data_path = self._get_path(segment, ChunkStore.DATA_EXT)
+            size = 0
+            if os.path.exists(data_path):
+                size = os.path.getsize(data_path)
+            self.segments[segment] = size
+            self.total_size += size
+        with self.lock:
+            self._evict()
+        LOG.info("ChunkStore at %s : %d chunks, %d/%d bytes" % \
+                (self.store_dir, len(self.chunks), self.total_size, self.quota))
+
+    def _evict(self):
+        # caller should hold the lock. Current segment is not dropped
+        while self.total_size > self.quota and len(self.segments) > 1:
+            segment, size = self.segments.popitem(last=False)
+            for (hash_value, offset, length) in self._read_index(segment):
+                if self.chunks.get(hash_value, (None,))[0] == segment:
+                    del self.chunks[hash_value]
+            self.total_size -= size
+            for ext in (ChunkStore.DATA_EXT, ChunkStore.INDEX_EXT):
+                try:
+                    os.remove(self._get_path(segment, ext))
+                except OSError as e:
+                    LOG.warning("Cannot remove chunk segment : %s" % str(e))
+            LOG.debug("Evict chunk segment %d (%d bytes)" % (segment, size))
+
+    def _open_segment(self):
+        # caller should hold the lock
+        if self.data_fd != None:
+            if self.segments[self.current_segment] < ChunkStore.SEGMENT_SIZE:
+                return
+            self.data_fd.close()
+            self.index_fd.close()
+            self.current_segment += 1
+        self.data_fd = open(self._get_path(self.current_segment,
+            ChunkStore.DATA_EXT), "ab")
+        self.index_fd = open(self._get_path(self.current_segment,
+            ChunkStore.INDEX_EXT), "ab")
+        self.segments[self.current_segment] = 0
+
+    def has_chunk(self, hash_value):
+        return hash_value in self.chunks
+
+    def locate(self, hash_value):
+        '''return (segment path, offset, length) of the chunk or None
+        Opened segment can be read even if it is evicted later
+        '''
+        with self.lock:
+            location = self.chunks.get(hash_value, None)
+            if location == None:
+                return None
+            (segment, offset, length) = location
+            return (self._get_path(segment, ChunkStore.DATA_EXT), offset, length)
+
+    def add_chunks(self, chunk_list):
+        # chunk_list : iterable of (sha256, data) verified by caller
+        added_count = 0
+        with self.lock:
+            for (hash_value, data) in chunk_list:
+                if hash_value in self.chunks:
+                    continue
+                self._open_segment()
+                offset = self.segments[self.current_segment]
+                self.data_fd.write(data)
+                self.index_fd.write(struct.pack(ChunkStore.RECORD_FORMAT,
+                    hash_value, offset, len(data)))
+                self.chunks[hash_value] = (self.current_segment, offset, len(data))
+                self.segments[self.current_segment] += len(data)
+                self.total_size += len(data)
+                added_count += 1
+            if self.data_fd != None:
+                # index record beyond the end of data is ignored at loading
+                self.data_fd.flush()
+                self.index_fd.flush()
+            self._evict()
+        return added_count
@@ -35,6 +35,7 @@ import sys
 import subprocess
 
 from Configuration import Const
+import hashindex
 import log as logging
 from db.api import DBConnector
 from db.table_def import BaseVM
@@ -347,7 +348,10 @@ class _FileFile(file):
         total_read = 0
         try:
             while total_read < size:
-                data = self.read(chunk_size)
+                data = self.read(min(chunk_size, size-total_read))
+                if not data:
+                    break
+                total_read += len(data)
                 yield data
         except:
             raise StopIteration()
@@ -385,8 +389,11 @@ class _PackageObject(object):
         self.size = info.file_size
 
 
-    def iter_content(self, chunk_size):
-        return self._fh.iter_content(self.offset, self.size, chunk_size)
+    def iter_content(self, chunk_size, offset=0, size=None):
+        # offset and size are relative to the member, e.g. a frame of blob
+        if size == None:
+            size = self.size - offset
+        return self._fh.iter_content(self.offset+offset, size, chunk_size)
 
 
 class VMOverlayPackage(object):
@@ -406,6 +413,7 @@ class VMOverlayPackage(object):
             raise ValueError('%s: URLs not supported' % parsed.scheme)
 
         # Read Zip
+        self._fh = fh
         try:
             self.zip_overlay = zipfile.ZipFile(fh, 'r')
 
@@ -415,8 +423,10 @@ class VMOverlayPackage(object):
             
             self.metafile = Const.OVERLAY_META
             self.blobfiles = list()
+            self.chunk_hashes_file = Const.OVERLAY_META + Const.OVERLAY_CHUNK_HASHES_EXT
             for each_file in self.zip_overlay.namelist():
-                if (each_file != Const.OVERLAY_META):
+                if (each_file != Const.OVERLAY_META) and \
+                        (each_file != self.chunk_hashes_file):
                     self.blobfiles.append(each_file)
             
         except (zipfile.BadZipfile, _HttpError), e:
@@ -430,9 +440,15 @@ class VMOverlayPackage(object):
     def read_blob(self, blobname):
         return self.zip_overlay.read(blobname)
 
-    def iter_blob(self, blobname, chunk_size):
+    def iter_blob(self, blobname, chunk_size, offset=0, size=None):
+        # read only (offset, size) range of the blob with range request
         package_blob = _PackageObject(self.zip_overlay, blobname)
-        return package_blob.iter_content(chunk_size)
+        return package_blob.iter_content(chunk_size, offset=offset, size=size)
+
+    def close(self):
+        # ZipFile does not close the file object given to it
+        self.zip_overlay.close()
+        self._fh.close()
 
     @classmethod
     def create(cls, outfilename, metafile, blobfiles):
@@ -440,6 +456,10 @@ class VMOverlayPackage(object):
         zip = zipfile.ZipFile(outfilename, 'w', zipfile.ZIP_STORED, True)
         zip.comment = 'Cloudlet VM overlay'
         zip.write(metafile, os.path.basename(metafile))
+        # chunk hashes of overlay go along with its meta if exist
+        hashes_file = metafile + Const.OVERLAY_CHUNK_HASHES_EXT
+        if os.path.exists(hashes_file):
+            zip.write(hashes_file, os.path.basename(hashes_file))
         for index, blobfile in enumerate(blobfiles):
             zip.write(blobfile, os.path.basename(blobfile))
         zip.close()
@@ -716,6 +736,8 @@ class PackagingUtil(object):
         LOG.info("Place base VM to the right directory")
         for (src, dest) in path_list.iteritems():
             shutil.move(src, dest)
+        hashindex.load_memory_index(target_memoryhash).close()
+        hashindex.load_disk_index(target_diskhash).close()
 
         # add to DB
         dbconn = DBConnector()
@@ -29,9 +29,25 @@ import tempfile
 import struct
 import shutil
 import threading
+import collections
+import itertools
+import multiprocessing
+import psutil
+from hashlib import sha256
 
 import synthesis as synthesis
+import hashindex
+import codec
 from package import VMOverlayPackage
+from overlay_cache import OverlayBlobCache
+from overlay_cache import BlobCacheWriteThread
+from overlay_cache import LaunchImageCache
+from overlay_cache import OverlayCacheError
+from overlay_cache import ChunkStore
+from overlay_cache import get_overlay_digest
+from delta import DeltaItem
+from delta import get_blob_frames
+from delta import get_frame_hashes
 from db.api import DBConnector
 from db.table_def import BaseVM, Session, OverlayVM
 from synthesis_protocol import Protocol as Protocol
@@ -42,13 +58,14 @@ import msgpack
 
 from pprint import pformat
 from optparse import OptionParser
-from multiprocessing import Process, JoinableQueue, Queue, Manager
-from lzma import LZMADecompressor
+from multiprocessing import Process, JoinableQueue, Queue
+from Queue import Empty
 import log as logging
 
 
 LOG = logging.getLogger(__name__)
 session_resources = dict()   # dict[session_id] = obj(SessionResource)
+session_resources_lock = threading.Lock()
 
 
 class RapidSynthesisError(Exception):
@@ -114,6 +131,163 @@ class SessionResource(object):
             overlay_db_entry.terminate()
 
 
+class AdmissionController(object):
+    ''' Cap concurrent synthesis sessions by CPU, memory and disk
+    A session is admitted when fewer than max_sessions are admitted and its
+    memory and disk fit into the budget left by admitted sessions as well
+    as into what is free now. Other sessions wait in arrival order.
+    The first session is always admitted so that a large VM cannot starve.
+    A session with no request in handling for idle_timeout seconds is
+    expired when another session is waiting: expire_callback(session_id)
+    tears down its resources and then its slot is released.
+    '''
+    WAIT_INTERVAL       = 1.0   # seconds between checking free resources
+
+    def __init__(self, max_sessions, work_dir=None,
+            memory_budget=None, disk_budget=None,
+            idle_timeout=None, expire_callback=None):
+        self.max_sessions = max_sessions
+        self.work_dir = work_dir or tempfile.gettempdir()
+        self.memory_budget = memory_budget or self._get_free_memory()
+        self.disk_budget = disk_budget or self._get_free_disk()
+        self.idle_timeout = idle_timeout
+        self.expire_callback = expire_callback
+        self.condition = threading.Condition()
+        self.admitted = dict()  # session_id -> (memory size, disk size)
+        self.requests = dict()  # session_id -> number of requests in handling
+        self.idle_since = dict()    # session_id -> time of the last request
+        self.waiting = list()   # session_id in arrival order
+
+    def _get_free_memory(self):
+        return psutil.virtual_memory().available
+
+    def _get_free_disk(self):
+        stat = os.statvfs(self.work_dir)
+        return stat.f_bavail * stat.f_frsize
+
+    def _fits(self, memory_size, disk_size):
+        if len(self.admitted) == 0:
+            return True
+        if len(self.admitted) >= self.max_sessions:
+            return False
+        reserved_memory = sum([memory for (memory, disk) in self.admitted.values()])
+        reserved_disk = sum([disk for (memory, disk) in self.admitted.values()])
+        if reserved_memory + memory_size > self.memory_budget or \
+                memory_size > self._get_free_memory():
+            return False
+        if reserved_disk + disk_size > self.disk_budget or \
+                disk_size > self._get_free_disk():
+            return False
+        return True
+
+    def admit(self, session_id, memory_size, disk_size, wait_callback=None):
+        '''block until the session is admitted
+        wait_callback(position) is called whenever the position in the
+        waiting queue changes. Exception from it cancels the request
+        '''
+        with self.condition:
+            self.waiting.append(session_id)
+        is_admitted = False
+        last_position = None
+        try:
+            while True:
+                with self.condition:
+                    position = self.waiting.index(session_id) + 1
+                    if position == 1 and self._fits(memory_size, disk_size):
+                        self.waiting.remove(session_id)
+                        self.admitted[session_id] = (memory_size, disk_size)
+                        self.requests[session_id] = 1
+                        self.idle_since[session_id] = time.time()
+                        is_admitted = True
+                        self.condition.notify_all()
+                        return
+                    expired_list = list()
+                    if position == 1:
+                        expired_list = self._pop_idle_sessions()
+                if len(expired_list) > 0:
+                    for expired_id in expired_list:
+                        self._expire(expired_id)
+                    continue
+                if wait_callback != None and position != last_position:
+                    wait_callback(position)
+                    last_position = position
+                with self.condition:
+                    self.condition.wait(AdmissionController.WAIT_INTERVAL)
+        finally:
+            if not is_admitted:
+                with self.condition:
+                    if session_id in self.waiting:
+                        self.waiting.remove(session_id)
+                    self.condition.notify_all()
+
+    def _pop_idle_sessions(self):
+        # expired sessions are marked busy so that no one else expires them
+        if not self.idle_timeout or self.expire_callback == None:
+            return list()
+        now = time.time()
+        expired_list = [session_id for (session_id, idle_since) \
+                in self.idle_since.items() if self.requests[session_id] == 0 \
+                and now - idle_since >= self.idle_timeout]
+        for session_id in expired_list:
+            self.requests[session_id] += 1
+        return expired_list
+
+    def _expire(self, session_id):
+        LOG.warning("Session %s is idle for %d seconds. Expire it" % \
+                (str(session_id), self.idle_timeout))
+        try:
+            self.expire_callback(session_id)
+        except Exception as e:
+            LOG.warning("Failed to expire Session %s : %s" % \
+                    (str(session_id), str(e)))
+        finally:
+            self.release(session_id)
+
+    def begin_request(self, session_id):
+        with self.condition:
+            if session_id in self.requests:
+                self.requests[session_id] += 1
+
+    def end_request(self, session_id):
+        with self.condition:
+            if session_id in self.requests:
+                self.requests[session_id] = max(0, self.requests[session_id]-1)
+                self.idle_since[session_id] = time.time()
+
+    def release(self, session_id):
+        with self.condition:
+            self.requests.pop(session_id, None)
+            self.idle_since.pop(session_id, None)
+            if self.admitted.pop(session_id, None) != None:
+                self.condition.notify_all()
+
+
+class BackgroundWorker(threading.Thread):
+    ''' Run tasks off the path of synthesis sessions, such as saving
+    recovered images to caches. Tasks run one at a time in submitted order.
+    '''
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.tasks = collections.deque()
+        threading.Thread.__init__(self, target=self.run_tasks)
+        self.daemon = True
+
+    def submit(self, task):
+        with self.condition:
+            self.tasks.append(task)
+            self.condition.notify()
+
+    def run_tasks(self):
+        while True:
+            with self.condition:
+                while len(self.tasks) == 0:
+                    self.condition.wait()
+                task = self.tasks.popleft()
+            try:
+                task()
+            except Exception as e:
+                LOG.warning("Background task failed : %s" % str(e))
+
 
 def wrap_process_fault(function):
     """Wraps a method to catch exceptions related to instances.
@@ -150,11 +324,287 @@ class NetworkUtil(object):
         return msgpack.unpackb(data)
 
 
+class BlobScheduler(object):
+    ''' Decide which overlay blob to request next from the client
+    Blobs demanded by the VM are requested before the sequential order.
+    Bytes in flight are limited by bandwidth-delay product measured from
+    received blobs: round trip time is the minimum delay until the header
+    of a requested blob arrives, and bandwidth is a moving average of
+    delivery rate. All state is local to the process.
+    '''
+    MIN_WINDOW          = 1024*512      # 512 KB
+    MAX_WINDOW          = 1024*1024*64  # 64 MB
+    WINDOW_GAIN         = 2.0           # window over bandwidth-delay product
+    BW_WEIGHT           = 0.3           # weight of new bandwidth sample
+
+    def __init__(self, blob_urls, blob_sizes):
+        self.blob_sizes = dict(blob_sizes)
+        self.sequential = collections.deque(blob_urls)
+        self.urgent = collections.deque()
+        self.pending = set(blob_urls)
+        self.total_count = len(self.pending)
+        self.finished = set()
+        self.request_time = dict()  # blob url -> requested time
+        self.in_flight_size = 0
+        self.min_rtt = None
+        self.bandwidth = None       # bytes per second
+        self.last_delivery_time = None
+        self.out_of_order_count = 0
+
+    def is_finished(self):
+        return len(self.finished) == self.total_count
+
+    def get_window(self):
+        if self.min_rtt == None or self.bandwidth == None:
+            return BlobScheduler.MIN_WINDOW
+        window = self.bandwidth * self.min_rtt * BlobScheduler.WINDOW_GAIN
+        return int(min(max(window, BlobScheduler.MIN_WINDOW),
+                BlobScheduler.MAX_WINDOW))
+
+    def demand(self, blob_url):
+        if blob_url in self.pending:
+            self.urgent.append(blob_url)
+
+    def _pop_next(self, candidates):
+        while len(candidates) > 0:
+            blob_url = candidates.popleft()
+            if blob_url in self.pending:
+                return blob_url
+        return None
+
+    def next_request(self):
+        '''return blob to request or None
+        Urgent blob is requested regardless of the window
+        '''
+        blob_url = self._pop_next(self.urgent)
+        if blob_url != None:
+            self.out_of_order_count += 1
+        elif self.in_flight_size < self.get_window():
+            blob_url = self._pop_next(self.sequential)
+        if blob_url != None:
+            self.pending.discard(blob_url)
+            self.request_time[blob_url] = time.time()
+            self.in_flight_size += self.blob_sizes.get(blob_url, 0)
+        return blob_url
+
+    def on_header(self, blob_url):
+        # delay until the header arrives while nothing was ahead of it
+        # is the closest sample to round trip time
+        now = time.time()
+        request_time = self.request_time.get(blob_url, now)
+        if self.last_delivery_time == None or \
+                self.last_delivery_time < request_time:
+            rtt = now - request_time
+            if self.min_rtt == None or rtt < self.min_rtt:
+                self.min_rtt = rtt
+            # link was idle, so delivery of this blob starts now
+            self.last_delivery_time = now
+
+    def on_received(self, blob_url, blob_size):
+        now = time.time()
+        self.request_time.pop(blob_url, None)
+        self.in_flight_size -= self.blob_sizes.get(blob_url, 0)
+        self.finished.add(blob_url)
+        elapsed = now - self.last_delivery_time
+        if elapsed > 0:
+            sample = blob_size / elapsed
+            if self.bandwidth == None:
+                self.bandwidth = sample
+            else:
+                self.bandwidth = (1-BlobScheduler.BW_WEIGHT)*self.bandwidth + \
+                        BlobScheduler.BW_WEIGHT*sample
+        self.last_delivery_time = now
+
+
+class ChunkInjector(object):
+    ''' Find chunks of overlay that Cloudlet can reconstruct by itself
+    A chunk is reconstructed from zero chunk, base VM or chunk store. When
+    every chunk of a frame can be reconstructed, the client does not send
+    the frame and its delta items are made here instead.
+    Chunk hashes of overlay (blob name -> sha256 list of each frame) are
+    sent by the client. Bitmap has a bit for each of them in the order of
+    blobs at overlay meta, frames and chunks in the frame, with the most
+    significant bit of each byte first.
+    '''
+    def __init__(self, chunk_store, base_memmeta, base_diskmeta):
+        self.chunk_store = chunk_store
+        self.chunk_size = Cloudlet_Const.CHUNK_SIZE
+        self.zero_hash = sha256(chr(0x00)*self.chunk_size).digest()
+        self.base_mem_index = None
+        self.base_disk_index = None
+        if os.path.exists(base_memmeta):
+            self.base_mem_index = hashindex.load_memory_index(base_memmeta)
+        if os.path.exists(base_diskmeta):
+            self.base_disk_index = hashindex.load_disk_index(base_diskmeta)
+        self.references = dict()    # sha256 -> (ref_id, reference)
+        self.segment_fds = dict()   # segment path -> opened file
+
+    def _find_base(self, hash_value):
+        # return (ref_id, offset) to reconstruct from base VM or None
+        if hash_value == self.zero_hash:
+            return (DeltaItem.REF_ZEROS, None)
+        for (base_index, ref_id) in ((self.base_mem_index, DeltaItem.REF_BASE_MEM),
+                (self.base_disk_index, DeltaItem.REF_BASE_DISK)):
+            if base_index == None:
+                continue
+            found = base_index.find(hash_value)
+            if found != None and found[1] == self.chunk_size:
+                return (ref_id, found[0])
+        return None
+
+    def _find(self, hash_value):
+        if hash_value in self.references:
+            return True
+        reference = self._find_base(hash_value)
+        if reference == None and self.chunk_store != None:
+            location = self.chunk_store.locate(hash_value)
+            if location != None:
+                # open segment now, so that it can be read after eviction
+                segment_path = location[0]
+                if segment_path not in self.segment_fds:
+                    self.segment_fds[segment_path] = open(segment_path, "rb")
+                reference = (DeltaItem.REF_RAW, location)
+        if reference == None:
+            return False
+        self.references[hash_value] = reference
+        return True
+
+    def negotiate(self, meta_info, chunk_hashes, excluded_urls):
+        '''return (bitmap, pruned frames)
+        pruned frames : blob url -> list of (frame index, frame info,
+            memory chunks, disk chunks, chunk hashes) not to be sent by
+            the client
+        '''
+        bitmap = bytearray()
+        bit_count = 0
+        pruned_frames = dict()
+        for blob in meta_info[Cloudlet_Const.META_OVERLAY_FILES]:
+            url = blob[Cloudlet_Const.META_OVERLAY_FILE_NAME]
+            for (frame_index, frame, memory_chunks, disk_chunks) in \
+                    get_blob_frames(blob):
+                hash_list = get_frame_hashes(chunk_hashes, url, frame_index)
+                if len(hash_list) == 0:
+                    continue
+                # frame of mismatched hashes is not pruned, but its bits
+                # are counted as the client does
+                is_pruned = url not in excluded_urls and \
+                        len(hash_list) == len(memory_chunks) + len(disk_chunks)
+                for hash_value in hash_list:
+                    if bit_count % 8 == 0:
+                        bitmap.append(0)
+                    if is_pruned and self._find(hash_value):
+                        bitmap[-1] |= 0x80 >> (bit_count % 8)
+                    else:
+                        is_pruned = False
+                    bit_count += 1
+                if is_pruned:
+                    pruned_frames.setdefault(url, list()).append((frame_index,
+                        frame, memory_chunks, disk_chunks, hash_list))
+        return str(bitmap), pruned_frames
+
+    def get_pruned_indexes(self, pruned_frames):
+        # index of delta items made here, which are not self referenced
+        pruned_indexes = set()
+        for frame_plans in pruned_frames.itervalues():
+            for (frame_index, frame, memory_chunks, disk_chunks, hash_list) in \
+                    frame_plans:
+                for chunk in memory_chunks:
+                    pruned_indexes.add(DeltaItem.get_index(DeltaItem.DELTA_MEMORY,
+                        chunk*self.chunk_size))
+                for chunk in disk_chunks:
+                    pruned_indexes.add(DeltaItem.get_index(DeltaItem.DELTA_DISK,
+                        chunk*self.chunk_size))
+        return pruned_indexes
+
+    def get_delta_items(self, frame_plan):
+        # return serialized delta items of a pruned frame
+        (frame_index, frame, memory_chunks, disk_chunks, hash_list) = frame_plan
+        chunk_list = [(DeltaItem.DELTA_MEMORY, chunk) for chunk in memory_chunks] + \
+                [(DeltaItem.DELTA_DISK, chunk) for chunk in disk_chunks]
+        data_list = list()
+        for (delta_type, chunk), hash_value in itertools.izip(chunk_list, hash_list):
+            ref_id, reference = self.references[hash_value]
+            offset = chunk*self.chunk_size
+            if ref_id == DeltaItem.REF_RAW:
+                (segment_path, chunk_offset, length) = reference
+                segment_fd = self.segment_fds[segment_path]
+                segment_fd.seek(chunk_offset)
+                data = segment_fd.read(length)
+                if sha256(data).digest() != hash_value:
+                    msg = "Corrupted chunk at chunk store: %s" % segment_path
+                    raise RapidSynthesisError(msg)
+                delta_item = DeltaItem(delta_type, offset, self.chunk_size,
+                        hash_value, ref_id, len(data), data)
+            elif ref_id == DeltaItem.REF_ZEROS:
+                delta_item = DeltaItem(delta_type, offset, self.chunk_size,
+                        hash_value, ref_id)
+            else:
+                delta_item = DeltaItem(delta_type, offset, self.chunk_size,
+                        hash_value, ref_id, 8, reference)
+            data_list.append(delta_item.get_serialized())
+        return ''.join(data_list)
+
+    def _is_known(self, hash_value):
+        return self.chunk_store.has_chunk(hash_value) or \
+                self._find_base(hash_value) != None
+
+    def iter_new_chunks(self, meta_info, launch_disk, launch_mem,
+            chunk_hashes=None):
+        # (sha256, data) of recovered chunks that cannot be reconstructed
+        # from base VM or chunk store. Chunks without hash from the client
+        # are read and hashed here
+        launch_fds = {DeltaItem.DELTA_MEMORY: open(launch_mem, "rb"),
+                DeltaItem.DELTA_DISK: open(launch_disk, "rb")}
+        try:
+            for blob in meta_info[Cloudlet_Const.META_OVERLAY_FILES]:
+                url = blob[Cloudlet_Const.META_OVERLAY_FILE_NAME]
+                for (frame_index, frame, memory_chunks, disk_chunks) in \
+                        get_blob_frames(blob):
+                    chunk_list = [(DeltaItem.DELTA_MEMORY, chunk) for chunk in memory_chunks] + \
+                            [(DeltaItem.DELTA_DISK, chunk) for chunk in disk_chunks]
+                    hash_list = get_frame_hashes(chunk_hashes, url, frame_index)
+                    if len(hash_list) != len(chunk_list):
+                        hash_list = [None]*len(chunk_list)
+                    for (delta_type, chunk), hash_value in itertools.izip(chunk_list, hash_list):
+                        if hash_value != None and self._is_known(hash_value):
+                            continue
+                        launch_fds[delta_type].seek(chunk*self.chunk_size)
+                        data = launch_fds[delta_type].read(self.chunk_size)
+                        if len(data) != self.chunk_size:
+                            continue
+                        data_hash = sha256(data).digest()
+                        if hash_value == None and self._is_known(data_hash):
+                            continue
+                        if hash_value == None or data_hash == hash_value:
+                            yield (data_hash, data)
+        finally:
+            for launch_fd in launch_fds.itervalues():
+                launch_fd.close()
+
+    def close(self):
+        for base_index in (self.base_mem_index, self.base_disk_index):
+            if base_index != None:
+                base_index.close()
+        self.base_mem_index = None
+        self.base_disk_index = None
+        for segment_fd in self.segment_fds.itervalues():
+            segment_fd.close()
+        self.segment_fds.clear()
+
+
 class NetworkStepThread(threading.Thread):
-    MAX_REQUEST_SIZE = 1024*512 # 512 KB
 
     def __init__(self, network_handler, overlay_urls, overlay_urls_size, 
-            demanding_queue, out_queue, time_queue, chunk_size):
+            demanding_queue, out_queue, time_queue, chunk_size,
+            cached_blobs=None, blob_cache=None, blob_digests=None,
+            pruned_frames=None, chunk_injector=None):
+        # cached_blobs: blob url -> opened file of cached blob, which is
+        #   read locally instead of requesting to the client
+        # blob_cache, blob_digests: received blob is saved at blob_cache
+        #   if its digest (blob url -> sha256) is known
+        # pruned_frames: blob url -> frames the client does not send.
+        #   Their delta items are made by chunk_injector. Blob of size 0 at
+        #   overlay_urls_size is not requested at all
         self.network_handler = network_handler
         self.read_stream = network_handler.rfile
         self.overlay_urls = overlay_urls
@@ -163,60 +613,103 @@ class NetworkStepThread(threading.Thread):
         self.out_queue = out_queue
         self.time_queue = time_queue
         self.chunk_size = chunk_size
+        self.cached_blobs = cached_blobs or dict()
+        self.blob_cache = blob_cache
+        self.blob_digests = blob_digests or dict()
+        self.pruned_frames = pruned_frames or dict()
+        self.chunk_injector = chunk_injector
         threading.Thread.__init__(self, target=self.receive_overlay_blobs)
 
     def exception_handler(self):
         self.out_queue.put(Synthesis_Const.ERROR_OCCURED)
         self.time_queue.put({'start_time':-1, 'end_time':-1, "bw_mbps":0})
 
+    def _read_cached_blob(self, blob_url, blob_fd):
+        self.out_queue.put((Synthesis_Const.BLOB_BEGIN, blob_url))
+        read_count = 0
+        try:
+            while True:
+                chunk = blob_fd.read(self.chunk_size)
+                if not chunk:
+                    break
+                self.out_queue.put(chunk)
+                read_count += len(chunk)
+        finally:
+            blob_fd.close()
+        return read_count
+
+    def _inject_frames(self, blob_url):
+        # delta items of pruned frames are placed before the compressed
+        # data of the blob
+        injected_size = 0
+        for frame_plan in self.pruned_frames.get(blob_url, list()):
+            delta_items = self.chunk_injector.get_delta_items(frame_plan)
+            self.out_queue.put((Synthesis_Const.DELTA_ITEMS, delta_items))
+            injected_size += len(delta_items)
+        return injected_size
+
+    def _request_blobs(self, scheduler):
+        # pass demanded blobs to scheduler and send requests it allows
+        while True:
+            try:
+                # client sends the entire blob, so frame is not used
+                demanding_url, frame_index = self.demanding_queue.get_nowait()
+            except Empty:
+                break
+            scheduler.demand(demanding_url)
+
+        while True:
+            requesting_overlay = scheduler.next_request()
+            if requesting_overlay == None:
+                break
+            message = NetworkUtil.encoding({
+                Protocol.KEY_COMMAND : Protocol.MESSAGE_COMMAND_ON_DEMAND,
+                Protocol.KEY_REQUEST_SEGMENT:requesting_overlay
+                })
+            message_size = struct.pack("!I", len(message))
+            self.network_handler.request.send(message_size)
+            self.network_handler.wfile.write(message)
+            self.network_handler.wfile.flush()
+
     @wrap_process_fault
     def receive_overlay_blobs(self):
+        # received blobs are written to the cache off the transfer path
+        cache_thread = None
+        if self.blob_cache != None:
+            cache_thread = BlobCacheWriteThread(self.blob_cache)
+            cache_thread.start()
+        try:
+            self._receive_overlay_blobs(cache_thread)
+        finally:
+            if cache_thread != None:
+                cache_thread.finish()
+
+    def _receive_overlay_blobs(self, cache_thread):
         total_read_size = 0
         counter = 0
-        index = 0 
-        finished_url = dict()
-        requesting_list = list()
-        out_of_order_count = 0
+        cached_read_size = 0
+        cached_count = len(self.cached_blobs)
+        injected_size = 0
+        scheduler = BlobScheduler([url for url in self.overlay_urls \
+                if url not in self.cached_blobs and \
+                self.overlay_urls_size[url] > 0],
+                dict(self.overlay_urls_size.items()))
         total_urls_count = len(self.overlay_urls)
         start_time = time.time()
 
-        while len(finished_url) < total_urls_count:
-            #request to client until it becomes more than MAX_REQUEST_SIZE
-            while True:
-                requesting_size = sum([self.overlay_urls_size[item] for item in requesting_list])
-                if requesting_size > self.MAX_REQUEST_SIZE or len(self.overlay_urls) == 0:
-                    # Enough requesting list or nothing left to request
-                    break;
-
-                # find overlay to request
-                urgent_overlay_url = None
-                while not self.demanding_queue.empty():
-                    # demanding_queue can have multiple same request
-                    demanding_url = self.demanding_queue.get()
-                    if (finished_url.get(demanding_url, False) == False) and \
-                            (demanding_url not in requesting_list):
-                        urgent_overlay_url = demanding_url
-                        break
-
-                requesting_overlay = None
-                if urgent_overlay_url != None:
-                    requesting_overlay = urgent_overlay_url
-                    out_of_order_count += 1
-                    if requesting_overlay in self.overlay_urls:
-                        self.overlay_urls.remove(requesting_overlay)
-                else:
-                    requesting_overlay = self.overlay_urls.pop(0)
-
-                # request overlay blob to client
-                message = NetworkUtil.encoding({
-                    Protocol.KEY_COMMAND : Protocol.MESSAGE_COMMAND_ON_DEMAND,
-                    Protocol.KEY_REQUEST_SEGMENT:requesting_overlay
-                    })
-                message_size = struct.pack("!I", len(message))
-                self.network_handler.request.send(message_size)
-                self.network_handler.wfile.write(message)
-                self.network_handler.wfile.flush()
-                requesting_list.append(requesting_overlay)
+        # cached blobs are read while the client sends requested blobs
+        self._request_blobs(scheduler)
+        for blob_url in self.overlay_urls:
+            blob_fd = self.cached_blobs.pop(blob_url, None)
+            if blob_fd != None:
+                cached_read_size += self._read_cached_blob(blob_url, blob_fd)
+            elif self.overlay_urls_size[blob_url] == 0:
+                # every frame of the blob is pruned
+                self.out_queue.put((Synthesis_Const.BLOB_BEGIN, blob_url))
+                injected_size += self._inject_frames(blob_url)
+
+        while not scheduler.is_finished():
+            self._request_blobs(scheduler)
 
             # read header
             blob_header_size = struct.unpack("!I", self.read_stream.read(4))[0]
@@ -230,9 +723,15 @@ class NetworkStepThread(threading.Thread):
             blob_url = blob_header.get(Protocol.KEY_REQUEST_SEGMENT, None)
             if blob_size == 0 or blob_url == None:
                 raise RapidSynthesisError("Invalid header for overlay segment")
-
-            finished_url[blob_url] = True
-            requesting_list.remove(blob_url)
+            scheduler.on_header(blob_url)
+            is_caching = False
+            blob_digest = self.blob_digests.get(blob_url, None)
+            if cache_thread != None and blob_digest != None and \
+                    blob_url not in self.pruned_frames:
+                is_caching = cache_thread.begin(blob_url, blob_digest)
+
+            self.out_queue.put((Synthesis_Const.BLOB_BEGIN, blob_url))
+            injected_size += self._inject_frames(blob_url)
             read_count = 0
             while read_count < blob_size:
                 read_min_size = min(self.chunk_size, blob_size-read_count)
@@ -240,15 +739,23 @@ class NetworkStepThread(threading.Thread):
                 read_size = len(chunk)
                 if chunk:
                     self.out_queue.put(chunk)
+                    if is_caching:
+                        is_caching = cache_thread.write(blob_url, chunk)
                 else:
                     break
 
                 counter += 1
                 read_count += read_size
+                # request demanded blob without waiting for the end of blob
+                self._request_blobs(scheduler)
             total_read_size += read_count
-            index += 1
+            scheduler.on_received(blob_url, read_count)
+            if is_caching and read_count == blob_size:
+                cache_thread.commit(blob_url)
 
         self.out_queue.put(Synthesis_Const.END_OF_FILE)
+        if self.chunk_injector != None:
+            self.chunk_injector.close()
         end_time = time.time()
         time_delta= end_time-start_time
 
@@ -259,8 +766,14 @@ class NetworkStepThread(threading.Thread):
 
         self.time_queue.put({'start_time':start_time, 'end_time':end_time, "bw_mbps":bw})
         LOG.info("[Transfer] out-of-order fetching : %d / %d == %5.2f %%" % \
-                (out_of_order_count, total_urls_count, \
-                100.0*out_of_order_count/total_urls_count))
+                (scheduler.out_of_order_count, total_urls_count, \
+                100.0*scheduler.out_of_order_count/max(total_urls_count, 1)))
+        LOG.info("[Transfer] request window : %d bytes" % scheduler.get_window())
+        LOG.info("[Transfer] cached blobs : %d / %d (%d bytes)" % \
+                (cached_count, total_urls_count, cached_read_size))
+        LOG.info("[Transfer] pruned frames : %d (%d bytes of delta items)" % \
+                (sum([len(frames) for frames in self.pruned_frames.itervalues()]),
+                injected_size))
         try:
             LOG.info("[Transfer] : (%s)~(%s)=(%s) (%d loop, %d bytes, %lf Mbps)" % \
                     (start_time, end_time, (time_delta),\
@@ -273,17 +786,26 @@ class NetworkStepThread(threading.Thread):
 
 
 class DecompStepProc(Process):
-    def __init__(self, input_queue, output_path, time_queue, temp_overlay_file=None):
+    def __init__(self, input_queue, output_path, time_queue, temp_overlay_file=None,
+            blob_codecs=None):
+        # blob_codecs: blob name -> codec name. Blob data follows
+        # (BLOB_BEGIN, blob name) marker at input_queue
         self.input_queue = input_queue
         self.time_queue = time_queue
         self.output_path = output_path
-        self.decompressor = LZMADecompressor()
+        self.blob_codecs = blob_codecs or dict()
+        self.decompressor = codec.get_decompressor(codec.Codec.XZ)
         self.temp_overlay_file = temp_overlay_file
         Process.__init__(self, target=self.decompress_blobs)
 
     def exception_handler(self):
         LOG.error("decompress step error")
 
+    def _write_output(self, decomp_chunk):
+        self.output_queue.write(decomp_chunk)
+        if self.temp_overlay_file:
+            self.temp_overlay_file.write(decomp_chunk)
+
     @wrap_process_fault
     def decompress_blobs(self):
         self.output_queue = open(self.output_path, "w")
@@ -297,20 +819,28 @@ class DecompStepProc(Process):
                 break
             if chunk == Synthesis_Const.ERROR_OCCURED:
                 break;
+            if type(chunk) == tuple and chunk[0] == Synthesis_Const.BLOB_BEGIN:
+                # new blob starts. Finish previous one and switch codec
+                self._write_output(self.decompressor.flush())
+                codec_name = self.blob_codecs.get(chunk[1], codec.Codec.XZ)
+                self.decompressor = codec.get_decompressor(codec_name)
+                self.input_queue.task_done()
+                continue
+            if type(chunk) == tuple and chunk[0] == Synthesis_Const.DELTA_ITEMS:
+                # delta items made at Cloudlet right after a blob begins
+                self._write_output(chunk[1])
+                self.input_queue.task_done()
+                continue
             data_size = data_size + len(chunk)
             decomp_chunk = self.decompressor.decompress(chunk)
 
             self.input_queue.task_done()
-            self.output_queue.write(decomp_chunk)
+            self._write_output(decomp_chunk)
             counter = counter + 1
-            if self.temp_overlay_file:
-                self.temp_overlay_file.write(decomp_chunk)
 
-        decomp_chunk = self.decompressor.flush()
-        self.output_queue.write(decomp_chunk)
+        self._write_output(self.decompressor.flush())
         self.output_queue.close()
         if self.temp_overlay_file:
-            self.temp_overlay_file.write(decomp_chunk)
             self.temp_overlay_file.close()
 
         end_time = time.time()
@@ -324,9 +854,13 @@ class URLFetchStep(threading.Thread):
     MAX_REQUEST_SIZE = 1024*512 # 512 KB
 
     def __init__(self, overlay_package, overlay_files, overlay_files_size, 
-            demanding_queue, out_queue, time_queue, chunk_size):
+            demanding_queue, out_queue, time_queue, chunk_size,
+            overlay_frames=None):
+        # overlay_frames: blob name -> list of frame info at overlay meta.
+        # Only the frame of a demanded chunk is fetched if blob has frames
         self.overlay_files = overlay_files
         self.overlay_files_size = overlay_files_size
+        self.overlay_frames = overlay_frames or dict()
         self.overlay_package = overlay_package
         self.demanding_queue = demanding_queue
         self.out_queue = out_queue
@@ -338,11 +872,46 @@ class URLFetchStep(threading.Thread):
         self.out_queue.put(Synthesis_Const.ERROR_OCCURED)
         self.time_queue.put({'start_time':-1, 'end_time':-1, "bw_mbps":0})
 
+    def _fetch_blob(self, blob_url, offset=0, size=None):
+        # send (offset, size) range of the blob to decompressor
+        self.out_queue.put((Synthesis_Const.BLOB_BEGIN, blob_url))
+        read_count = 0
+        for chunk in self.overlay_package.iter_blob(blob_url, \
+                self.chunk_size, offset=offset, size=size):
+            if not chunk:
+                break
+            self.out_queue.put(chunk)
+            read_count += len(chunk)
+        return read_count
+
+    def _fetch_frames(self, blob_url, frame_indexes):
+        # fetch frames with a range request for each contiguous frames
+        frames = self.overlay_frames[blob_url]
+        read_count = 0
+        range_start = None
+        range_end = None
+        for frame_index in sorted(frame_indexes):
+            frame = frames[frame_index]
+            frame_offset = frame[Cloudlet_Const.META_FRAME_OFFSET]
+            frame_size = frame[Cloudlet_Const.META_FRAME_SIZE]
+            if range_end != None and frame_offset != range_end:
+                read_count += self._fetch_blob(blob_url, range_start,
+                        range_end-range_start)
+                range_start = None
+            if range_start == None:
+                range_start = frame_offset
+            range_end = frame_offset + frame_size
+        if range_start != None:
+            read_count += self._fetch_blob(blob_url, range_start,
+                    range_end-range_start)
+        return read_count
+
     @wrap_process_fault
     def receive_overlay_blobs(self):
         total_read_size = 0
         counter = 0
         finished_url = dict()
+        finished_frames = dict()    # blob name -> set of fetched frames
         out_of_order_count = 0
         total_urls_count = len(self.overlay_files)
         start_time = time.time()
@@ -350,35 +919,46 @@ class URLFetchStep(threading.Thread):
         while len(finished_url) < total_urls_count:
             # find overlay blob for on-demand request
             urgent_overlay_url = None
+            urgent_frame_index = None
             while not self.demanding_queue.empty():
                 # demanding_queue can have multiple same request
-                demanding_url = self.demanding_queue.get()
-                if (finished_url.get(demanding_url, False) == False):
-                    urgent_overlay_url = demanding_url
-                    break
+                demanding_url, frame_index = self.demanding_queue.get()
+                if finished_url.get(demanding_url, False) == True:
+                    continue
+                if frame_index in finished_frames.get(demanding_url, set()):
+                    continue
+                urgent_overlay_url = demanding_url
+                urgent_frame_index = frame_index
+                break
 
             requesting_overlay = None
             if urgent_overlay_url != None:
                 requesting_overlay = urgent_overlay_url
                 out_of_order_count += 1
-                if requesting_overlay in self.overlay_files:
-                    self.overlay_files.remove(requesting_overlay)
             else:
-                requesting_overlay = self.overlay_files.pop(0)
+                requesting_overlay = self.overlay_files[0]
 
-            finished_url[requesting_overlay] = True
-            read_count = 0
-            for chunk in self.overlay_package.iter_blob(requesting_overlay, \
-                    self.chunk_size):
-                read_size = len(chunk)
-                if chunk:
-                    self.out_queue.put(chunk)
+            frames = self.overlay_frames.get(requesting_overlay, None)
+            if not frames:
+                # blob without frame is fetched at once
+                total_read_size += self._fetch_blob(requesting_overlay)
+                finished_url[requesting_overlay] = True
+            else:
+                fetched = finished_frames.setdefault(requesting_overlay, set())
+                if urgent_frame_index != None:
+                    requesting_frames = [urgent_frame_index]
                 else:
-                    break
-                read_count += read_size
-
-            # request overlay blob
-            total_read_size += read_count
+                    requesting_frames = [index for index in xrange(len(frames)) \
+                            if index not in fetched]
+                total_read_size += self._fetch_frames(requesting_overlay,
+                        requesting_frames)
+                fetched.update(requesting_frames)
+                if len(fetched) == len(frames):
+                    finished_url[requesting_overlay] = True
+            if finished_url.get(requesting_overlay, False) and \
+                    requesting_overlay in self.overlay_files:
+                self.overlay_files.remove(requesting_overlay)
+            counter += 1
 
         self.out_queue.put(Synthesis_Const.END_OF_FILE)
         end_time = time.time()
@@ -410,6 +990,14 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
             Protocol.SYNTHESIS_OPTION_EARLY_START : False,
             Protocol.SYNTHESIS_OPTION_SHOW_STATISTICS : False
             }
+    CHUNK_STORE_BATCH   = 1024  # chunks added to chunk store at once
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        # requests are handled concurrently, so client option should not
+        # change the default option of the class
+        self.synthesis_option = dict(SynthesisHandler.synthesis_option)
+        self.session_id = None
 
     def ret_fail(self, message):
         LOG.error("%s" % str(message))
@@ -434,6 +1022,30 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
         self.wfile.write(message)
         self.wfile.flush()
 
+    def send_waiting(self, position):
+        message = NetworkUtil.encoding({
+            Protocol.KEY_COMMAND : Protocol.MESSAGE_COMMAND_WAITING,
+            Protocol.KEY_WAIT_POSITION : position,
+            })
+        LOG.info("Session %s is waiting at position %d" % \
+                (str(self.session_id), position))
+        message_size = struct.pack("!I", len(message))
+        self.request.send(message_size)
+        self.wfile.write(message)
+        self.wfile.flush()
+
+    def _wait_admission(self, session_id, meta_info):
+        # memory of the resumed VM and disk for the recovered chunks
+        memory_size = meta_info.get(Cloudlet_Const.META_RESUME_VM_MEMORY_SIZE, 0)
+        chunk_count = 0
+        for blob in meta_info[Cloudlet_Const.META_OVERLAY_FILES]:
+            chunk_count += len(blob[Cloudlet_Const.META_OVERLAY_FILE_MEMORY_CHUNKS])
+            chunk_count += len(blob[Cloudlet_Const.META_OVERLAY_FILE_DISK_CHUNKS])
+        disk_size = chunk_count * Cloudlet_Const.CHUNK_SIZE
+        self.session_id = session_id
+        self.server.admission.admit(session_id, memory_size, disk_size,
+                wait_callback=self.send_waiting)
+
     def send_synthesis_done(self):
         message = NetworkUtil.encoding({
             Protocol.KEY_COMMAND : Protocol.MESSAGE_COMMAND_SYNTHESIS_DONE,
@@ -473,6 +1085,159 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
                     header_info = header
         return [requested_base, header_info]
 
+    def _open_cached_blobs(self, meta_info):
+        # return dict of blob url -> opened file of cached blob
+        cached_blobs = dict()
+        if self.server.blob_cache == None:
+            return cached_blobs
+        for blob in meta_info[Cloudlet_Const.META_OVERLAY_FILES]:
+            digest = blob.get(Cloudlet_Const.META_OVERLAY_FILE_SHA256, None)
+            if digest == None:
+                continue
+            blob_fd = self.server.blob_cache.open_blob(digest)
+            if blob_fd != None:
+                url = blob[Cloudlet_Const.META_OVERLAY_FILE_NAME]
+                cached_blobs[url] = blob_fd
+        return cached_blobs
+
+    def _get_launch_images(self, meta_info):
+        # return copy of cached launch images (disk, memory) or None
+        if self.server.launch_cache == None:
+            return None
+        overlay_digest = get_overlay_digest(meta_info)
+        if overlay_digest == None:
+            return None
+        base_hashvalue = meta_info.get(Cloudlet_Const.META_BASE_VM_SHA256, None)
+        launch_disk = tempfile.NamedTemporaryFile(prefix="cloudlet-launch-disk-", delete=False)
+        launch_mem = tempfile.NamedTemporaryFile(prefix="cloudlet-launch-mem-", delete=False)
+        launch_disk.close()
+        launch_mem.close()
+        if self.server.launch_cache.get_launch_images(base_hashvalue,
+                overlay_digest, launch_disk.name, launch_mem.name):
+            LOG.info("Found cached launch images of overlay %s" % overlay_digest)
+            return (launch_disk.name, launch_mem.name)
+        os.unlink(launch_disk.name)
+        os.unlink(launch_mem.name)
+        return None
+
+    def _save_launch_images(self, meta_info, launch_disk, launch_mem):
+        if self.server.launch_cache == None:
+            return
+        overlay_digest = get_overlay_digest(meta_info)
+        if overlay_digest == None:
+            return
+        base_hashvalue = meta_info.get(Cloudlet_Const.META_BASE_VM_SHA256, None)
+        if self.server.launch_cache.add_launch_images(base_hashvalue,
+                overlay_digest, launch_disk, launch_mem):
+            LOG.info("Cached launch images of overlay %s" % overlay_digest)
+
+    def _save_recovered(self, base_path, meta_info, launch_disk, launch_mem,
+            chunk_hashes=None):
+        # keep recovered images for later request of the same overlay and
+        # chunks for later overlays sharing them at background, not to
+        # delay the session
+        if self.server.launch_cache == None and self.server.chunk_store == None:
+            return
+        # pin images by hard links, since the session removes them at its end
+        pinned_paths = list()
+        try:
+            for path in (launch_disk, launch_mem):
+                pinned_path = tempfile.mktemp(dir=os.path.dirname(path),
+                        prefix=os.path.basename(path) + "-")
+                os.link(path, pinned_path)
+                pinned_paths.append(pinned_path)
+        except OSError as e:
+            LOG.warning("Cannot keep recovered images : %s" % str(e))
+            for pinned_path in pinned_paths:
+                os.unlink(pinned_path)
+            return
+
+        def save_recovered():
+            try:
+                self._save_launch_images(meta_info, *pinned_paths)
+                self._save_chunks(base_path, meta_info, *pinned_paths,
+                        chunk_hashes=chunk_hashes)
+            finally:
+                for pinned_path in pinned_paths:
+                    os.unlink(pinned_path)
+        self.server.background_worker.submit(save_recovered)
+
+    def _recv_chunk_hashes(self):
+        # client sends chunk hashes of overlay once SEND_META is accepted
+        # with chunk negotiation
+        message_size = struct.unpack("!I", NetworkUtil.recvall(self.request, 4))[0]
+        message = NetworkUtil.decoding(NetworkUtil.recvall(self.request, message_size))
+        if message.get(Protocol.KEY_COMMAND, None) != \
+                Protocol.MESSAGE_COMMAND_SEND_CHUNK_HASHES:
+            raise RapidSynthesisError("Expected chunk hashes, but got %s" % \
+                    str(message.get(Protocol.KEY_COMMAND, None)))
+        hashes_size = message.get(Protocol.KEY_CHUNK_HASHES_SIZE, 0)
+        return NetworkUtil.decoding(NetworkUtil.recvall(self.request, hashes_size))
+
+    def _negotiate_chunks(self, base_path, meta_info, chunk_hashes, excluded_urls):
+        # return (chunk injector, bitmap of chunks that Cloudlet can
+        # reconstruct, frames the client does not need to send)
+        (base_diskmeta, base_mem, base_memmeta) = \
+                Cloudlet_Const.get_basepath(base_path)
+        chunk_injector = ChunkInjector(self.server.chunk_store,
+                base_memmeta, base_diskmeta)
+        chunk_bitmap, pruned_frames = chunk_injector.negotiate(meta_info,
+                chunk_hashes, excluded_urls)
+        return chunk_injector, chunk_bitmap, pruned_frames
+
+    def _save_chunks(self, base_path, meta_info, launch_disk, launch_mem,
+            chunk_hashes=None):
+        # keep chunks of recovered overlay, which can be omitted by
+        # later overlays sharing them
+        if self.server.chunk_store == None:
+            return
+        (base_diskmeta, base_mem, base_memmeta) = \
+                Cloudlet_Const.get_basepath(base_path)
+        chunk_injector = ChunkInjector(self.server.chunk_store,
+                base_memmeta, base_diskmeta)
+        added_count = 0
+        try:
+            new_chunks = chunk_injector.iter_new_chunks(meta_info,
+                    launch_disk, launch_mem, chunk_hashes=chunk_hashes)
+            while True:
+                # add in batches not to hold the store lock for long
+                chunk_list = list(itertools.islice(new_chunks,
+                    SynthesisHandler.CHUNK_STORE_BATCH))
+                if len(chunk_list) == 0:
+                    break
+                added_count += self.server.chunk_store.add_chunks(chunk_list)
+        except (IOError, OSError) as e:
+            LOG.warning("Cannot save chunks to chunk store : %s" % str(e))
+        finally:
+            chunk_injector.close()
+        LOG.info("Added %d chunks to chunk store" % added_count)
+
+    def _resume_launch_images(self, session_id, base_path, meta_info,
+            launch_images, overlay_db_entry):
+        # resume VM right away from cached launch images
+        launch_disk, launch_mem = launch_images
+        time_start_resume = time.time()
+        self.fuse = synthesis.launch_cached_VM(base_path, meta_info,
+                launch_disk, launch_mem, log=sys.stdout)
+        self.resumed_VM = synthesis.SynthesizedVM(launch_disk, launch_mem, self.fuse)
+        self.resumed_VM.start()
+        self.resumed_VM.join()
+        time_end_resume = time.time()
+        self.send_synthesis_done()
+        LOG.info("[Time] Resume from cached launch images : %f" % \
+                (time_end_resume-time_start_resume))
+
+        if self.synthesis_option.get(Protocol.SYNTHESIS_OPTION_DISPLAY_VNC, False):
+            synthesis.connect_vnc(self.resumed_VM.machine, no_wait=True)
+
+        s_resource = SessionResource(session_id)
+        s_resource.add(SessionResource.RESUMED_VM, self.resumed_VM)
+        s_resource.add(SessionResource.FUSE, self.fuse)
+        s_resource.add(SessionResource.OVERLAY_DB_ENTRY, overlay_db_entry)
+        with session_resources_lock:
+            session_resources[session_id] = s_resource
+        LOG.info("Resource is allocated for Session: %s" % str(session_id))
+
     def _handle_synthesis(self, message):
         LOG.info("\n\n----------------------- New Connection --------------")
         # check overlay meta info
@@ -481,7 +1246,34 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
         base_path, meta_info = self._check_validity(message)
         session_id = message.get(Protocol.KEY_SESSION_ID, None)
         if base_path and meta_info and meta_info.get(Cloudlet_Const.META_OVERLAY_FILES, None):
-            self.ret_success(Protocol.MESSAGE_COMMAND_SEND_META)
+            self._wait_admission(session_id, meta_info)
+            cached_blobs = dict()
+            launch_images = None
+            if message.get(Protocol.KEY_BLOB_CACHE, False) == True:
+                launch_images = self._get_launch_images(meta_info)
+                if launch_images == None:
+                    cached_blobs = self._open_cached_blobs(meta_info)
+            cached_urls = cached_blobs.keys()
+            if launch_images != None:
+                # nothing needs to be sent
+                cached_urls = [blob[Cloudlet_Const.META_OVERLAY_FILE_NAME] \
+                        for blob in meta_info[Cloudlet_Const.META_OVERLAY_FILES]]
+            payload = {Protocol.KEY_CACHED_BLOBS: cached_urls}
+            is_negotiating = launch_images == None and \
+                    message.get(Protocol.KEY_CHUNK_NEGOTIATION, False) == True
+            if is_negotiating:
+                payload[Protocol.KEY_CHUNK_NEGOTIATION] = True
+            self.ret_success(Protocol.MESSAGE_COMMAND_SEND_META, payload)
+            chunk_injector = None
+            chunk_hashes = None
+            pruned_frames = dict()
+            if is_negotiating:
+                chunk_hashes = self._recv_chunk_hashes()
+                chunk_injector, chunk_bitmap, pruned_frames = \
+                        self._negotiate_chunks(base_path, meta_info,
+                                chunk_hashes, cached_urls)
+                self.ret_success(Protocol.MESSAGE_COMMAND_SEND_CHUNK_HASHES,
+                        {Protocol.KEY_CHUNK_BITMAP: chunk_bitmap})
         else:
             self.ret_fail("No matching Base VM")
             return
@@ -489,19 +1281,32 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
         # update DB
         new_overlayvm = OverlayVM(session_id, base_path)
         self.server.dbconn.add_item(new_overlayvm)
+        if launch_images != None:
+            self._resume_launch_images(session_id, base_path, meta_info,
+                    launch_images, new_overlayvm)
+            return
 
         # start synthesis process
-        url_manager = Manager()
-        overlay_urls = url_manager.list()
-        overlay_urls_size = url_manager.dict()
+        overlay_urls = list()
+        overlay_urls_size = dict()
+        blob_codecs = dict()
+        blob_digests = dict()
         for blob in meta_info[Cloudlet_Const.META_OVERLAY_FILES]:
             url = blob[Cloudlet_Const.META_OVERLAY_FILE_NAME]
             size = blob[Cloudlet_Const.META_OVERLAY_FILE_SIZE]
+            for frame_plan in pruned_frames.get(url, list()):
+                # client sends the blob without pruned frames
+                size -= frame_plan[1][Cloudlet_Const.META_FRAME_SIZE]
             overlay_urls.append(url)
             overlay_urls_size[url] = size
+            blob_codecs[url] = codec.get_blob_codec(blob)[0]
+            blob_digests[url] = blob.get(Cloudlet_Const.META_OVERLAY_FILE_SHA256, None)
         LOG.info("  - %s" % str(pformat(self.synthesis_option)))
         LOG.info("  - Base VM     : %s" % base_path)
         LOG.info("  - Blob count  : %d" % len(overlay_urls))
+        LOG.info("  - Cached blob : %d" % len(cached_blobs))
+        LOG.info("  - Pruned frame: %d" % \
+                sum([len(frames) for frames in pruned_frames.itervalues()]))
         if overlay_urls == None:
             self.ret_fail("No overlay info listed")
             return
@@ -530,13 +1335,20 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
         download_process = NetworkStepThread(self, 
                     overlay_urls, overlay_urls_size, demanding_queue, 
                     download_queue, time_transfer, Synthesis_Const.TRANSFER_SIZE, 
-                    )
+                    cached_blobs=cached_blobs, blob_cache=self.server.blob_cache,
+                    blob_digests=blob_digests, pruned_frames=pruned_frames,
+                    chunk_injector=chunk_injector)
+        pruned_indexes = None
+        if chunk_injector != None:
+            pruned_indexes = chunk_injector.get_pruned_indexes(pruned_frames)
         decomp_process = DecompStepProc(
                 download_queue, self.overlay_pipe, time_decomp, temp_overlay_file,
-                )
+                blob_codecs=blob_codecs)
         modified_img, modified_mem, self.fuse, self.delta_proc, self.fuse_proc = \
                 synthesis.recover_launchVM(base_path, meta_info, self.overlay_pipe, 
-                        log=sys.stdout, demanding_queue=demanding_queue)
+                        log=sys.stdout, demanding_queue=demanding_queue,
+                        recovery_process_number=self.server.recovery_process_number,
+                        pruned_indexes=pruned_indexes)
         self.delta_proc.time_queue = time_delta # for measurement
         self.fuse_proc.time_queue = time_fuse # for measurement
 
@@ -581,6 +1393,8 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
             self.send_synthesis_done()
 
         end_time = time.time()
+        self._save_recovered(base_path, meta_info, modified_img, modified_mem,
+                chunk_hashes=chunk_hashes)
 
         # printout result
         SynthesisHandler.print_statistics(start_time, end_time, \
@@ -591,7 +1405,6 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
             synthesis.connect_vnc(self.resumed_VM.machine, no_wait=True)
 
         # save all the resource to the session resource
-        global session_resources
         s_resource = SessionResource(session_id)
         s_resource.add(SessionResource.DELTA_PROCESS, self.delta_proc)
         s_resource.add(SessionResource.RESUMED_VM, self.resumed_VM)
@@ -599,7 +1412,8 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
         s_resource.add(SessionResource.OVERLAY_PIPE, self.overlay_pipe)
         s_resource.add(SessionResource.OVERLAY_DIR, self.tmp_overlay_dir)
         s_resource.add(SessionResource.OVERLAY_DB_ENTRY, new_overlayvm)
-        session_resources[session_id] = s_resource
+        with session_resources_lock:
+            session_resources[session_id] = s_resource
         LOG.info("Resource is allocated for Session: %s" % str(session_id))
 
         # printout synthesis statistics
@@ -610,11 +1424,9 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
                     mem_access_list, disk_access_list)
         LOG.info("[SOCKET] waiting for client exit message")
 
-    def _handle_finish(self, message):
-        global session_resources
-
-        session_id = message.get(Protocol.KEY_SESSION_ID, None)
-        session_resource = session_resources.get(session_id)
+    def _deallocate_session(self, session_id):
+        with session_resources_lock:
+            session_resource = session_resources.pop(session_id, None)
         if session_resource is None:
             # No saved resource for the session
             msg = "No resource to be deallocated found at Session (%s)" % session_id
@@ -623,8 +1435,13 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
             # deallocate all the session resource
             msg = "Deallocating resources for the Session (%s)" % session_id
             LOG.info(msg)
-            session_resource.deallocate()
-            del session_resources[session_id]
+            with self.server.dbconn.lock:
+                session_resource.deallocate()
+        self.server.admission.release(session_id)
+
+    def _handle_finish(self, message):
+        session_id = message.get(Protocol.KEY_SESSION_ID, None)
+        self._deallocate_session(session_id)
 
         LOG.info("  - %s" % str(pformat(message)))
         self.ret_success(Protocol.MESSAGE_COMMAND_FINISH)
@@ -671,24 +1488,33 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
             return 
 
         # return success get overlay URL
+        session_id = message.get(Protocol.KEY_SESSION_ID, None)
+        self._wait_admission(session_id, meta_info)
         self.ret_success(Protocol.MESSAGE_COMMAND_SEND_META)
         overlay_url = message.get(Protocol.KEY_OVERLAY_URL)
         overlay_package = VMOverlayPackage(overlay_url)
 
         # update DB
-        session_id = message.get(Protocol.KEY_SESSION_ID, None)
         new_overlayvm = OverlayVM(session_id, base_path)
         self.server.dbconn.add_item(new_overlayvm)
+        launch_images = self._get_launch_images(meta_info)
+        if launch_images != None:
+            self._resume_launch_images(session_id, base_path, meta_info,
+                    launch_images, new_overlayvm)
+            return
 
         # start synthesis process
-        url_manager = Manager()
-        overlay_urls = url_manager.list()
-        overlay_urls_size = url_manager.dict()
+        overlay_urls = list()
+        overlay_urls_size = dict()
+        blob_codecs = dict()
+        overlay_frames = dict()
         for blob in meta_info[Cloudlet_Const.META_OVERLAY_FILES]:
             url = blob[Cloudlet_Const.META_OVERLAY_FILE_NAME]
             size = blob[Cloudlet_Const.META_OVERLAY_FILE_SIZE]
             overlay_urls.append(url)
             overlay_urls_size[url] = size
+            blob_codecs[url] = codec.get_blob_codec(blob)[0]
+            overlay_frames[url] = blob.get(Cloudlet_Const.META_OVERLAY_FILE_FRAMES, None)
         LOG.info("  - %s" % str(pformat(self.synthesis_option)))
         LOG.info("  - Base VM     : %s" % base_path)
         LOG.info("  - Blob count  : %d" % len(overlay_urls))
@@ -719,13 +1545,15 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
         download_queue = JoinableQueue()
         download_process = URLFetchStep(overlay_package, overlay_urls, 
                 overlay_urls_size, demanding_queue, download_queue, 
-                time_transfer, Synthesis_Const.TRANSFER_SIZE, )
+                time_transfer, Synthesis_Const.TRANSFER_SIZE,
+                overlay_frames=overlay_frames)
         decomp_process = DecompStepProc(
                 download_queue, self.overlay_pipe, time_decomp, temp_overlay_file,
-                )
+                blob_codecs=blob_codecs)
         modified_img, modified_mem, self.fuse, self.delta_proc, self.fuse_proc = \
                 synthesis.recover_launchVM(base_path, meta_info, self.overlay_pipe, 
-                        log=sys.stdout, demanding_queue=demanding_queue)
+                        log=sys.stdout, demanding_queue=demanding_queue,
+                        recovery_process_number=self.server.recovery_process_number)
         self.delta_proc.time_queue = time_delta # for measurement
         self.fuse_proc.time_queue = time_fuse # for measurement
 
@@ -770,6 +1598,7 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
             self.send_synthesis_done()
 
         end_time = time.time()
+        self._save_recovered(base_path, meta_info, modified_img, modified_mem)
 
         # printout result
         SynthesisHandler.print_statistics(start_time, end_time, \
@@ -780,7 +1609,6 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
             synthesis.connect_vnc(self.resumed_VM.machine, no_wait=True)
 
         # save all the resource to the session resource
-        global session_resources
         s_resource = SessionResource(session_id)
         s_resource.add(SessionResource.DELTA_PROCESS, self.delta_proc)
         s_resource.add(SessionResource.RESUMED_VM, self.resumed_VM)
@@ -788,7 +1616,8 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
         s_resource.add(SessionResource.OVERLAY_PIPE, self.overlay_pipe)
         s_resource.add(SessionResource.OVERLAY_DIR, self.tmp_overlay_dir)
         s_resource.add(SessionResource.OVERLAY_DB_ENTRY, new_overlayvm)
-        session_resources[session_id] = s_resource
+        with session_resources_lock:
+            session_resources[session_id] = s_resource
         LOG.info("Resource is allocated for Session: %s" % str(session_id))
 
         # printout synthesis statistics
@@ -819,23 +1648,14 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
 
     def _handle_session_close(self, message):
         my_session_id = message.get(Protocol.KEY_SESSION_ID, None)
-        ret_session = self.server.dbconn.session.query(Session).filter(Session.session_id==my_session_id).first()
-        if ret_session:
-            ret_session.terminate()
-        self.server.dbconn.session.commit()
+        with self.server.dbconn.lock:
+            ret_session = self.server.dbconn.session.query(Session).filter(Session.session_id==my_session_id).first()
+            if ret_session:
+                ret_session.terminate()
+            self.server.dbconn.session.commit()
 
         # deallocate all resource in the session
-        session_resource = session_resources.get(my_session_id)
-        if session_resource is None:
-            # No saved resource for the session
-            msg = "No resource to be deallocated found at Session (%s)" % my_session_id
-            LOG.warning(msg)
-        else:
-            # deallocate all the session resource
-            msg = "Deallocating resources for the Session (%s)" % my_session_id
-            LOG.info(msg)
-            session_resource.deallocate()
-            del session_resources[my_session_id]
+        self._deallocate_session(my_session_id)
 
         LOG.info("  - %s" % str(pformat(message)))
         self.ret_success(Protocol.MESSAGE_COMMAND_FINISH)
@@ -845,8 +1665,10 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
 
     def _check_session(self, message):
         my_session_id = message.get(Protocol.KEY_SESSION_ID, None)
-        ret_session = self.server.dbconn.session.query(Session).filter(Session.session_id==my_session_id).first()
-        if ret_session and ret_session.status == Session.STATUS_RUNNING:
+        with self.server.dbconn.lock:
+            ret_session = self.server.dbconn.session.query(Session).filter(Session.session_id==my_session_id).first()
+            is_running = ret_session and ret_session.status == Session.STATUS_RUNNING
+        if is_running:
             return True
         else:
             # send response
@@ -855,8 +1677,11 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
 
     def force_session_close(self, message):
         my_session_id = message.get(Protocol.KEY_SESSION_ID, None)
-        ret_session = self.server.dbconn.session.query(Session).filter(Session.session_id==my_session_id).first()
-        ret_session.terminate(status=Session.STATUS_UNEXPECT_CLOSE)
+        with self.server.dbconn.lock:
+            ret_session = self.server.dbconn.session.query(Session).filter(Session.session_id==my_session_id).first()
+            if ret_session:
+                ret_session.terminate(status=Session.STATUS_UNEXPECT_CLOSE)
+            self.server.dbconn.session.commit()
 
     def handle(self):
         '''Handle request from the client
@@ -876,6 +1701,9 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
             msgpack_data += self.request.recv(message_size-len(msgpack_data))
         message = NetworkUtil.decoding(msgpack_data)
         command = message.get(Protocol.KEY_COMMAND, None)
+        # admitted session is not expired while its request is handled
+        request_session_id = message.get(Protocol.KEY_SESSION_ID, None)
+        self.server.admission.begin_request(request_session_id)
 
         # handle request that requries session
         try:
@@ -903,13 +1731,16 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
                 LOG.info("Invalid command number : %d" % command)
         except Exception as e:
             # close session if synthesis failed
-            if command == Protocol.MESSAGE_COMMAND_SEND_META:
-                self.force_session_close()
+            if command == Protocol.MESSAGE_COMMAND_SEND_META or \
+                    command == Protocol.MESSAGE_COMMAND_SEND_OVERLAY_URL:
+                self.force_session_close(message)
             sys.stderr.write(traceback.format_exc())
             sys.stderr.write("%s" % str(e))
             sys.stderr.write("handler raises exception\n")
             self.terminate()
             raise e
+        finally:
+            self.server.admission.end_request(request_session_id)
 
     def finish(self):
         pass
@@ -917,21 +1748,26 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
     def terminate(self):
         # force terminate when something wrong in handling request
         # do not wait for joinining
-        if hasattr(self, 'detla_proc') and self.delta_proc != None:
-            self.delta_proc.finish()
-            if self.delta_proc.is_alive():
-                self.delta_proc.terminate()
-            self.delta_proc = None
-        if hasattr(self, 'resumed') and self.resumed_VM != None:
-            self.resumed_VM.terminate()
-            self.resumed_VM = None
-        if hasattr(self, 'fuse') and self.fuse != None:
-            self.fuse.terminate()
-            self.fuse = None
-        if hasattr(self, 'overlay_pipe') and os.path.exists(self.overlay_pipe):
-            os.unlink(self.overlay_pipe)
-        if hasattr(self, 'tmp_overlay_dir') and os.path.exists(self.tmp_overlay_dir):
-            shutil.rmtree(self.tmp_overlay_dir)
+        try:
+            if hasattr(self, 'delta_proc') and self.delta_proc != None:
+                self.delta_proc.finish()
+                if self.delta_proc.is_alive():
+                    self.delta_proc.terminate()
+                self.delta_proc = None
+            if hasattr(self, 'resumed_VM') and self.resumed_VM != None:
+                self.resumed_VM.terminate()
+                self.resumed_VM = None
+            if hasattr(self, 'fuse') and self.fuse != None:
+                self.fuse.terminate()
+                self.fuse = None
+            if hasattr(self, 'overlay_pipe') and os.path.exists(self.overlay_pipe):
+                os.unlink(self.overlay_pipe)
+            if hasattr(self, 'tmp_overlay_dir') and os.path.exists(self.tmp_overlay_dir):
+                shutil.rmtree(self.tmp_overlay_dir)
+        finally:
+            # free the slot only after the session stops using resources
+            if self.session_id != None:
+                self.server.admission.release(self.session_id)
 
 
     @staticmethod
@@ -978,10 +1814,39 @@ def get_local_ipaddress():
     return ipaddress
 
 
-class SynthesisServer(SocketServer.TCPServer):
+class SynthesisServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    # each request is handled at its own thread
+    daemon_threads = True
 
     def __init__(self, args):
         settings, args = SynthesisServer.process_command_line(args)
+        self.recovery_process_number = settings.recovery_process_number
+        self.admission = AdmissionController(settings.max_session_number,
+                idle_timeout=settings.session_timeout,
+                expire_callback=self.expire_session)
+        self.blob_cache = None
+        if settings.cache_size_mb > 0:
+            try:
+                self.blob_cache = OverlayBlobCache(settings.cache_dir,
+                        settings.cache_size_mb*1024*1024)
+            except (OverlayCacheError, OSError) as e:
+                LOG.warning("Cannot use overlay blob cache : %s" % str(e))
+        self.chunk_store = None
+        if settings.chunk_store_size_mb > 0:
+            try:
+                self.chunk_store = ChunkStore(settings.chunk_store_dir,
+                        settings.chunk_store_size_mb*1024*1024)
+            except (OverlayCacheError, OSError, IOError) as e:
+                LOG.warning("Cannot use chunk store : %s" % str(e))
+        self.launch_cache = None
+        if settings.launch_cache_size_mb > 0:
+            try:
+                self.launch_cache = LaunchImageCache(settings.launch_cache_dir,
+                        settings.launch_cache_size_mb*1024*1024)
+            except (OverlayCacheError, OSError) as e:
+                LOG.warning("Cannot use launch image cache : %s" % str(e))
+        self.background_worker = BackgroundWorker()
+        self.background_worker.start()
         self.dbconn = DBConnector()
         self.basevm_list = self.check_basevm()
 
@@ -1001,6 +1866,17 @@ class SynthesisServer(SocketServer.TCPServer):
         LOG.info(" - Open TCP Server at %s" % (str(server_address)))
         LOG.info(" - Disable Nagle(No TCP delay)  : %s" \
                 % str(self.socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)))
+        LOG.info(" - Recovery workers per session : %d" % self.recovery_process_number)
+        LOG.info(" - Max concurrent sessions : %d" % self.admission.max_sessions)
+        if self.blob_cache != None:
+            LOG.info(" - Overlay blob cache : %s (%d MB)" % \
+                    (settings.cache_dir, settings.cache_size_mb))
+        if self.chunk_store != None:
+            LOG.info(" - Chunk store : %s (%d MB)" % \
+                    (settings.chunk_store_dir, settings.chunk_store_size_mb))
+        if self.launch_cache != None:
+            LOG.info(" - Launch image cache : %s (%d MB)" % \
+                    (settings.launch_cache_dir, settings.launch_cache_size_mb))
         LOG.info("-"*50)
 
         # Start UPnP Server
@@ -1050,13 +1926,29 @@ class SynthesisServer(SocketServer.TCPServer):
         from db.table_def import Session
 
         LOG.info("Close all running sessions")
-        session_list = self.dbconn.list_item(Session)
-        for item in session_list:
-            if item.status == Session.STATUS_RUNNING:
-                item.terminate(Session.STATUS_UNEXPECT_CLOSE)
-        self.dbconn.session.commit()
+        with self.dbconn.lock:
+            session_list = self.dbconn.list_item(Session)
+            for item in session_list:
+                if item.status == Session.STATUS_RUNNING:
+                    item.terminate(Session.STATUS_UNEXPECT_CLOSE)
+            self.dbconn.session.commit()
 
 
+    def expire_session(self, session_id):
+        # session admitted but left without FINISH or SESSION_CLOSE
+        from db.table_def import Session
+
+        with session_resources_lock:
+            session_resource = session_resources.pop(session_id, None)
+        with self.dbconn.lock:
+            ret_session = self.dbconn.session.query(Session).filter(Session.session_id==session_id).first()
+            if ret_session and ret_session.status == Session.STATUS_RUNNING:
+                ret_session.terminate(status=Session.STATUS_UNEXPECT_CLOSE)
+            self.dbconn.session.commit()
+            if session_resource != None:
+                LOG.info("Deallocating resources for the Session (%s)" % session_id)
+                session_resource.deallocate()
+
     def terminate(self):
         # expire all existing session
         self.expire_all_sessions()
@@ -1081,8 +1973,10 @@ class SynthesisServer(SocketServer.TCPServer):
             self.resource_monitor.terminate()
             self.resource_monitor.join()
 
-        global session_resources
-        for (session_id, resource) in session_resources.iteritems():
+        with session_resources_lock:
+            resource_list = session_resources.items()
+            session_resources.clear()
+        for (session_id, resource) in resource_list:
             try:
                 resource.deallocate()
                 msg = "Deallocate resources for Session: %s" % str(session_id)
@@ -1090,6 +1984,7 @@ class SynthesisServer(SocketServer.TCPServer):
             except Exception as e:
                 msg = "Failed to deallocate resources for Session : %s" % str(session_id)
                 LOG.warning(msg)
+            self.admission.release(session_id)
         LOG.info("[TERMINATE] Finish synthesis server connection")
 
 
@@ -1105,7 +2000,76 @@ class SynthesisServer(SocketServer.TCPServer):
                 default=None, help= 'Domain address for registration server.\n \
                         Specify this if you like to register your \
                         Cloudlet to registration server.')
+        parser.add_option(
+                '-w', '--recovery-workers', action='store', type='int',
+                dest='recovery_process_number',
+                default=Synthesis_Const.RECOVERY_PROCESS_NUMBER,
+                help='Number of processes recovering xdelta items per session ' + \
+                        '(default: number of CPUs / max sessions)')
+        parser.add_option(
+                '-s', '--max-sessions', action='store', type='int',
+                dest='max_session_number',
+                default=Synthesis_Const.MAX_SESSION_NUMBER,
+                help='Number of synthesis sessions running at once. ' + \
+                        'Other sessions wait for admission (default: %d)' % \
+                        Synthesis_Const.MAX_SESSION_NUMBER)
+        parser.add_option(
+                '--session-timeout', action='store', type='int',
+                dest='session_timeout',
+                default=Synthesis_Const.SESSION_IDLE_TIMEOUT,
+                help='Seconds after which an idle session is closed ' + \
+                        'when other sessions wait for admission. ' + \
+                        '0 keeps idle sessions (default: %d)' % \
+                        Synthesis_Const.SESSION_IDLE_TIMEOUT)
+        parser.add_option(
+                '-c', '--cache-dir', action='store', dest='cache_dir',
+                default=Synthesis_Const.OVERLAY_CACHE_DIR,
+                help='Directory to keep received overlay blobs (default: %s)' % \
+                        Synthesis_Const.OVERLAY_CACHE_DIR)
+        parser.add_option(
+                '--cache-size', action='store', type='int', dest='cache_size_mb',
+                default=Synthesis_Const.OVERLAY_CACHE_SIZE_MB,
+                help='Disk quota of overlay blob cache in MB. ' + \
+                        '0 disables the cache (default: %d)' % \
+                        Synthesis_Const.OVERLAY_CACHE_SIZE_MB)
+        parser.add_option(
+                '--chunk-store-dir', action='store', dest='chunk_store_dir',
+                default=Synthesis_Const.CHUNK_STORE_DIR,
+                help='Directory to keep chunks of recovered overlays (default: %s)' % \
+                        Synthesis_Const.CHUNK_STORE_DIR)
+        parser.add_option(
+                '--chunk-store-size', action='store', type='int',
+                dest='chunk_store_size_mb',
+                default=Synthesis_Const.CHUNK_STORE_SIZE_MB,
+                help='Disk quota of chunk store in MB. ' + \
+                        '0 disables the chunk store (default: %d)' % \
+                        Synthesis_Const.CHUNK_STORE_SIZE_MB)
+        parser.add_option(
+                '--launch-cache-dir', action='store', dest='launch_cache_dir',
+                default=Synthesis_Const.LAUNCH_CACHE_DIR,
+                help='Directory to keep recovered launch images (default: %s)' % \
+                        Synthesis_Const.LAUNCH_CACHE_DIR)
+        parser.add_option(
+                '--launch-cache-size', action='store', type='int',
+                dest='launch_cache_size_mb',
+                default=Synthesis_Const.LAUNCH_CACHE_SIZE_MB,
+                help='Disk quota of launch image cache in MB. ' + \
+                        '0 disables the cache (default: %d)' % \
+                        Synthesis_Const.LAUNCH_CACHE_SIZE_MB)
         settings, args = parser.parse_args(argv)
+        if settings.recovery_process_number == None:
+            # concurrent sessions do not oversubscribe CPUs
+            settings.recovery_process_number = max(1,
+                    multiprocessing.cpu_count()/max(1, settings.max_session_number))
+        if settings.recovery_process_number < 1:
+            parser.error("Number of recovery workers should be positive")
+        if settings.max_session_number < 1:
+            parser.error("Number of sessions should be positive")
+        if settings.session_timeout < 0:
+            parser.error("Session timeout should not be negative")
+        if settings.cache_size_mb < 0 or settings.launch_cache_size_mb < 0 or \
+                settings.chunk_store_size_mb < 0:
+            parser.error("Cache size should not be negative")
         return settings, args
 
     def check_basevm(self):
@@ -1124,6 +2088,12 @@ class SynthesisServer(SocketServer.TCPServer):
                 LOG.warning("memory snapshot (%s) is not exist" % (base_mempath))
                 continue
 
+            # convert meta files of existing base VM to hash index
+            if os.path.exists(base_memmeta):
+                hashindex.load_memory_index(base_memmeta).close()
+            if os.path.exists(base_diskmeta):
+                hashindex.load_disk_index(base_diskmeta).close()
+
             # add to list
             ret_list.append(item)
             LOG.info(" %d : %s (Disk %d MB, Memory %d MB)" % \
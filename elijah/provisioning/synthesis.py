@@ -28,6 +28,7 @@ import vmnetfs
 import vmnetx
 import delta
 import xray
+import hashindex
 import hashlib
 import libvirt
 import shutil
@@ -47,6 +48,7 @@ from package import VMOverlayPackage
 from xml.etree import ElementTree
 from xml.etree.ElementTree import Element
 from uuid import uuid4
+from operator import attrgetter
 from tempfile import NamedTemporaryFile
 from tempfile import mkdtemp
 from time import time
@@ -58,6 +60,8 @@ from optparse import OptionParser
 from tool import comp_lzma
 from tool import diff_files
 from tool import decomp_overlay
+from tool import decomp_blobs
+from tool import DECOMP_CHUNK_SIZE
 import log as logging
 
 LOG = logging.getLogger(__name__)
@@ -217,7 +221,7 @@ class VM_Overlay(threading.Thread):
         self.overlay_metafile, self.overlay_files = \
                 generate_overlayfile(overlay_deltalist, self.options, 
                 self.base_hashvalue, os.path.getsize(self.modified_disk), 
-                os.path.getsize(self.modified_mem.name),
+                monitoring_info.memory_snapshot_size,
                 overlay_metapath, overlay_prefix)
 
         # packaging VM overlay into a single zip file
@@ -227,6 +231,9 @@ class VM_Overlay(threading.Thread):
             # delete tmp overlay files
             if os.path.exists(self.overlay_metafile) == True:
                 os.remove(self.overlay_metafile)
+            hashes_file = self.overlay_metafile + Const.OVERLAY_CHUNK_HASHES_EXT
+            if os.path.exists(hashes_file) == True:
+                os.remove(hashes_file)
             for overlay_file in self.overlay_files:
                 if os.path.exists(overlay_file) == True:
                     os.remove(overlay_file)
@@ -327,6 +334,8 @@ class _MonitoringInfo(object):
     DISK_USED_BLOCKS        = "disk_used_block" # from xray support
     DISK_FREE_BLOCKS        = "disk_free_block"
     MEMORY_FREE_BLOCKS      = "memory_free_block"
+    MEMORY_DELTALIST        = "memory_deltalist" # from streaming memory diff
+    MEMORY_SNAPSHOT_SIZE    = "memory_snapshot_size"
 
     def __init__(self, properties):
         for k, v in properties.iteritems():
@@ -731,13 +740,25 @@ def _get_monitoring_info(conn, machine, options,
 
     # 1-2. Stop monitoring for memory access (snapshot will create a lot of access)
     fuse_stream_monitor.del_path(vmnetfs.StreamMonitor.MEMORY_ACCESS)
-    # TODO: support stream of modified memory rather than tmp file
+    memory_deltalist = None
+    memory_size = 0
     if not options.DISK_ONLY:
-        save_mem_snapshot(conn, machine, modified_mem, nova_util=nova_util)
+        if options.MEMORY_DIFF_STREAMING and not options.FREE_SUPPORT:
+            # compare memory while saving it. Save memory snapshot
+            # only when it is requested
+            base = Memory.Memory.import_from_metafile(base_memmeta, base_mem)
+            memory_size, memory_deltalist = save_mem_snapshot(conn, machine,
+                    modified_mem, nova_util=nova_util,
+                    memory_diff=Memory.MemoryStreamDiff(base,
+                        num_proc=options.PROCESS_NUMBER),
+                    save_file=bool(options.MEMORY_SAVE_PATH))
+        else:
+            memory_size, memory_deltalist = save_mem_snapshot(conn, machine,
+                    modified_mem, nova_util=nova_util)
 
-    # 1-3. get hashlist of base memory and disk
-    basemem_hashlist = Memory.base_hashlist(base_memmeta)
-    basedisk_hashlist = Disk.base_hashlist(base_diskmeta)
+    # 1-3. get hash index of base memory and disk
+    basemem_hashlist = hashindex.load_memory_index(base_memmeta)
+    basedisk_hashlist = hashindex.load_disk_index(base_diskmeta)
 
     # 1-4. get dma & discard information
     if options.TRIM_SUPPORT:
@@ -762,6 +783,8 @@ def _get_monitoring_info(conn, machine, options,
     info_dict[_MonitoringInfo.DISK_MODIFIED_BLOCKS] = m_chunk_dict
     info_dict[_MonitoringInfo.DISK_FREE_BLOCKS] = trim_dict
     info_dict[_MonitoringInfo.MEMORY_FREE_BLOCKS] = free_memory_dict
+    info_dict[_MonitoringInfo.MEMORY_DELTALIST] = memory_deltalist
+    info_dict[_MonitoringInfo.MEMORY_SNAPSHOT_SIZE] = memory_size
     monitoring_info = _MonitoringInfo(info_dict)
     return monitoring_info
 
@@ -802,16 +825,22 @@ def get_overlay_deltalist(monitoring_info, options,
     m_chunk_dict = getattr(monitoring_info, INFO.DISK_MODIFIED_BLOCKS, None)
     trim_dict = getattr(monitoring_info, INFO.DISK_FREE_BLOCKS, None)
     used_blocks_dict = getattr(monitoring_info, INFO.DISK_USED_BLOCKS, None)
+    streamed_mem_deltalist = getattr(monitoring_info, INFO.MEMORY_DELTALIST, None)
     dma_dict = dict()
 
     LOG.info("Get memory delta")
     if options.DISK_ONLY:
         mem_deltalist = list()
     else:
-        mem_deltalist = Memory.create_memory_deltalist(modified_mem,
-                basemem_meta=base_memmeta, basemem_path=base_mem,
-                apply_free_memory=options.FREE_SUPPORT,
-                free_memory_info=free_memory_dict)
+        if streamed_mem_deltalist != None:
+            # memory is already compared while saving memory snapshot
+            mem_deltalist = streamed_mem_deltalist
+        else:
+            mem_deltalist = Memory.create_memory_deltalist(modified_mem,
+                    basemem_meta=base_memmeta, basemem_path=base_mem,
+                    apply_free_memory=options.FREE_SUPPORT,
+                    free_memory_info=free_memory_dict,
+                    num_proc=options.PROCESS_NUMBER)
         if old_deltalist and len(old_deltalist) > 0:
             diff_deltalist = delta.residue_diff_deltalists(old_deltalist,
                     mem_deltalist, base_mem)
@@ -826,7 +855,8 @@ def get_overlay_deltalist(monitoring_info, options,
         apply_discard = True,
         dma_dict=dma_dict,
         used_blocks_dict=used_blocks_dict,
-        ret_statistics=disk_statistics)
+        ret_statistics=disk_statistics,
+        num_proc=options.PROCESS_NUMBER)
         
     LOG.info("Generate VM overlay using deduplication")
     merged_deltalist = delta.create_overlay(
@@ -855,10 +885,18 @@ def generate_overlayfile(overlay_deltalist, options,
     '''
 
     # Compression
-    LOG.info("[LZMA] Compressing overlay blobs (%s)", overlay_metapath)
+    # chunks close to each other in offset are put in the same blob
+    overlay_deltalist.sort(key=attrgetter('delta_type', 'offset'))
+    LOG.info("[%s] Compressing overlay blobs (%s), blob size %d KB",
+            options.OVERLAY_CODEC, overlay_metapath, options.OVERLAY_BLOB_SIZE_KB)
+    chunk_hashes = dict()
     blob_list = delta.divide_blobs(overlay_deltalist, overlayfile_prefix,
-            Const.OVERLAY_BLOB_SIZE_KB, Const.CHUNK_SIZE,
-            Memory.Memory.RAM_PAGE_SIZE)
+            options.OVERLAY_BLOB_SIZE_KB, Const.CHUNK_SIZE,
+            Memory.Memory.RAM_PAGE_SIZE, num_proc=options.PROCESS_NUMBER,
+            codec_name=options.OVERLAY_CODEC,
+            codec_level=options.OVERLAY_CODEC_LEVEL,
+            frame_size_kb=options.OVERLAY_FRAME_SIZE_KB,
+            chunk_hashes=chunk_hashes)
 
     # create metadata
     if not options.DISK_ONLY:
@@ -867,6 +905,11 @@ def generate_overlayfile(overlay_deltalist, options,
     else:
         _create_overlay_meta(overlay_metapath, base_hashvalue,
                 launchdisk_size, launchmem_size, blob_list)
+    # chunk hashes are kept out of meta, since they are needed only when
+    # the client negotiates chunks with Cloudlet
+    hashes_fd = open(overlay_metapath + Const.OVERLAY_CHUNK_HASHES_EXT, "wb")
+    hashes_fd.write(msgpack.packb(chunk_hashes))
+    hashes_fd.close()
 
     overlay_files = [item[Const.META_OVERLAY_FILE_NAME] for item in blob_list]
     dirpath = os.path.dirname(overlayfile_prefix)
@@ -914,6 +957,9 @@ def run_delta_compression(output_list, **kwargs):
 def recover_launchVM(base_image, meta_info, overlay_file, **kwargs):
     # kwargs
     # skip_validation   :   skip sha1 validation
+    # recovery_process_number : number of processes recovering xdelta items
+    # pruned_indexes : index of delta items that Cloudlet makes from its
+    #                  own chunks instead of receiving them
     # LOG = log object for nova
     # nova_util = nova_util is executioin wrapper for nova framework
     #           You should use nova_util in OpenStack, or subprocess
@@ -933,16 +979,31 @@ def recover_launchVM(base_image, meta_info, overlay_file, **kwargs):
     vm_memory_size = meta_info[Const.META_RESUME_VM_MEMORY_SIZE]
     memory_chunk_list = list()
     disk_chunk_list = list()
+    self_ref_counts = dict()
     for each_file in meta_info[Const.META_OVERLAY_FILES]:
         memory_chunks = each_file[Const.META_OVERLAY_FILE_MEMORY_CHUNKS]
         disk_chunks = each_file[Const.META_OVERLAY_FILE_DISK_CHUNKS]
         memory_chunk_list.extend(["%ld:0" % item for item in memory_chunks])
         disk_chunk_list.extend(["%ld:0" % item for item in disk_chunks])
+        self_refs = each_file.get(Const.META_OVERLAY_FILE_SELF_REFS, None)
+        if self_refs == None or self_ref_counts == None:
+            # old overlay: self reference is read from recovered file
+            self_ref_counts = None
+            continue
+        for (ref_index, ref_count) in self_refs:
+            self_ref_counts[ref_index] = ref_count
+    if self_ref_counts != None and kwargs.get('pruned_indexes', None):
+        # deduped chunks are in the frame of their reference, so both
+        # are pruned together
+        for ref_index in kwargs.get('pruned_indexes'):
+            self_ref_counts.pop(ref_index, None)
     disk_overlay_map = ','.join(disk_chunk_list)
     memory_overlay_map = ','.join(memory_chunk_list)
 
     # make FUSE disk & memory
     kwargs['meta_info'] = meta_info
+    demanded_chunk_queue = multiprocessing.Queue()
+    kwargs['demanded_chunk_queue'] = demanded_chunk_queue
     fuse = run_fuse(Const.VMNETFS_PATH, Const.CHUNK_SIZE,
             base_image, vm_disk_size, base_mem, vm_memory_size,
             resumed_disk=launch_disk.name,  disk_overlay_map=disk_overlay_map,
@@ -957,12 +1018,44 @@ def recover_launchVM(base_image, meta_info, overlay_file, **kwargs):
     delta_proc = delta.Recovered_delta(base_image, base_mem, overlay_file, \
             launch_mem.name, vm_memory_size,
             launch_disk.name, vm_disk_size, Const.CHUNK_SIZE,
-            out_pipename=named_pipename)
+            out_pipename=named_pipename, demand_queue=demanded_chunk_queue,
+            self_ref_counts=self_ref_counts,
+            num_proc=kwargs.get('recovery_process_number', 1))
     fuse_thread = vmnetfs.FuseFeedingProc(fuse,
             named_pipename, delta.Recovered_delta.END_OF_PIPE)
     return [launch_disk.name, launch_mem.name, fuse, delta_proc, fuse_thread]
 
 
+def launch_cached_VM(base_image, meta_info, launch_disk, launch_mem, **kwargs):
+    # launch_disk and launch_mem have all the chunks of the overlay
+    # recovered, so FUSE is started without delta recovery
+    base_mem = kwargs.get('base_mem', None)
+    if not base_mem:
+        (base_diskmeta, base_mem, base_memmeta) = \
+                Const.get_basepath(base_image, check_exist=True)
+
+    vm_disk_size = meta_info[Const.META_RESUME_VM_DISK_SIZE]
+    vm_memory_size = meta_info[Const.META_RESUME_VM_MEMORY_SIZE]
+    memory_chunk_list = list()
+    disk_chunk_list = list()
+    for each_file in meta_info[Const.META_OVERLAY_FILES]:
+        memory_chunks = each_file[Const.META_OVERLAY_FILE_MEMORY_CHUNKS]
+        disk_chunks = each_file[Const.META_OVERLAY_FILE_DISK_CHUNKS]
+        memory_chunk_list.extend(["%ld:1" % item for item in memory_chunks])
+        disk_chunk_list.extend(["%ld:1" % item for item in disk_chunks])
+    disk_overlay_map = ','.join(disk_chunk_list)
+    memory_overlay_map = ','.join(memory_chunk_list)
+
+    fuse = run_fuse(Const.VMNETFS_PATH, Const.CHUNK_SIZE,
+            base_image, vm_disk_size, base_mem, vm_memory_size,
+            resumed_disk=launch_disk,  disk_overlay_map=disk_overlay_map,
+            resumed_memory=launch_mem, memory_overlay_map=memory_overlay_map,
+            **kwargs)
+    fuse.fuse_write("END_OF_TRANSMISSION")
+    LOG.info("Start FUSE with recovered launch images")
+    return fuse
+
+
 def run_fuse(bin_path, chunk_size, original_disk, fuse_disk_size,
         original_memory, fuse_memory_size,
         resumed_disk=None, disk_overlay_map=None,
@@ -1046,13 +1139,18 @@ class MemoryReadProcess(multiprocessing.Process):
     #class MemoryReadProcess(threading.Thread):
     RET_SUCCESS = 1
     RET_ERRROR = 2
+    # delta list is returned in batches of items, ending with None
+    DELTA_BATCH_SIZE = 1024
 
     def __init__(self, input_path, output_path, 
-            machine_memory_size, output_queue):
+            machine_memory_size, output_queue, memory_diff=None):
+        # output_path: memory snapshot is not saved if it is None
+        # memory_diff: Memory.MemoryStreamDiff to compare memory while reading
         self.input_path = input_path
         self.output_path = output_path
         self.output_queue = output_queue
         self.machine_memory_size = machine_memory_size*1024
+        self.memory_diff = memory_diff
         multiprocessing.Process.__init__(self, target=self.read_mem_snapshot)
         #threading.Thread.__init__(self, target=self.read_mem_snapshot)
 
@@ -1064,7 +1162,9 @@ class MemoryReadProcess(multiprocessing.Process):
         # create memory snapshot aligned with 4KB
         try:
             self.in_fd = open(self.input_path, 'rb')
-            self.out_fd = open(self.output_path, 'wb')
+            self.out_fd = None
+            if self.output_path:
+                self.out_fd = open(self.output_path, 'wb')
 
             total_read_size = 0
             # read first 40KB and aligen header with 4KB
@@ -1073,9 +1173,9 @@ class MemoryReadProcess(multiprocessing.Process):
             original_header = libvirt_header.get_header()
             align_size = Memory.Memory.RAM_PAGE_SIZE*2
             new_header = libvirt_header.get_aligned_header(align_size)
-            self.out_fd.write(new_header)
+            self._write(new_header)
             total_read_size += len(new_header)
-            self.out_fd.write(data[len(original_header):])
+            self._write(data[len(original_header):])
             total_read_size += len(data[len(original_header):])
             LOG.info("Header size of memory snapshot is %s" % len(new_header))
 
@@ -1085,25 +1185,51 @@ class MemoryReadProcess(multiprocessing.Process):
                 data = self.in_fd.read(1024 * 1024)
                 if data == None or len(data) <= 0:
                     break
-                self.out_fd.write(data)
+                self._write(data)
                 total_read_size += len(data)
                 prog_bar.set_percent(100.0*total_read_size/self.machine_memory_size)
                 prog_bar.show_progress()
-            self.out_fd.flush()
             prog_bar.finish()
-            if total_read_size != self.out_fd.tell():
-                raise Exception("output file size is different from stream size")
+            if self.out_fd:
+                self.out_fd.flush()
+                if total_read_size != self.out_fd.tell():
+                    raise Exception("output file size is different from stream size")
+            if self.memory_diff:
+                memory_deltalist, memory_size = self.memory_diff.close()
+                if total_read_size != memory_size:
+                    raise Exception("compared memory size is different from stream size")
         except Exception, e:
             LOG.error(str(e))
+            if self.memory_diff:
+                self.memory_diff.terminate()
             self.output_queue.put(self.RET_ERRROR)
             self.output_queue.put(str(e))
         else:
             self.output_queue.put(self.RET_SUCCESS)
+            self.output_queue.put(total_read_size)
+            if self.memory_diff:
+                for start in xrange(0, len(memory_deltalist), self.DELTA_BATCH_SIZE):
+                    self.output_queue.put(
+                            memory_deltalist[start:start+self.DELTA_BATCH_SIZE])
+                self.output_queue.put(None)
+
+    def _write(self, data):
+        if self.out_fd:
+            self.out_fd.write(data)
+        if self.memory_diff:
+            self.memory_diff.write(data)
 
 
 def save_mem_snapshot(conn, machine, fout_path, **kwargs):
+    # kwargs
+    # nova_util : nova_util is executioin wrapper for nova framework
+    # memory_diff : Memory.MemoryStreamDiff to get memory delta while saving
+    # save_file : False not to write memory snapshot at fout_path
+    # return : (size of memory snapshot, memory delta list or None)
     #Set migration speed
     nova_util = kwargs.get('nova_util', None)
+    memory_diff = kwargs.get('memory_diff', None)
+    save_file = kwargs.get('save_file', True)
     ret = machine.migrateSetMaxSpeed(1000000, 0)   # 1000 Gbps, unlimited
     if ret != 0:
         raise CloudletGenerationError("Cannot set migration speed : %s", machine.name())
@@ -1131,11 +1257,11 @@ def save_mem_snapshot(conn, machine, fout_path, **kwargs):
         if os.path.exists(named_pipe_output):
             os.remove(named_pipe_output)
         os.mkfifo(named_pipe_output)
-        memory_read_proc = MemoryReadProcess(named_pipe_output, fout_path, 
-                machine_memory_size, output_queue)
+        memory_read_proc = MemoryReadProcess(named_pipe_output,
+                fout_path if save_file else None,
+                machine_memory_size, output_queue, memory_diff=memory_diff)
         memory_read_proc.start()
         ret = machine.save(named_pipe_output)
-        memory_read_proc.join()
     except libvirt.libvirtError, e:
         # we intentionally ignore seek error from libvirt since we have cause
         # that by using named pipe
@@ -1149,13 +1275,24 @@ def save_mem_snapshot(conn, machine, fout_path, **kwargs):
             machine = None
 
     try:
+        # get results before joining since delta list can be big
         proc_ret = output_queue.get()
         if proc_ret != MemoryReadProcess.RET_SUCCESS:
             error_reason = output_queue.get()
             msg = "Failed to create memory snapshot : %s" % str(error_reason)
             LOG.error(msg)
             raise CloudletGenerationError(msg)
-        if nova_util != None:
+        memory_size = output_queue.get()
+        memory_deltalist = None
+        if memory_diff:
+            memory_deltalist = list()
+            while True:
+                delta_items = output_queue.get()
+                if delta_items == None:
+                    break
+                memory_deltalist.extend(delta_items)
+        memory_read_proc.join()
+        if nova_util != None and save_file:
             # OpenStack runs VM with nova account and snapshot 
             # is generated from system connection
             nova_util.chown(fout_path, os.getuid())
@@ -1168,6 +1305,7 @@ def save_mem_snapshot(conn, machine, fout_path, **kwargs):
 
     if ret != 0:
         raise CloudletGenerationError("libvirt: Cannot save memory state")
+    return memory_size, memory_deltalist
 
 
 def run_snapshot(conn, disk_image, mem_snapshot, new_xml_string, resume_time=None):
@@ -1336,7 +1474,7 @@ def create_residue(base_disk, base_hashvalue,
     residue_metafile, residue_files = \
             generate_overlayfile(residue_deltalist, options, 
             base_hashvalue, os.path.getsize(resumed_vm.resumed_disk), 
-            os.path.getsize(residue_mem.name),
+            monitoring_info.memory_snapshot_size,
             residue_metapath, residue_prefix)
 
     # 4. merge with previous deltalist
@@ -1350,7 +1488,7 @@ def create_residue(base_disk, base_hashvalue,
     overlay_metafile, overlay_files = \
             generate_overlayfile(merged_list, options, 
             base_hashvalue, os.path.getsize(resumed_vm.resumed_disk), 
-            os.path.getsize(residue_mem.name),
+            monitoring_info.memory_snapshot_size,
             overlay_metapath, overlay_prefix)
 
     # 6. terminting
@@ -1523,8 +1661,13 @@ def _create_baseVM(conn, domain, base_diskpath, base_mempath, base_diskmeta, bas
     # generate disk hashing
     # TODO: need more efficient implementation, e.g. bisect
     LOG.info("Start Base VM Disk hashing")
-    base_hashvalue = Disk.hashing(base_diskpath, base_diskmeta)
+    base_hashvalue = Disk.hashing(base_diskpath, base_diskmeta,
+            num_proc=Options.PROCESS_NUMBER)
     LOG.info("Finish Base VM Disk hashing")
+
+    # generate hash index
+    hashindex.load_memory_index(base_memmeta).close()
+    hashindex.load_disk_index(base_diskmeta).close()
     return base_hashvalue
 
 
@@ -1679,6 +1822,22 @@ def _reconstruct_mem_deltalist(base_disk, base_mem, overlay_filepath):
     return ret_deltalist
 
 
+# overlay package opened at each process, since the file offset of the
+# package should not be shared with decompression worker processes
+_overlay_packages = dict()
+
+
+def _iter_package_blob(blob_source, chunk_size):
+    # blob reader of tool.decomp_blobs for zip container
+    (package_url, blobname) = blob_source
+    package_key = (os.getpid(), package_url)
+    overlay_package = _overlay_packages.get(package_key, None)
+    if overlay_package == None:
+        overlay_package = VMOverlayPackage(package_url)
+        _overlay_packages[package_key] = overlay_package
+    return overlay_package.iter_blob(blobname, chunk_size)
+
+
 def synthesis(base_disk, meta, **kwargs):
     # VM Synthesis and run recoverd VM
     # param base_disk : path to base disk
@@ -1693,6 +1852,11 @@ def synthesis(base_disk, meta, **kwargs):
     zip_container = kwargs.get('zip_container', False)
     return_residue = kwargs.get('return_residue', False)
     qemu_args = kwargs.get('qemu_args', False)
+    # blobs are decompressed in parallel, each process buffering a few
+    # decomp_chunk_size of data
+    decomp_process_number = kwargs.get('decomp_process_number',
+            Options.PROCESS_NUMBER)
+    decomp_chunk_size = kwargs.get('decomp_chunk_size', DECOMP_CHUNK_SIZE)
 
     nova_xml = kwargs.get('nova_xml', None)
     base_mem = kwargs.get('base_mem', None)
@@ -1706,23 +1870,23 @@ def synthesis(base_disk, meta, **kwargs):
             msg = "Meta file for VM overlay does not exist at %s" % meta
             raise CloudletGenerationError(msg)
         LOG.info("Decompressing VM overlay")
-        meta_info = decomp_overlay(meta, overlay_filename.name)
+        meta_info = decomp_overlay(meta, overlay_filename.name,
+                num_proc=decomp_process_number, chunk_size=decomp_chunk_size)
     else:
         # download VM overlay at local
-        from lzma import LZMADecompressor
         overlay_package = VMOverlayPackage(meta)
         meta_raw = overlay_package.read_meta()
         meta_info = msgpack.unpackb(meta_raw)
-        comp_overlay_files = meta_info[Const.META_OVERLAY_FILES]
-        comp_overlay_files = [item[Const.META_OVERLAY_FILE_NAME] for item in comp_overlay_files]
-        overlay_fd = open(overlay_filename.name, "w+b")
-        for comp_filename in comp_overlay_files:
-            comp_data = overlay_package.read_blob(comp_filename)
-            decompressor = LZMADecompressor()
-            decomp_data = decompressor.decompress(comp_data)
-            decomp_data += decompressor.flush()
-            overlay_fd.write(decomp_data)
-        overlay_fd.close()
+        package_key = (os.getpid(), meta)
+        _overlay_packages[package_key] = overlay_package
+        blob_list = [((meta, blob_info[Const.META_OVERLAY_FILE_NAME]), blob_info) \
+                for blob_info in meta_info[Const.META_OVERLAY_FILES]]
+        try:
+            decomp_blobs(blob_list, _iter_package_blob, overlay_filename.name,
+                    num_proc=decomp_process_number, chunk_size=decomp_chunk_size)
+        finally:
+            # packages of worker processes are closed as the workers exit
+            _overlay_packages.pop(package_key).close()
     LOG.info("Decompression time : %f (s)" % (time()-decompe_time_s))
     LOG.info("Recovering launch VM")
     launch_disk, launch_mem, fuse, delta_proc, fuse_thread = \
@@ -52,12 +52,14 @@ class Protocol(object):
     MESSAGE_COMMAND_GET_RESOURCE_INFO   = 0x14
     MESSAGE_COMMAND_SESSION_CREATE      = 0x15
     MESSAGE_COMMAND_SESSION_CLOSE       = 0x16
+    MESSAGE_COMMAND_SEND_CHUNK_HASHES   = 0x18
     # server -> client as return
     MESSAGE_COMMAND_SUCCESS             = 0x01
     MESSAGE_COMMAND_FAIELD              = 0x02
     # server -> client as command
     MESSAGE_COMMAND_ON_DEMAND           = 0x03
     MESSAGE_COMMAND_SYNTHESIS_DONE      = 0x04
+    MESSAGE_COMMAND_WAITING             = 0x05
 
     #
     # other keys
@@ -71,6 +73,16 @@ class Protocol(object):
     KEY_SESSION_ID             = "session_id"
     KEY_REQUESTED_COMMAND       = "requested_command"
     KEY_OVERLAY_URL             = "overlay_url"
+    KEY_WAIT_POSITION           = "wait_position"
+    # client can skip blobs cached at Cloudlet
+    KEY_BLOB_CACHE              = "blob_cache"
+    KEY_CACHED_BLOBS            = "cached_blobs"
+    # client can skip frames whose chunks Cloudlet can reconstruct.
+    # Once Cloudlet accepts negotiation, client sends chunk hashes of
+    # overlay and gets a bitmap having a bit for each of them
+    KEY_CHUNK_NEGOTIATION       = "chunk_negotiation"
+    KEY_CHUNK_HASHES_SIZE       = "chunk_hashes_size"
+    KEY_CHUNK_BITMAP            = "chunk_bitmap"
 
     # synthesis option
     KEY_SYNTHESIS_OPTION        = "synthesis_option"
@@ -180,9 +192,7 @@ class Client(object):
         self.time_dict['send_header_end_time'] = time.time()
 
         # recv response
-        data = Client.recv_all(sock, 4)
-        msg_size = struct.unpack("!I", data)[0]
-        message = Client.decoding(Client.recv_all(sock, msg_size))
+        message = Client.recv_admission(sock)
         command = message.get(Protocol.KEY_COMMAND, None)
         if command != Protocol.MESSAGE_COMMAND_SUCCESS:
             msg = "Failed to send overlay URL: %s" %\
@@ -218,12 +228,15 @@ class Client(object):
         sys.stdout.write("Sending overlay meta")
         sys.stdout.write("Session ID: %ld\n" % (session_id))
         meta_data = self._read_overlay_meta(overlay_file, is_zipped)
+        hashes_data = self._read_chunk_hashes(overlay_file, is_zipped)
 
         # send header
         header_dict = {
             Protocol.KEY_COMMAND : Protocol.MESSAGE_COMMAND_SEND_META,
             Protocol.KEY_META_SIZE : len(meta_data),
             Protocol.KEY_SESSION_ID: session_id,
+            Protocol.KEY_BLOB_CACHE: True,
+            Protocol.KEY_CHUNK_NEGOTIATION: hashes_data != None,
             }
         if len(self.synthesis_option) > 0:
             header_dict[Protocol.KEY_SYNTHESIS_OPTION] = self.synthesis_option
@@ -234,10 +247,7 @@ class Client(object):
         self.time_dict['send_header_end_time'] = time.time()
 
         # recv header
-        data = Client.recv_all(sock, 4)
-        msg_size = struct.unpack("!I", data)[0]
-        msg_data = Client.recv_all(sock, msg_size)
-        message = Client.decoding(msg_data)
+        message = Client.recv_admission(sock)
         command = message.get(Protocol.KEY_COMMAND, None)
         if command != Protocol.MESSAGE_COMMAND_SUCCESS:
             msg = "Failed to send overlay meta header: %s" %\
@@ -246,7 +256,32 @@ class Client(object):
             raise ClientError(msg)
 
         meta_info = Client.decoding(meta_data)
-        total_blob_count = len(meta_info['overlay_files'])
+        # Cloudlet does not request blobs it already has
+        cached_blobs = set(message.get(Protocol.KEY_CACHED_BLOBS, list()))
+        # frames that Cloudlet can reconstruct are not sent, and neither
+        # is a blob whose frames are all pruned
+        chunk_hashes = None
+        chunk_bitmap = None
+        if hashes_data != None and \
+                message.get(Protocol.KEY_CHUNK_NEGOTIATION, False) == True:
+            chunk_hashes = Client.decoding(hashes_data)
+            chunk_bitmap = Client.negotiate_chunks(sock, hashes_data)
+        pruned_frames = Client.get_pruned_frames(meta_info, chunk_hashes,
+                chunk_bitmap)
+        blob_frames = dict()
+        skipped_blobs = set(cached_blobs)
+        for blob in meta_info['overlay_files']:
+            blob_name = blob['overlay_name']
+            blob_frames[blob_name] = blob.get('frames', None) or list()
+            pruned_count = len(pruned_frames.get(blob_name, set()))
+            if pruned_count > 0 and pruned_count == len(blob_frames[blob_name]):
+                skipped_blobs.add(blob_name)
+        total_blob_count = len(meta_info['overlay_files']) - len(skipped_blobs)
+        if len(cached_blobs) > 0:
+            sys.stdout.write("%d blobs are cached at Cloudlet\n" % len(cached_blobs))
+        if len(pruned_frames) > 0:
+            sys.stdout.write("%d frames are reconstructed at Cloudlet\n" % \
+                    sum([len(frames) for frames in pruned_frames.values()]))
         sent_blob_list = list()
         is_synthesis_finished = False
 
@@ -300,8 +335,11 @@ class Client(object):
                         raise ClientError(msg)
 
                     blob_name = os.path.basename(requested_uri)
-                    blob_size = self._get_overlay_blob_size(overlay_file, 
-                            blob_name, is_zipped)
+                    blob_data = Client.prune_blob(
+                            self._read_overlay_blob(overlay_file, blob_name, is_zipped),
+                            blob_frames.get(requested_uri, list()),
+                            pruned_frames.get(requested_uri, set()))
+                    blob_size = len(blob_data)
                     segment_info = {
                             Protocol.KEY_COMMAND : Protocol.MESSAGE_COMMAND_SEND_OVERLAY,
                             Protocol.KEY_REQUEST_SEGMENT : requested_uri,
@@ -313,8 +351,7 @@ class Client(object):
                     header = Client.encoding(segment_info)
                     sock.sendall(struct.pack("!I", len(header)))
                     sock.sendall(header)
-                    sock.sendall(self._read_overlay_blob(overlay_file,
-                        blob_name, is_zipped))
+                    sock.sendall(blob_data)
 
                     if len(sent_blob_list) == total_blob_count:
                         self.time_dict['send_header_end_time'] = time.time()
@@ -347,6 +384,21 @@ class Client(object):
             blob_path = os.path.join(os.path.dirname(filepath), blobname)
             return open(blob_path, 'r').read()
 
+    def _read_chunk_hashes(self, filepath, is_zipped):
+        # chunk hashes are next to overlay meta, and None if not exist
+        # '.chunk-hashes' is defined in Configuration.py
+        hashes_name = "overlay-meta" + ".chunk-hashes"
+        if is_zipped is True:
+            zz = zipfile.ZipFile(filepath, "r")
+            if hashes_name not in zz.namelist():
+                return None
+            return zz.read(hashes_name)
+        else:
+            hashes_path = filepath + ".chunk-hashes"
+            if not os.path.exists(hashes_path):
+                return None
+            return open(hashes_path, "rb").read()
+
     def _get_overlay_blob_size(self, filepath, blobname, is_zipped):
         if is_zipped is True:
             zz = zipfile.ZipFile(filepath, "r")
@@ -421,6 +473,78 @@ class Client(object):
             data += sock.recv(size - len(data))
         return data
 
+    @staticmethod
+    def negotiate_chunks(sock, hashes_data):
+        # send chunk hashes of overlay and return bitmap of chunks that
+        # Cloudlet can reconstruct
+        header = Client.encoding({
+            Protocol.KEY_COMMAND : Protocol.MESSAGE_COMMAND_SEND_CHUNK_HASHES,
+            Protocol.KEY_CHUNK_HASHES_SIZE : len(hashes_data),
+            })
+        sock.sendall(struct.pack("!I", len(header)))
+        sock.sendall(header)
+        sock.sendall(hashes_data)
+        msg_size = struct.unpack("!I", Client.recv_all(sock, 4))[0]
+        message = Client.decoding(Client.recv_all(sock, msg_size))
+        if message.get(Protocol.KEY_COMMAND, None) != Protocol.MESSAGE_COMMAND_SUCCESS:
+            msg = "Failed to negotiate chunks: %s" % \
+                    message.get(Protocol.KEY_FAILED_REASON, None)
+            raise ClientError(msg)
+        return message.get(Protocol.KEY_CHUNK_BITMAP, None)
+
+    @staticmethod
+    def get_pruned_frames(meta_info, chunk_hashes, chunk_bitmap):
+        # return blob name -> set of frame index that Cloudlet can
+        # reconstruct. Bits follow the order of blobs, frames and chunk
+        # hashes of the frame
+        pruned_frames = dict()
+        if not chunk_bitmap or not chunk_hashes:
+            return pruned_frames
+        bit_index = 0
+        for blob in meta_info['overlay_files']:
+            frames = blob.get('frames', None) or list()
+            blob_hashes = chunk_hashes.get(blob['overlay_name'], list())
+            for frame_index in xrange(min(len(frames), len(blob_hashes))):
+                frame_hashes = blob_hashes[frame_index]
+                if not frame_hashes:
+                    continue
+                is_pruned = True
+                for hash_value in frame_hashes:
+                    bit = ord(chunk_bitmap[bit_index/8]) & (0x80 >> (bit_index%8))
+                    if bit == 0:
+                        is_pruned = False
+                    bit_index += 1
+                if is_pruned:
+                    pruned_frames.setdefault(blob['overlay_name'], set()).add(frame_index)
+        return pruned_frames
+
+    @staticmethod
+    def prune_blob(blob_data, frames, pruned_frame_set):
+        # frames are compressed independently, so remaining frames are
+        # concatenated as they are
+        if len(pruned_frame_set) == 0:
+            return blob_data
+        data_list = list()
+        for frame_index, frame in enumerate(frames):
+            if frame_index in pruned_frame_set:
+                continue
+            data_list.append(blob_data[frame['offset']:frame['offset']+frame['size']])
+        return ''.join(data_list)
+
+    @staticmethod
+    def recv_admission(sock):
+        # Cloudlet reports position in its waiting queue until it admits
+        # the synthesis request
+        while True:
+            data = Client.recv_all(sock, 4)
+            msg_size = struct.unpack("!I", data)[0]
+            message = Client.decoding(Client.recv_all(sock, msg_size))
+            command = message.get(Protocol.KEY_COMMAND, None)
+            if command != Protocol.MESSAGE_COMMAND_WAITING:
+                return message
+            sys.stdout.write("Waiting at Cloudlet (position %d)\n" % \
+                    message.get(Protocol.KEY_WAIT_POSITION, 0))
+
     @staticmethod
     def encoding(data):
         return msgpack.packb(data)
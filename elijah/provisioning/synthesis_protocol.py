@@ -32,12 +32,14 @@ class Protocol(object):
     MESSAGE_COMMAND_GET_RESOURCE_INFO   = 0x14
     MESSAGE_COMMAND_SESSION_CREATE      = 0x15
     MESSAGE_COMMAND_SESSION_CLOSE       = 0x16
+    MESSAGE_COMMAND_SEND_CHUNK_HASHES   = 0x18
     # server -> client as return
     MESSAGE_COMMAND_SUCCESS             = 0x01
     MESSAGE_COMMAND_FAIELD              = 0x02
     # server -> client as command
     MESSAGE_COMMAND_ON_DEMAND           = 0x03
     MESSAGE_COMMAND_SYNTHESIS_DONE      = 0x04
+    MESSAGE_COMMAND_WAITING             = 0x05
 
     #
     # other keys
@@ -51,6 +53,16 @@ class Protocol(object):
     KEY_SESSION_ID              = "session_id"
     KEY_REQUESTED_COMMAND       = "requested_command"
     KEY_OVERLAY_URL             = "overlay_url"
+    KEY_WAIT_POSITION           = "wait_position"
+    # client can skip blobs cached at Cloudlet
+    KEY_BLOB_CACHE              = "blob_cache"
+    KEY_CACHED_BLOBS            = "cached_blobs"
+    # client can skip frames whose chunks Cloudlet can reconstruct.
+    # Once Cloudlet accepts negotiation, client sends chunk hashes of
+    # overlay and gets a bitmap having a bit for each of them
+    KEY_CHUNK_NEGOTIATION       = "chunk_negotiation"
+    KEY_CHUNK_HASHES_SIZE       = "chunk_hashes_size"
+    KEY_CHUNK_BITMAP            = "chunk_bitmap"
 
     # synthesis option
     KEY_SYNTHESIS_OPTION        = "synthesis_option"
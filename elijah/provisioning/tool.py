@@ -28,11 +28,13 @@ from hashlib import sha1
 from hashlib import sha256
 import mmap
 import struct
+import multiprocessing
 from lzma import LZMACompressor
 from lzma import LZMADecompressor
 
 import msgpack 
 from Configuration import Const
+import codec
 import log as logging
 
 LOG = logging.getLogger(__name__)
@@ -43,6 +45,8 @@ HASHFILE_MAGIC = 0x1145511a
 HASHFILE_VERSION = 0x00000001
 HASH_CHUNKING_SIZE = 4012
 LZMA_OPTION = {'format':'xz', 'level':9}
+# size of data read from a blob and written at once while decompressing
+DECOMP_CHUNK_SIZE = 1024*1024
 
 def diff_files(source_file, target_file, output_file, **kwargs):
     # kwargs
@@ -235,22 +239,110 @@ def decomp_lzma(inputname, outputname, **kwargs):
     return outputname, str(time_diff)
 
 
-def decomp_overlay(meta, output_path):
+def iter_file(file_path, chunk_size):
+    # blob reader for decomp_blobs
+    fd = open(file_path, "rb")
+    try:
+        while True:
+            data = fd.read(chunk_size)
+            if not data:
+                break
+            yield data
+    finally:
+        fd.close()
+
+
+def get_blob_decomp_size(blob_info):
+    # decompressed size is known only for a blob with frame information
+    frames = blob_info.get(Const.META_OVERLAY_FILE_FRAMES, None)
+    if not frames:
+        return None
+    return sum([frame[Const.META_FRAME_DECOMP_SIZE] for frame in frames])
+
+
+def decomp_blob(comp_chunks, codec_name, out_fd, chunk_size=DECOMP_CHUNK_SIZE):
+    # stream compressed data through decompressor to out_fd
+    written_size = 0
+    for decomp_data in codec.iter_decompress(codec_name, comp_chunks, chunk_size):
+        out_fd.write(decomp_data)
+        written_size += len(decomp_data)
+    return written_size
+
+
+def _decomp_blob_at(decomp_task):
+    (blob_reader, blob_source, codec_name, output_path, offset,
+            decomp_size, chunk_size) = decomp_task
+    out_fd = open(output_path, "r+b")
+    try:
+        out_fd.seek(offset)
+        written_size = decomp_blob(blob_reader(blob_source, chunk_size),
+                codec_name, out_fd, chunk_size)
+    finally:
+        out_fd.close()
+    if written_size != decomp_size:
+        raise IOError("Decompressed size of %s is %d, but expected %d" % \
+                (str(blob_source), written_size, decomp_size))
+    return written_size
+
+
+def decomp_blobs(blob_list, blob_reader, output_path, num_proc=1,
+        chunk_size=DECOMP_CHUNK_SIZE):
+    '''decompress blobs into output file in order
+    blob_list: list of (blob source, blob info at overlay meta)
+    blob_reader(blob source, chunk_size): iterator of compressed data. It
+        should be a module level function to be passed to worker processes.
+    Each process keeps at most a few chunk_size of data in memory. When
+    decompressed size of every blob is known, blobs are decompressed in
+    parallel at their own region of the output file.
+    '''
+    decomp_sizes = [get_blob_decomp_size(blob_info) \
+            for (blob_source, blob_info) in blob_list]
+    if num_proc > 1 and len(blob_list) > 1 and None not in decomp_sizes:
+        decomp_tasks = list()
+        offset = 0
+        for (blob_source, blob_info), decomp_size in zip(blob_list, decomp_sizes):
+            codec_name, codec_level = codec.get_blob_codec(blob_info)
+            decomp_tasks.append((blob_reader, blob_source, codec_name,
+                output_path, offset, decomp_size, chunk_size))
+            offset += decomp_size
+        out_fd = open(output_path, "wb")
+        out_fd.truncate(offset)
+        out_fd.close()
+
+        pool = multiprocessing.Pool(processes=min(num_proc, len(decomp_tasks)))
+        try:
+            pool.map(_decomp_blob_at, decomp_tasks, 1)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return
+
+    out_fd = open(output_path, "w+b")
+    try:
+        for (blob_source, blob_info) in blob_list:
+            codec_name, codec_level = codec.get_blob_codec(blob_info)
+            decomp_blob(blob_reader(blob_source, chunk_size), codec_name,
+                    out_fd, chunk_size)
+    finally:
+        out_fd.close()
+
+
+def decomp_overlay(meta, output_path, num_proc=1, chunk_size=DECOMP_CHUNK_SIZE):
     meta_dict = msgpack.unpackb(open(meta, "r").read())
     decomp_start_time = time()
     comp_overlay_files = meta_dict[Const.META_OVERLAY_FILES]
-    comp_overlay_files = [item[Const.META_OVERLAY_FILE_NAME] for item in comp_overlay_files]
-    comp_overlay_files = [os.path.join(os.path.dirname(meta), item) for item in comp_overlay_files]
-    overlay_file = open(output_path, "w+b")
-    for comp_file in comp_overlay_files:
-        decompressor = LZMADecompressor()
-        comp_data = open(comp_file, "r").read()
-        decomp_data = decompressor.decompress(comp_data)
-        decomp_data += decompressor.flush()
-        overlay_file.write(decomp_data)
+    blob_list = list()
+    for blob_info in comp_overlay_files:
+        comp_file = os.path.join(os.path.dirname(meta),
+                blob_info[Const.META_OVERLAY_FILE_NAME])
+        blob_list.append((comp_file, blob_info))
+    decomp_blobs(blob_list, iter_file, output_path, num_proc=num_proc,
+            chunk_size=chunk_size)
     LOG.debug("Overlay decomp time for %d files: %f at %s\n" % \
             (len(comp_overlay_files), (time()-decomp_start_time), output_path))
-    overlay_file.close()
 
     return meta_dict
 
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#
+# Cloudlet Infrastructure for Mobile Computing
+#
+#   Copyright (C) 2011-2013 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import threading
+import unittest
+
+from elijah.provisioning.server import AdmissionController
+
+
+class AdmissionControllerTest(unittest.TestCase):
+    def setUp(self):
+        self.wait_interval = AdmissionController.WAIT_INTERVAL
+        AdmissionController.WAIT_INTERVAL = 0.05
+        self.expired = list()
+        self.admission = AdmissionController(1,
+                memory_budget=1024, disk_budget=1024,
+                idle_timeout=0.2, expire_callback=self.expired.append)
+
+    def tearDown(self):
+        AdmissionController.WAIT_INTERVAL = self.wait_interval
+
+    def _admit_later(self, session_id):
+        admitted = threading.Event()
+        def admit():
+            self.admission.admit(session_id, 1, 1)
+            admitted.set()
+        thread = threading.Thread(target=admit)
+        thread.daemon = True
+        thread.start()
+        return admitted
+
+    def test_session_left_without_close(self):
+        # session 1 finishes synthesis, but never sends SESSION_CLOSE
+        self.admission.admit(1, 1, 1)
+        self.admission.end_request(1)
+
+        admitted = self._admit_later(2)
+        self.assertTrue(admitted.wait(5))
+        self.assertEqual(self.expired, [1])
+        self.assertEqual(self.admission.admitted.keys(), [2])
+
+    def test_busy_session_is_not_expired(self):
+        # session 1 is still in its synthesis request
+        self.admission.admit(1, 1, 1)
+
+        admitted = self._admit_later(2)
+        self.assertFalse(admitted.wait(1))
+        self.assertEqual(self.expired, [])
+
+        self.admission.end_request(1)
+        self.assertTrue(admitted.wait(5))
+        self.assertEqual(self.expired, [1])
+
+    def test_released_session(self):
+        self.admission.admit(1, 1, 1)
+        self.admission.end_request(1)
+        self.admission.release(1)
+
+        admitted = self._admit_later(2)
+        self.assertTrue(admitted.wait(5))
+        self.assertEqual(self.expired, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# Cloudlet Infrastructure for Mobile Computing
+#
+#   Author: Kiryong Ha <krha@cmu.edu>
+#
+#   Copyright (C) 2011-2013 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+# Measure encoding/decoding speed of delta list (items per second)
+# per-item write/read vs. batched DeltaList.tofile/DeltaStreamDecoder
+
+import sys
+import os
+import time
+import random
+import tempfile
+
+if __name__ == "__main__":
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    from delta import DeltaItem
+    from delta import DeltaList
+    from delta import DeltaStreamDecoder
+
+    item_count = 200000
+    if len(sys.argv) > 1:
+        item_count = int(sys.argv[1])
+    chunk_size = 4096
+
+    # mixture of payload and reference items
+    random.seed(0)
+    payload = os.urandom(chunk_size)
+    delta_list = list()
+    for index in xrange(item_count):
+        ref_id = random.choice([DeltaItem.REF_RAW, DeltaItem.REF_XDELTA,
+            DeltaItem.REF_SELF, DeltaItem.REF_BASE_MEM,
+            DeltaItem.REF_BASE_DISK, DeltaItem.REF_ZEROS])
+        if ref_id == DeltaItem.REF_RAW:
+            data_len, data = chunk_size, payload
+        elif ref_id == DeltaItem.REF_XDELTA:
+            data_len, data = 300, payload[:300]
+        else:
+            data_len, data = 8, long(random.randint(0, 1<<30))
+        delta_list.append(DeltaItem(DeltaItem.DELTA_MEMORY,
+            index*chunk_size, chunk_size, None, ref_id, data_len, data))
+
+    bench_path = tempfile.mktemp(prefix="cloudlet-deltalist-")
+
+    # per-item write
+    start_time = time.time()
+    fd = open(bench_path, "wb")
+    for item in delta_list:
+        fd.write(item.get_serialized())
+    fd.close()
+    item_write = time.time() - start_time
+
+    # batched write
+    start_time = time.time()
+    DeltaList.tofile(delta_list, bench_path)
+    batch_write = time.time() - start_time
+
+    # per-item read
+    start_time = time.time()
+    fd = open(bench_path, "rb")
+    count = 0
+    while DeltaItem.unpack_stream(fd) != None:
+        count += 1
+    fd.close()
+    item_read = time.time() - start_time
+
+    # buffered read
+    start_time = time.time()
+    fd = open(bench_path, "rb")
+    decoder = DeltaStreamDecoder(fd)
+    decoded = 0
+    for items in decoder.iter_batches():
+        decoded += len(items)
+    fd.close()
+    batch_read = time.time() - start_time
+    os.remove(bench_path)
+
+    if count != item_count or decoded != item_count:
+        print "Error, decoded %d, %d items out of %d" % (count, decoded, item_count)
+        sys.exit(1)
+    print "items       : %d" % item_count
+    print "encode      : %d items/s (per-item), %d items/s (batch)" % \
+            (item_count/item_write, item_count/batch_write)
+    print "decode      : %d items/s (per-item), %d items/s (buffered)" % \
+            (item_count/item_read, item_count/batch_read)
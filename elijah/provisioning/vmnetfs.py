@@ -55,45 +55,59 @@ class VMNetFS(threading.Thread):
         # TODO: passing these argument through kwargs
         self.demanding_queue = kwargs.get("demanding_queue", None)
         self.meta_info = kwargs.get("meta_info", None)
+        # (delta type, chunk) of requested chunk to recovering process
+        self.demanded_chunk_queue = kwargs.get("demanded_chunk_queue", None)
         threading.Thread.__init__(self, target=self.fuse_read)
 
     def fuse_read(self):
         wait_statistics = list()
+        from delta import DeltaItem
         if (self.meta_info != None) and (self.demanding_queue != None):
             memory_overlay_dict = dict()
             disk_overlay_dict = dict()
             from Configuration import Const
+            from delta import get_blob_frames
+            # chunk -> (blob url, frame index), frame index is None for
+            # the blob without frames
             for blob in self.meta_info[Const.META_OVERLAY_FILES]:
                 overlay_url = blob[Const.META_OVERLAY_FILE_NAME]
-                memory_chunks = blob[Const.META_OVERLAY_FILE_MEMORY_CHUNKS]
-                for chunk in memory_chunks:
-                    memory_overlay_dict[chunk] = overlay_url
-                disk_chunks = blob[Const.META_OVERLAY_FILE_DISK_CHUNKS]
-                for chunk in disk_chunks:
-                    disk_overlay_dict[chunk] = overlay_url
+                for (frame_index, frame, memory_chunks, disk_chunks) in \
+                        get_blob_frames(blob):
+                    for chunk in memory_chunks:
+                        memory_overlay_dict[chunk] = (overlay_url, frame_index)
+                    for chunk in disk_chunks:
+                        disk_overlay_dict[chunk] = (overlay_url, frame_index)
 
         while(not self.stop.wait(0.0001)):
             self._running = True
             oneline = self.proc.stdout.readline()
             if len(oneline.strip()) > 0:
                 request_split = oneline.split(",")
-                if (self.demanding_queue != None) and \
-                        (len(request_split) > 0) and \
+                if (len(request_split) > 0) and \
                         (request_split[0].find("REQUEST") > 0):
                     overlay_type = request_split[1].split(":")[1].strip()
                     chunk = long(request_split[2].split(":")[1])
                     if overlay_type == VMNetFS.FUSE_TYPE_DISK:
-                        url = disk_overlay_dict.get(chunk, None)
+                        delta_type = DeltaItem.DELTA_DISK
                     elif overlay_type == VMNetFS.FUSE_TYPE_MEMORY:
-                        url = memory_overlay_dict.get(chunk, None)
+                        delta_type = DeltaItem.DELTA_MEMORY
                     else:
                         msg = "FUSE type does not match : %s" % overlay_type
                         raise VMNetFSError(msg)
+                    if self.demanded_chunk_queue != None:
+                        self.demanded_chunk_queue.put((delta_type, chunk))
+                    if self.demanding_queue == None:
+                        continue
 
+                    if delta_type == DeltaItem.DELTA_DISK:
+                        url = disk_overlay_dict.get(chunk, None)
+                    else:
+                        url = memory_overlay_dict.get(chunk, None)
                     if url == None:
                         msg = "Cannot find matching blob with chunk(%ld)" % chunk
                         raise VMNetFSError(msg)
                     #LOG.debug("requesting chunk(%ld) at %s" % (chunk, url))
+                    # (blob url, frame index)
                     self.demanding_queue.put(url)
                 elif (len(request_split) > 0) and (request_split[0].find("STATISTICS-WAIT") > 0):
                     type_name, overlay_type = request_split[1].split(":")